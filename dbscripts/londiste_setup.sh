@@ -1,6 +1,9 @@
 #!/bin/sh
 # This script should be run on the remote machine.
 # It sets up table replication
+# Don't partition a replicated table with avp_partition_existing (see avp_partitions) before trying it on a
+# test database. londiste replicates a table's own rows, so each monthly partition would have to be added
+# too, and the initial COPY of a partitioned parent fails.
 
 echo "Adding to master..."
 londiste3 /etc/londiste3.ini add-table `hostname`_cast
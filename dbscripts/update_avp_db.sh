@@ -1,6 +1,7 @@
 #!/bin/sh -x
 # Creates all the database tables that start with hostname
-psql -f avp_cast     `hostname` postgres # Has to be first
+psql -f avp_partitions `hostname` postgres # Functions for partitioning tables, used by db_trim.py
+psql -f avp_cast     `hostname` postgres # Has to be the first table
 
 psql -f avp_depth    `hostname` postgres
 psql -f avp_gps      `hostname` postgres
@@ -8,6 +9,7 @@ psql -f avp_isco     `hostname` postgres
 psql -f avp_lisst    `hostname` postgres
 psql -f avp_log      `hostname` postgres
 psql -f avp_power    `hostname` postgres
+psql -f avp_rpc_stats `hostname` postgres
 psql -f avp_schedule `hostname` postgres
 psql -f avp_sonde    `hostname` postgres
 psql -f avp_wind     `hostname` postgres
@@ -40,6 +40,13 @@ public class GpsdAdapter extends BrokerAdapter implements GpsdListener {
     /** Period in minutes for recording to database */
     private double mLogPeriod = 10;    // could easily go in config file
 
+    /** Distance in meters the position has to move from the last row logged
+        to log another row before mLogPeriod is up. 0 turns this off. */
+    private double mDeadBand = 0;
+
+    /** Meters per degree of latitude */
+    private static final double METERS_PER_DEGREE = 6371000.0 * Math.PI / 180.0;
+
     /** Rate at which gps updates data */
     private static final int UPDATE_INTERVAL = 1000;
 
@@ -47,6 +54,10 @@ public class GpsdAdapter extends BrokerAdapter implements GpsdListener {
     private long mLastDbTime = 0;
     private long mLastDataTime = 0;
 
+    /** Position of the last data recorded to database */
+    private double mLastDbLat = Double.NaN;
+    private double mLastDbLon = Double.NaN;
+
     // The hashmap JSONParameters is declared in BrokerAdapter.  This must exist
     // and be populated with the list of parameters, units, and access types (RO, RW)
     static {
@@ -67,6 +78,7 @@ public class GpsdAdapter extends BrokerAdapter implements GpsdListener {
         JSONParameters.put("epc",    arrayOf("m/s",     "RO"));
         JSONParameters.put("mode",   arrayOf("numeric", "RO"));
         JSONParameters.put("log_period", arrayOf("minutes", "RW"));
+        JSONParameters.put("dead_band", arrayOf("meters", "RW"));
     }
     private static String[] arrayOf(String a, String b) {
         String[] rv = {a, b};
@@ -76,6 +88,7 @@ public class GpsdAdapter extends BrokerAdapter implements GpsdListener {
     public GpsdAdapter(final Broker broker) {
         mBroker = broker;
         mLogPeriod = Double.parseDouble(mBroker.getProperties().getProperty("period", "10.0"));
+        mDeadBand = Double.parseDouble(mBroker.getProperties().getProperty("dead_band", "0"));
         mLogger = Logger.getLogger();   // construct a new logger
     }
 
@@ -196,8 +209,8 @@ public class GpsdAdapter extends BrokerAdapter implements GpsdListener {
                 reply.addResult(ps, "units", JSONParameters.get(ps)[UNITS_INDEX], changed, true);   // forVerbose
                 reply.addResult(ps, "sample_time", timeVal, changed);
             }
-            else if (ps.equals("log_period")) {
-                String newValue = String.valueOf(mLogPeriod);
+            else if (ps.equals("log_period") || ps.equals("dead_band")) {
+                String newValue = String.valueOf(ps.equals("log_period") ? mLogPeriod : mDeadBand);
                 if (entry.getValue() == null){
                     changed = true;
                 }
@@ -267,6 +280,15 @@ public class GpsdAdapter extends BrokerAdapter implements GpsdListener {
                     mLogger.log("Exception setting log period: " + e.getMessage(), this.getClass().getName(), LogLevel.ERROR);
                 }
             }
+            else if (ps.equals("dead_band")) {
+                mDeadBand = (Double) value;
+                mLogger.log("Changed dead_band to: " + mDeadBand, this.getClass().getName(), LogLevel.INFO);
+                try {
+                    reply.addResult(ps, "status", "ok");
+                } catch (Exception e) {
+                    mLogger.log("Exception setting dead band: " + e.getMessage(), this.getClass().getName(), LogLevel.ERROR);
+                }
+            }
         }
     }
 
@@ -283,13 +305,16 @@ public class GpsdAdapter extends BrokerAdapter implements GpsdListener {
         try {
             JSONObject jo = new JSONObject(d.get());
             
-            // Once every mLogPeriod save the position (TPV class) to the db
+            // Once every mLogPeriod, or whenever it has moved more than mDeadBand,
+            // save the position (TPV class) to the db
             String cls = jo.getString("class");
             if ( cls.equals("TPV") ) {
                 mJo = new JSONObject(d.get());
-                if (timestamp >= mLastDbTime+mLogPeriod*60000) {
+                if (timestamp >= mLastDbTime+mLogPeriod*60000 || movedPastDeadBand()) {
                     insertData();
                     mLastDbTime = timestamp;
+                    mLastDbLat = mJo.optDouble("lat");
+                    mLastDbLon = mJo.optDouble("lon");
                 }
             }
         } catch (JSONException e) {
@@ -299,6 +324,26 @@ public class GpsdAdapter extends BrokerAdapter implements GpsdListener {
         } 
     }
 
+    /**
+    Whether the position in mJo is more than mDeadBand meters from the last one
+    recorded to the database. A moored platform only logs every mLogPeriod, while
+    one that is moving or dragging logs every fix.
+    @return true if it should be recorded now
+    */
+    private boolean movedPastDeadBand() {
+        if (mDeadBand <= 0 || mJo.optInt("mode") < 2) {
+            return false;
+        }
+        double lat = mJo.optDouble("lat");
+        double lon = mJo.optDouble("lon");
+        if (Double.isNaN(lat) || Double.isNaN(lon) || Double.isNaN(mLastDbLat) || Double.isNaN(mLastDbLon)) {
+            return false;
+        }
+        double north = (lat - mLastDbLat) * METERS_PER_DEGREE;
+        double east = (lon - mLastDbLon) * METERS_PER_DEGREE * Math.cos(Math.toRadians(lat));
+        return Math.hypot(north, east) > mDeadBand;
+    }
+
     public Timestamp getLastDataTime() { return new Timestamp(mLastDataTime); }
     public Timestamp getLastDbTime() { return new Timestamp(mLastDbTime); }
 
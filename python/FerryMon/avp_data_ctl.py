@@ -4,8 +4,10 @@
 
 from datetime import datetime, timedelta
 import logging
+import queue
 import signal
 import sys
+import threading
 import time
 #Installed Modules
 import pytz.reference 
@@ -18,6 +20,7 @@ from time import sleep
 import gislib
 import avp_broker
 from shapely.geometry import Point, Polygon, LineString
+from shapely.prepared import prep
 import numpy as np
 
 class Transect(object):
@@ -26,10 +29,10 @@ class Transect(object):
     
     see __init__ for arguments.
     Public Methods:
-        setup
-        pre_transect
-        wait
-        do_transect
+        pre_config
+        start_transect
+        prepare_transect
+        begin_transect
         finish_transect
     '''
     REQUIRED_SONDE_SUBSCRIPTIONS = ['sampling',   # Is sonde in sampling (run) mode?*
@@ -49,6 +52,8 @@ class Transect(object):
         self.logger = logging.getLogger(self.__class__.__name__) # set up logging
         self.transects_started = 0
         self.transects_completed = 0
+        self.logging_started = False
+        self.transect_db = None
         
     def pre_config(self, transect_time=datetime.now(pytz.reference.LocalTimezone()), transect_number=None,
                    wipe=True, load_config=False, **kwargs):
@@ -80,44 +85,59 @@ class Transect(object):
         self.flow = avp_broker.FlowBroker(config)
         
     def start_transect(self, **kwargs):
+        '''
+        Prepares and begins a transect, trying a second time if it aborts.
+        Returns True if the transect started.
+        '''
         self.logger.debug('Transect.start_transect');
+        if self.prepare_transect() is True and self.begin_transect() is True:
+            return True
+        self.logger.error('Transect.start_transect aborted.  Trying a second time.')
+        time.sleep(5) 	# give it some time
+        return self.prepare_transect(retry=True) is True and self.begin_transect() is True
+
+    def prepare_transect(self, retry=False, **kwargs):
+        '''
+        The slow part of starting a transect, which DataControl runs in the background as soon as the
+        ferry is in the route: gets the sonde token, checks the instruments, opens the water valve, wipes
+        the sonde and starts it sampling.
+        Keyword Arguments:
+            retry   -- This is another try at the same transect, so don't increment the transect number.
+        Returns True if it is ready for begin_transect.
+        '''
+        self.logger.debug('Transect.prepare_transect')
         self.abort_transect = {}
-        result = {}
-		
-		# increment the transect number if it has already been set
-        if self.transect_number:
+        self.logging_started = False
+        # increment the transect number if it has already been set
+        if self.transect_number and retry is False:
             self.transect_number = self.transect_number + 1
-			
-		
+        result = {}
         result['01 get_tokens'] = self.get_tokens()
         result['02 check_instrument_status'] = self.check_instrument_status()
         self.logger.info("Turning on water valve")
         self.flow.water_on()	# open the valve (if it exists)
         result['03 wipe_sensor'] = self.wipe_sensor()
         result['04 init_instruments'] = self.init_instruments()		# this starts sonde sampling
-        result['05 init_db'] = self.init_db()     
+        self.logger.debug('Transect.prepare_transect result: {0}'.format(result))
+        return not self.abort_transect
+
+    def begin_transect(self, **kwargs):
+        '''
+        Adds the transect to the database and starts the sonde logging it. Call after prepare_transect.
+        Returns True if the transect started.
+        '''
+        if self.abort_transect: return False
+        self.logger.debug('Transect.begin_transect')
+        result = {}
+        result['05 init_db'] = self.init_db()
         result['06 start_logging'] = self.start_logging()
         if self.abort_transect:
-            self.logger.error('Transect.start_transect aborted.  Trying a second time.')
-            time.sleep(5) 	# give it some time
-            self.abort_transect = {}
-            result = {}
-		
-            result['01 get_tokens'] = self.get_tokens()
-            result['02 check_instrument_status'] = self.check_instrument_status()
-            self.logger.info("Turning on water valve")
-            self.flow.water_on()	# open the valve (if it exists)
-            result['03 init_instruments'] = self.init_instruments()
-            result['04 init_db'] = self.init_db()     
-            result['05 wipe_sensor'] = self.wipe_sensor()
-            result['06 start_logging'] = self.start_logging()
-        if self.abort_transect:
-            transect_started = False
-        else:
-            transect_started = True
-            self.check_flow_rate()		# must be run after check_instrument_status and init_db, issues warning if out of range
-			
-        return transect_started
+            self.logger.debug('Transect.begin_transect result: {0}'.format(result))
+            return False
+        self.logging_started = True
+        self.transects_started += 1
+        self.check_flow_rate()		# must be run after check_instrument_status and init_db, issues warning if out of range
+        return True
 
     def check_flow_rate(self, **kwargs):
         flowrate = self.flow.flowrate_mean30.value
@@ -321,9 +341,12 @@ class Transect(object):
         result['18 sonde.unsubscribe_all'] = self.sonde.unsubscribe_all(debug_mode=self.debug_mode)
         # Release all other tokens
         result['22 sonde.tokenRelease'] = self.sonde.tokenRelease(debug_mode=self.debug_mode)
-        self.transect_db.finish()        # Close the database.
-        if self.abort_transect == {}:
+        if self.transect_db is not None:
+            self.transect_db.finish()        # Close the database.
+            self.transect_db = None
+        if self.abort_transect == {} and self.logging_started is True:
             self.transects_completed += 1
+        self.logging_started = False
         return result
 
     def shutdown(self):
@@ -331,7 +354,77 @@ class Transect(object):
         self.sonde.disconnect()
         self.flow.disconnect()
             
+def _as_list(value):
+    # ConfigObj gives a string rather than a list when there is only one value
+    if isinstance(value,str):
+        return [value]
+    return value
+
+
+class RouteFence(object):
+    '''
+    The ferry's route corridor and ports from the [data_ctl] section of the config, worked out once
+    so that each GPS fix can be checked quickly.
+    The corridor is ROUTE_LAT/ROUTE_LON buffered by ROUTE_WIDTH meters on the flat projection
+    DataControl has always used, kept as a prepared shapely geometry. Each fix is projected to
+    test it, rather than the corridor being projected back to degrees every time.
+    Ports are PORT_RADIUS km circles. Each has a lat/lon box around it, so the haversine distance
+    is only worked out for a port the fix could be in.
+    Public Methods: port_at, in_route
+    Instance Variables: corridor, outline, ports
+    '''
+    R_EARTH = 6378000 # meters
+    KM_PER_DEGREE = 110.0 # A little under the real value, so the port boxes are never too small
+    def __init__(self,config):
+        data_ctl = config['data_ctl']
+        route_lat = [float(lat) for lat in _as_list(data_ctl['ROUTE_LAT'])]
+        route_lon = [float(lon) for lon in _as_list(data_ctl['ROUTE_LON'])]
+        self._lat_scale = (2*np.pi/360)*self.R_EARTH
+        self._lon_scale = self._lat_scale*np.cos(route_lat[0]*np.pi/180)
+        route = LineString([self._project(lat,lon) for lat,lon in zip(route_lat,route_lon)])
+        # Only the outside edge is used, so any holes where the route loops are in the corridor
+        self.corridor = Polygon(route.buffer(float(data_ctl['ROUTE_WIDTH'])).exterior)
+        self._corridor = prep(self.corridor)
+        self.outline = [(x/self._lat_scale,y/self._lon_scale) for x,y in self.corridor.exterior.coords]
+        self.ports = [] # (name,lat,lon,radius km,min lat,max lat,min lon,max lon)
+        for name,lat,lon,radius in zip(_as_list(data_ctl['PORT_NAME']),_as_list(data_ctl['PORT_LAT']),
+                                       _as_list(data_ctl['PORT_LON']),_as_list(data_ctl['PORT_RADIUS'])):
+            lat,lon,radius = float(lat),float(lon),float(radius)
+            d_lat = radius/self.KM_PER_DEGREE
+            d_lon = d_lat/np.cos(lat*np.pi/180)
+            self.ports.append((name,lat,lon,radius,lat - d_lat,lat + d_lat,lon - d_lon,lon + d_lon))
+    def _project(self,lat,lon):
+        return (lat*self._lat_scale,lon*self._lon_scale)
+    def port_at(self,lat,lon):
+        '''
+        Returns the name of the port lat,lon is in, or None.
+        '''
+        for name,port_lat,port_lon,radius,min_lat,max_lat,min_lon,max_lon in self.ports:
+            if min_lat <= lat <= max_lat and min_lon <= lon <= max_lon:
+                if gislib.getDistance((port_lat,port_lon),(lat,lon)) < radius:
+                    return name
+        return None
+    def in_route(self,lat,lon):
+        return self._corridor.contains(Point(self._project(lat,lon)))
+
+
 class DataControl(object):
+    '''
+    Starts and finishes transects as the ferry goes along its route.
+    Each GPS fix from the subscription is checked against the RouteFence as it arrives, and the
+    transect moves through these states:
+        idle       -- Not in the route (or in port).
+        preparing  -- In the route, Transect.prepare_transect (tokens, wipe...) running in the background.
+        ready      -- Prepared, waiting for ROUTE_ENTER_FIXES fixes in a row in the route.
+        starting   -- Transect.begin_transect running in the background.
+        sampling   -- Logging the transect.
+    ROUTE_LEAVE_FIXES fixes in a row out of the route, or in port, finish the transect from any state but idle.
+    The Transect methods run one at a time, in order, in the transect jobs thread so that fixes keep
+    being handled while they do.
+    Public Methods: get_coordinates, main_loop, shutdown
+    Instance Variables: fence, gps, state, transect
+    '''
+    RETRY_WAIT = 5 # Seconds after a failed start before trying again
     def __init__(self, **kwargs):
         self._running = True
         # catch some signals and perform an orderly shutdown
@@ -349,6 +442,23 @@ class DataControl(object):
         self._logger = logging.getLogger(self.__class__.__name__)
         # some startup messages
         self._logger.info('Starting FerryMon Data Controller')
+        data_ctl = self._config.get('data_ctl',{})
+        self.GPS_FREQ = float(data_ctl.get('GPS_FREQ',10)) # Longest we wait for a fix before checking the broker
+        self.ROUTE_ENTER_FIXES = int(data_ctl.get('ROUTE_ENTER_FIXES',3))
+        self.ROUTE_LEAVE_FIXES = int(data_ctl.get('ROUTE_LEAVE_FIXES',3))
+        self.state = 'idle'
+        self._fixes_in = 0 # Fixes in a row in the route
+        self._fixes_out = 0 # Fixes in a row out of the route
+        self._retry_time = 0
+        self._new_fix = threading.Event()
+        self._jobs = queue.Queue() # (job name,Transect method) for the transect jobs thread, None to stop it
+        self._done = queue.Queue() # (job name,result) back from it
+        self._job_thread = threading.Thread(target=self._run_jobs,name='transect jobs')
+        self._job_thread.daemon = True
+        try:
+            self.fence = RouteFence(self._config)
+        except KeyError as e:
+            self._logger.warning('Error finding configuration key '+str(e))
         
         # get GPS broker
         self._get_gps_broker()        
@@ -356,7 +466,74 @@ class DataControl(object):
     def _get_gps_broker(self):
         # get GPS broker
         self.gps = avp_broker.GpsBroker(config)
-        self.gps.add_subscriptions(['lat','lon'],on_change=True,subscriber="avp_data_ctl")
+        self.gps.add_subscriptions(['lat','lon','mode'],on_change=True,subscriber="avp_data_ctl")
+        self.gps.add_callback({'lat':self._fix_cb,'lon':self._fix_cb})
+
+    def _fix_cb(self, sample_time, data_item):
+        # Runs in a subscription callback thread, so just wake up main_loop
+        self._new_fix.set()
+
+    def _run_jobs(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            name,method = job
+            try:
+                result = method()
+            except Exception as e:
+                self._logger.error('Transect {0} failed: {1}'.format(name,e))
+                result = False
+            self._done.put((name,result))
+
+    def _submit(self, name, method, state):
+        self._logger.debug('{0} -> {1}, queuing {2}'.format(self.state,state,name))
+        self.state = state
+        self._jobs.put((name,method))
+
+    def _route_update(self, in_route):
+        '''
+        Counts the fixes in a row in and out of the route, then moves the transect along.
+        '''
+        if in_route is True:
+            self._fixes_in += 1
+            self._fixes_out = 0
+        else:
+            self._fixes_out += 1
+            self._fixes_in = 0
+        self._advance()
+
+    def _advance(self):
+        if self.state == 'idle':
+            if self._fixes_in > 0 and time.time() >= self._retry_time:
+                self._logger.info('Entered the route - preparing instruments for a transect')
+                self._submit('prepare',self.transect.prepare_transect,'preparing')
+        elif self._fixes_out >= self.ROUTE_LEAVE_FIXES:
+            self._logger.info('Transition from in to out of gps range - finishing transect')
+            self._submit('finish',self.transect.finish_transect,'idle')
+        elif self.state == 'ready' and self._fixes_in >= self.ROUTE_ENTER_FIXES:
+            self._logger.info('Transition from out to in of gps range - starting transect')
+            self._submit('begin',self.transect.begin_transect,'starting')
+
+    def _check_jobs(self):
+        '''
+        Handles the results of the jobs which have finished.
+        '''
+        while True:
+            try:
+                name,result = self._done.get_nowait()
+            except queue.Empty:
+                return
+            expected = {'prepare':'preparing','begin':'starting'}.get(name)
+            if expected is None or self.state != expected:
+                continue # finish, or a job overtaken by leaving the route
+            if result is True:
+                self.state = {'preparing':'ready','starting':'sampling'}[self.state]
+            else:
+                self._logger.error('Transect {0} aborted.  Trying again in {1} seconds.'.format(name,self.RETRY_WAIT))
+                self.state = 'idle'
+                self._retry_time = time.time() + self.RETRY_WAIT
+            self._advance()
         
     def _gps_checks(self):
         if hasattr(self, 'gps') is False:
@@ -364,14 +541,8 @@ class DataControl(object):
         elif self.gps.initialized is False:
             self._logger.debug('GPS client not initialized, skipping _gps_checks')
         if self.gps.connected() is True:
-            try:
-                port_lat = self._config['data_ctl']['PORT_LAT']
-                port_lon = self._config['data_ctl']['PORT_LON']
-                port_radius = self._config['data_ctl']['PORT_RADIUS']  
-                port_name = self._config['data_ctl']['PORT_NAME']
-            except KeyError as e:
-                self._logger.warning('Error finding configuration key '+str(e))
-                return
+            if hasattr(self, 'fence') is False:
+                return # No route in the config
             lat = None
             lon = None
             mode = None
@@ -386,18 +557,11 @@ class DataControl(object):
             if (mode == 3) or (mode == 2):   # only check gps for 3d fixes
                 try:
                     if lat != 'NaN' and lon != 'NaN':
-                        for i in range(len(port_lat)):
-                            distance, bearing = gislib.get_distance_bearing((float(port_lat[i]),float(port_lon[i])), (lat, lon))
-                            if distance < float(port_radius[i]): # add more parameters
-                                self._logger.debug('Within Port: {0} at: {1:6.4f}, {2:6.4f} '.format(port_name[i], lat, lon) )
-                                return False
-                        
-                        point = Point(lat, lon)
-                        route = self.get_coordinates()
-                        poly = Polygon(route)
-                        #print(poly)
-                        k = point.within(poly)
-                        if k:
+                        port = self.fence.port_at(lat, lon)
+                        if port is not None:
+                            self._logger.debug('Within Port: {0} at: {1:6.4f}, {2:6.4f} '.format(port, lat, lon) )
+                            return False
+                        if self.fence.in_route(lat, lon):
                             self._logger.debug('Within Sampling Range of expected route at: {0:6.4f}, {1:6.4f} '.format(lat, lon) )
                             return True
                         else:
@@ -411,30 +575,10 @@ class DataControl(object):
             return j
                            
     def get_coordinates(self):
-        route_lat = self._config['data_ctl']['ROUTE_LAT']
-        route_lon = self._config['data_ctl']['ROUTE_LON']      
-        route_width = self._config['data_ctl']['ROUTE_WIDTH']
-        route1 = []
-        route2 = []
-        r_earth = 6378000
-                
-        for i in range(len(route_lat)):
-            x1p = float(route_lat[i])*(2*np.pi/360)*r_earth
-            y1p = float(route_lon[i])*(2*np.pi/360)*r_earth*np.cos(float(route_lat[0])*np.pi/180)
-            route1.append((x1p,y1p))
-            
-        r = LineString(route1)
-        poly = Polygon(r.buffer(float(route_width)))
-        x = []
-        y = []
-        x,y = poly.exterior.coords.xy
-                
-        for i in range(len(x)):
-            x2p = x[i]/((2*np.pi/360)*r_earth)
-            y2p = y[i]/((2*np.pi/360)*r_earth*np.cos(float(route_lat[0])*np.pi/180))
-            route2.append((x2p,y2p))
-                    
-        return route2
+        '''
+        Returns the outline of the route corridor as a list of (lat,lon)
+        '''
+        return self.fence.outline
         
     def _stop_running(self, signal_number, *args):
         self._running = False
@@ -456,35 +600,25 @@ class DataControl(object):
         
     def main_loop(self, **kwargs):
         transect_time = datetime.now(pytz.reference.LocalTimezone())
-        transect = Transect(program_name='avp_data_ctl', debug_mode=False)
-        transect.pre_config(transect_time=transect_time)
-        transect_started = False
-        gps_freq = self._config['data_ctl']['GPS_FREQ']
-        while self._running:          
-            if datetime.now(pytz.reference.LocalTimezone()).second % float(gps_freq) == 0:
-                in_gps_range = self._gps_checks() #will be true or false depending on GPS check  
-                if in_gps_range is True:
-                    if transect_started is False:
-                        self._logger.info('Transition from out to in of gps range - starting transect')
-                        if transect.start_transect() is True:
-                            transect_started = True
-                    
-                else:
-                    #self._logger.debug('In Port, or Out of Sampling Range')
-                    if transect_started is True:
-                        self._logger.info('Transition from in to out of gps range - finishing transect')
-                        transect.finish_transect()
-                        transect_started = False
-            
-                if self.gps.socket_handler.connected is False:
-                    self.GpsBroker.disconnect()
-                    self._logger.warning('gps broker is not connected')
-                    self._get_gps_broker()
-            
-            sleep(1)
-        if transect_started is True:
-            transect.finish_transect()
-        transect.shutdown()
+        self.transect = Transect(program_name='avp_data_ctl', debug_mode=False)
+        self.transect.pre_config(transect_time=transect_time)
+        self._job_thread.start()
+        while self._running:
+            if self._new_fix.wait(self.GPS_FREQ):
+                self._new_fix.clear()
+                in_gps_range = self._gps_checks() #will be true or false depending on GPS check
+                if in_gps_range is not None:
+                    self._route_update(in_gps_range is True)
+            self._check_jobs()
+            if self.gps.socket_handler.connected is False:
+                self.gps.disconnect()
+                self._logger.warning('gps broker is not connected')
+                self._get_gps_broker()
+        if self.state != 'idle':
+            self._submit('finish',self.transect.finish_transect,'idle')
+        self._jobs.put(None)
+        self._job_thread.join()
+        self.transect.shutdown()
         self.shutdown()
                     
 
@@ -124,4 +124,37 @@ def get_bearing(loc1, loc2):
     y = sin(delta_lon) * cos(lat2)
     x = cos(lat1)*sin(lat2) - sin(lat1)*cos(lat2)*cos(delta_lon)
     bearing = atan2( y,x)
-    return to_degrees(bearing)
\ No newline at end of file
+    return to_degrees(bearing)
+
+
+# Array versions of the functions above. They take NumPy arrays (or anything np.asarray accepts)
+# of decimal degrees and broadcast them, so a whole track is done in one call instead of a loop.
+# NumPy is only imported when they are used.
+
+def get_distances(lat1, lon1, lat2, lon2):
+    "Haversine distances in km between (lat1,lon1) and (lat2,lon2), like getDistanceByHaversine"
+    import numpy as np
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(value, dtype=float)) for value in (lat1, lon1, lat2, lon2)]
+    a = np.sin((lat2 - lat1)/2.0)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1)/2.0)**2
+    return earthradius * 2.0 * np.arctan2(np.sqrt(a), np.sqrt(1.0 - a))
+
+def get_bearings(lat1, lon1, lat2, lon2):
+    "Initial bearings in degrees (0-360) from (lat1,lon1) to (lat2,lon2), like get_bearing"
+    import numpy as np
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(value, dtype=float)) for value in (lat1, lon1, lat2, lon2)]
+    delta_lon = lon2 - lon1
+    y = np.sin(delta_lon) * np.cos(lat2)
+    x = np.cos(lat1)*np.sin(lat2) - np.sin(lat1)*np.cos(lat2)*np.cos(delta_lon)
+    return (np.degrees(np.arctan2(y, x)) + 360.0) % 360
+
+def get_distance_matrix(lats, lons, ref_lats, ref_lons):
+    "Distances in km from each of N points to each of M reference points, as an N x M array"
+    import numpy as np
+    lats, lons = np.asarray(lats, dtype=float).reshape(-1, 1), np.asarray(lons, dtype=float).reshape(-1, 1)
+    return get_distances(lats, lons, np.ravel(ref_lats), np.ravel(ref_lons))
+
+def is_within_distance(lats, lons, origin_lat, origin_lon, distance):
+    """boolean array of which points are within distance km of an origin, like isWithinDistance.
+    To test a track against several origins at once, e.g. ports with their own radii:
+        in_port = is_within_distance(lats[:,None], lons[:,None], port_lats, port_lons, port_radii).any(axis=1)"""
+    return get_distances(origin_lat, origin_lon, lats, lons) <= distance
@@ -20,9 +20,15 @@
 # Created:     01/02/2012
 #-------------------------------------------------------------------------------
 #Built in Modules
+import bisect
+from collections import deque
 from datetime import datetime,timedelta
+import hashlib
+import itertools
 import json
 import logging
+import math
+import os
 from random import random
 from select import select as sselect
 import socket
@@ -33,16 +39,11 @@ import time
 import pytz.reference
 #Custom Modules
 import avp_util
-import avp_db
-
-
-if sys.version_info < (3,):
-    def b(x):
-        return x
-else:
-    import codecs
-    def b(x):
-        return codecs.latin_1_encode(x)[0]
+import avp_codec
+import avp_record
+import avp_shm
+import avp_stats
+# avp_db (and so psycopg2) is imported where it is used, most broker clients never need it.
 
 '''
 TODO: check for errors on _status, set, subscribe calls
@@ -63,16 +64,32 @@ class SocketHandler(threading.Thread):
         rx_n        -- Shared list of notifications
         so_timeout  -- Default socket timeout.
         broker_name -- Used for naming thread
+        recorder    -- Optional avp_record.Recorder which gets a copy of all traffic
+        reconnect_min -- Seconds to wait after the first failed connection attempt. Doubles with each
+                         failure, up to reconnect_max, and is randomized so clients don't retry together.
+        reconnect_max -- Longest wait between connection attempts.
+        proxy       -- Optional (host,port) of avp_proxy.py. It is tried first on every connection attempt,
+                       and the broker is connected to directly if it isn't listening.
     Instance attributes:
         connected   -- Are we connected to broker server
+        stats       -- avp_stats.BrokerStats shared with other clients of this broker
+        on_reconnect -- Called in a new thread whenever the connection to the broker has been re-established
         
     '''
-    def __init__(self, host, PORT, rx_r, rx_n, so_timeout, broker_name,debug_mode=False):
+    def __init__(self, host, PORT, rx_r, rx_n, so_timeout, broker_name,debug_mode=False,recorder=None,
+                 reconnect_min=0.5,reconnect_max=30,proxy=None):
         self.debug_mode = debug_mode
+        self.broker_name = broker_name
+        self.recorder = recorder
+        self.record_tag = avp_record.connection_tag() if recorder is not None else None
+        self.stats = avp_stats.for_broker(broker_name)
         self.logger = logging.getLogger('{0}.{1}'.format(broker_name,self.__class__.__name__))
         if self.debug_mode is False:
             self.logger.setLevel(logging.INFO)
-        self.address = (host,PORT)
+        self.broker_address = (host,PORT)
+        self.proxy = proxy
+        self.address = self.broker_address # Whichever we are connected to
+        self.socket = None
         self._rx_r = rx_r
         self._rx_n = rx_n
         self.so_timeout = so_timeout
@@ -81,6 +98,14 @@ class SocketHandler(threading.Thread):
         self.running = False
         self.connected = False
         self.connect_tries = 0
+        self.reconnect_min = reconnect_min
+        self.reconnect_max = reconnect_max
+        self.on_reconnect = None
+        self._has_connected = False
+        self._stopping = threading.Event() # Set by shutdown() to cut short a reconnect wait
+        self.timed_out = False # Did the last _get_reply() time out
+        self._reply_ready = threading.Condition()
+        self.framer = avp_codec.FrameReader()
     def send_rpc(self, method, json_id,timeout=None,params=None,**kwargs):
         ''' 
         Formats and sends JSON-RPC message to broker server.
@@ -105,114 +130,187 @@ class SocketHandler(threading.Thread):
         if not self.connected:
             error_msg = 'Not connected to broker.'
             self.logger.error(error_msg)
+            self.stats.rpc(method,0,error=True)
             return {'error':{'message':error_msg,'code':0}}
         self.msg = {'method':method, 'id':json_id}
         if timeout is None:
             timeout=self.so_timeout
         if params:
             self.msg['params'] = params
-        if debug_mode: print(("JSON-RPC Request:{0}".format(json.dumps(self.msg))))
-        self._send(json.dumps(self.msg))
+        data = avp_codec.dumps(self.msg)
+        if debug_mode: print(("JSON-RPC Request:{0}".format(data.decode('utf-8'))))
+        if self.recorder is not None:
+            self.recorder.request(self.broker_name,self.record_tag,data)
+        start_time = time.time()
+        self._send(data)
         # We may want to do something else if send_result is 0
         reply_result = self._get_reply(json_id,timeout)
+        self.stats.rpc(method,time.time() - start_time,error='error' in reply_result,timed_out=self.timed_out)
         return reply_result
+    def send_batch(self,requests,timeout=None):
+        '''
+        Sends several JSON-RPC requests in one write, then waits for all the replies.
+
+        Arguments:
+            requests -- List of (method,json_id,params) tuples. params may be None.
+            timeout  -- Number of seconds to wait for all the replies. if nothing is specified, default is used.
+        Returns:
+            A list of replies in the same order as requests, see send_rpc().
+        '''
+        if not self.connected:
+            return [{'error':{'message':'Not connected to broker.','code':0}} for request in requests]
+        if timeout is None:
+            timeout=self.so_timeout
+        frames = []
+        for method,json_id,params in requests:
+            msg = {'method':method,'id':json_id}
+            if params:
+                msg['params'] = params
+            frames.append(avp_codec.dumps(msg))
+            if self.recorder is not None:
+                self.recorder.request(self.broker_name,self.record_tag,frames[-1])
+        start_time = time.time()
+        self._send(b''.join(frames))
+        end_time = start_time + timeout
+        replies = []
+        for method,json_id,params in requests:
+            self.msg = {'method':method,'id':json_id}
+            reply_result = self._get_reply(json_id,max(end_time - time.time(),0.1))
+            self.stats.rpc(method,time.time() - start_time,error='error' in reply_result,timed_out=self.timed_out)
+            replies.append(reply_result)
+        return replies
     def _send(self, data):
         if not self.running:
             self.logger.debug("Socket not connected.")
             return 0
         try:
-            self.socket.send(b(data))
+            self.socket.sendall(data)
             return 1
         except Exception as e:
             self.running = False
             self.logger.debug('{0}.send broker failed ({1}).'.format(self.name,e))
             return 0
     def _get_reply(self,json_id,timeout):
-        endtime = time.time() + int(timeout)
+        endtime = time.time() + float(timeout)
         tries = 0
-        while time.time() < endtime:
-            if json_id in self._rx_r:
+        self.timed_out = False
+        with self._reply_ready:
+            while json_id not in self._rx_r:
+                remaining = endtime - time.time()
+                if remaining <= 0 or not self.running:
+                    break
+                # run() notifies as soon as any reply arrives, so replies aren't held up by a polling interval.
+                self._reply_ready.wait(min(remaining,1))
+                tries += 1
+            else:
                 return self._rx_r.pop(json_id)
-            try:
-                # This is a straightforward interface to the Unix select() system call. The first three arguments are
-                # sequences of 'waitable objects': either integers representing file descriptors or objects with a
-                # parameterless method named fileno() returning such an integer
-                [read_list, write_list, exception_list] = sselect([self.sf],[],[], 0.1)
-            except (AttributeError,) as e:
-                # This can happen if a broker is killed while awaiting a response
-                break
-            tries += 1
-            time.sleep(0.1)
         error_msg = 'Response from {a} timed out after {t} tries in {to}s ({n},{j}). Request was {m}. Response was:{r}'.format(
                         a=self.address,to=timeout,n=self.name,j=json_id,m=self.msg,t=tries,r=self._rx_r)
         self.logger.error(error_msg)
+        self.timed_out = True
         return {'error':{'message':error_msg,'code':0}}
     def shutdown(self):
+        self._stopping.set()
         if self.running is True:
             self.running = False
             time.sleep(1) # Give main thread time to stop
             self.logger.debug("Shutting down {0:2} threads left.".format(threading.active_count()))
-            try:
-                self.sf.close()
-            except AttributeError as e:
-                # If there were problems starting up, sf may not exist.
-                pass
             try:
                 self.socket.shutdown(socket.SHUT_RDWR)
             except (socket.error, Exception) as e:
-                pass # It may already be shut down.
-            self.socket.close()
+                pass # It may already be shut down, or never have connected.
+            if self.socket is not None:
+                self.socket.close()
     def start(self):
         self.running = True
+        self._stopping.clear()
         super(SocketHandler,self).start() #threading.Thread.start(self)
         self.logger.debug("Started up {0:24} {1:2} active threads.".format(self.name,threading.active_count()))
     def run(self):
         while self.running:
             if self.connected:
                 try:
-                    [read_list, write_list, exception_list] = sselect([self.sf],[],[], 1)
+                    [read_list, write_list, exception_list] = sselect([self.socket],[],[], 1)
                     if(len(read_list) > 0):
-                        try:
-                            jrx = self.sf.readline()[:-1]
-                        except AttributeError:
-                            pass # Rarely we get this from socket.py
-                                 # data = self._sock.recv(self._rbufsize)
-                                 # AttributeError: 'NoneType' object has no attribute 'recv'
-                        rx = json.loads(jrx)
-                        rxid = rx.get("id",None)
-                        if rxid is not None:
-                            self._rx_r[rxid] = rx # It's a reply
-                            if self.debug_mode: print(("RPC Resp:{0}".format(json.dumps(rx,sort_keys=True))))
-                        else:
-                            self._rx_n.append(rx) # It's a notification
-                            if self.debug_mode: print(("RPC Noti:{0}".format(json.dumps(rx,sort_keys=True))))
-                except ValueError as e:
+                        # Every complete frame in this recv() is handled now. A text mode makefile()
+                        # would leave extra lines in its buffer where select() can't see them.
+                        frames = self.framer.read(self.socket)
+                        if frames is None:
+                            raise socket.error("Connection closed by broker")
+                        for frame in frames:
+                            self._receive(frame)
+                except (socket.error, ValueError) as e:
                     self.logger.info("In SocketHandler.run: {0}".format(e))
                     self.connected = False
-                    self.sf.close()
-                    self.socket.shutdown(socket.SHUT_RDWR)
+                    try:
+                        self.socket.shutdown(socket.SHUT_RDWR)
+                    except (socket.error, Exception):
+                        pass # It may already be shut down.
                     self.socket.close()
             else:
                 # Connect or re-connect
                 self.start_connection()
+    def _receive(self,frame):
+        try:
+            rx = avp_codec.loads(frame)
+        except avp_codec.DecodeError as e:
+            self.logger.info("Could not decode {0} from broker: {1}".format(frame[:80],e))
+            return
+        rxid = rx.get("id",None)
+        if rxid is not None:
+            with self._reply_ready:
+                self._rx_r[rxid] = rx # It's a reply
+                self._reply_ready.notify_all()
+            if self.recorder is not None:
+                self.recorder.reply(self.broker_name,self.record_tag,frame)
+            if self.debug_mode: print(("RPC Resp:{0}".format(frame.decode('utf-8','replace'))))
+        else:
+            self._rx_n.append(rx) # It's a notification
+            self.stats.notification(time.time())
+            if self.recorder is not None:
+                self.recorder.notification(self.broker_name,self.record_tag,frame)
+            if self.debug_mode: print(("RPC Noti:{0}".format(frame.decode('utf-8','replace'))))
     def start_connection(self):
         # This should be in a try, so if we get "socket.error: [Errno 111] Connection refused" or some other error it is handled.
         try:
             self.connect_tries += 1
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect(self.address)
-            self.sf = self.socket.makefile('r') # returns a readable file object
+            self.socket = self._connect()
+            self.framer.reset() # Don't mix a partial frame from the last connection with this one.
             self.connected = True
+            if self.recorder is not None:
+                self.recorder.connected(self.broker_name,self.record_tag,self.address)
             if self.connect_tries > 1:
                 self.logger.debug("{0}.start_connection re-connected to {1}.".format(self.name,self.address))
             else:
                 self.logger.debug("{0}.start_connection connected to {1}.".format(self.name,self.address))
             self.connect_tries = 0
+            if self._has_connected and self.on_reconnect is not None:
+                # Not in this thread, which has to be reading the socket for the callback's replies.
+                threading.Thread(target=self.on_reconnect,name='{0}.reconnect'.format(self.broker_name)).start()
+            self._has_connected = True
         except Exception as e:
-            print(("ERROR",e))
-            if self.connect_tries == 1 or self.connect_tries % 60 == 0:
+            if self.connect_tries == 1 or self.connect_tries % 10 == 0:
                 self.logger.info("in start_connection(), connection to (host,port):{0}, failed ({1}).".format(self.address,e))
-            time.sleep(1)
+            # Exponential backoff with jitter
+            delay = min(self.reconnect_max,self.reconnect_min * 2 ** min(self.connect_tries - 1,16))
+            self._stopping.wait(delay * (0.5 + random() / 2))
+    def _connect(self):
+        '''
+        Returns a socket connected to the proxy if there is one and it is listening, otherwise to the broker.
+        '''
+        if self.proxy is not None:
+            try:
+                proxy_socket = socket.create_connection(self.proxy,timeout=1)
+                proxy_socket.settimeout(None)
+                self.address = self.proxy
+                return proxy_socket
+            except socket.error as e:
+                if self.address != self.broker_address or self.connect_tries == 1:
+                    self.logger.info("Broker proxy not available on {0} ({1}), connecting directly.".format(self.proxy,e))
+        self.address = self.broker_address
+        broker_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        broker_socket.connect(self.address)
+        return broker_socket
     def is_connected(self):
         return self.connected
 
@@ -228,10 +326,12 @@ class _SubscriptionHandler(threading.Thread):
         subscriptions -- Shared(?) dictionary of _Data_Item objects which are subscribed
         callbacks     -- Shared(?) dictionary of {<callback_name>:<callback function>}
         broker_name   -- Used for naming thread    
+        publisher     -- Optional function called with each updated _DataItem (see avp_collector)
     '''
     SLEEP_TIME = 0.1 # How long to sleep between notification checks
-    def __init__(self, rx_n, subscriptions, callbacks, broker_name,debug_mode=False):
+    def __init__(self, rx_n, subscriptions, callbacks, broker_name,debug_mode=False,publisher=None):
         self.debug_mode = debug_mode
+        self.publisher = publisher
         self.logger = logging.getLogger('{0}.{1}'.format(broker_name,self.__class__.__name__))
         if self.debug_mode is False:
             self.logger.setLevel(logging.INFO)
@@ -279,6 +379,11 @@ class _SubscriptionHandler(threading.Thread):
                                     self.subscriptions[key_name]._sample_time = get_date_time(self.subscriptions[key_name]._sample_time_long)
                                     if tz is not None:
                                         self.subscriptions[key_name]._tz = tz # This should never change once set
+                                    if self.publisher is not None:
+                                        try:
+                                            self.publisher(self.subscriptions[key_name])
+                                        except Exception as e:
+                                            self.logger.error("Error publishing {0}: {1}".format(key_name,e))
                                     if key_name in self.callbacks:
                                         # check this key_name for a callback, and if so call it
                                         # arguments will be the sample_time and the subscription value
@@ -343,11 +448,16 @@ class _BrokerClient(object):
                         SOCKET_TIMEOUT,     - Broker socket timeout
                         RESUME_TIMEOUT,     - Broker socket timeout when resuming (which typically takes longer than most actions)
                         subscriptions,      - Dictionary of subscribed values where each entry is a data_name:object pair
+                        subscription_specs, - Dictionary of data_name:subscription parameters used to re-subscribe on reconnect
                         new_subscriptions,
                         callbacks,          - Dictionary of callbacks in subscription name - callback:function pairs
                         data_points,        - Dictionary of attribute names and objects
                         initialized         - Have we communicated with the broker and set up data structures
                         token_acquired      - Do we think we have the token
+                        TOKEN_LEASE         - Seconds get_token trusts token_acquired without asking the broker, 0 to always ask
+                        bus                 - avp_shm.ShmTable of values published by avp_collector, or None
+                        recorder            - avp_record.Recorder for [broker] RECORD_FILE, or None
+                        CATALOGUE_DIR       - Where each broker's list_data catalogue is cached, '' to not cache
     '''
     MINIMUM_VALUE = 1e-300
     def __init__(self,config,broker_name,program_name=__name__,**kwargs):
@@ -371,12 +481,18 @@ class _BrokerClient(object):
         #self.load_config(reload_config=False,debug_mode=debug_mode)
         # perhaps self.config = self.config[self.BROKER_NAME] so each broker only sees its own part of the config.
         self.subscriptions = {}
+        self.subscription_specs = {} # data_name:subscribe params other than 'data', for re-subscribing after a reconnect
+        self.token_name = None # Name the token was last acquired with
+        self._token_time = 0 # When the broker last told us we had the token, see get_token()
         self.new_subscriptions = {} #new version, to be implemented {name:{'object':object,'subscribers':[list of subscribers]}}
         self.callbacks = {} 
         self.data_points = {} 
+        self._catalogue_fingerprint = None # Hash of the catalogue the data_points were built from
+        self._catalogue_lock = threading.Lock()
+        self.publisher = None # See set_publisher()
         self._rx_r = {} # rx replies
         self._rx_n = [] # rx notifications
-        self._json_id = int(random() * 10000)
+        self._json_ids = itertools.count(int(random() * 10000)) # See _next_json_id()
         self.connected = null # null is a function which accepts any arguments and returns False
         self.initialized = False 
         self.token_acquired = False
@@ -410,12 +526,13 @@ class _BrokerClient(object):
             if result['_structure_data'] > 0:
                 #This allows us to alias parameters with their functions.
                 self.logger.debug("Added {0} parameters to data structure.".format(result['_structure_data']))
-                self.param_aliases = self.config.get(self.BROKER_NAME,{}).get('aliases',{})
-                for key,value in list(self.param_aliases.items()):
-                    this_data_item = getattr(self,value)
-                    setattr(self,key,this_data_item)
-                    self.data_points[key] = getattr(self,key)
-                    if debug_mode: print("Aliasing {0} to {1}".format(key,value))
+                with self._catalogue_lock: # The catalogue refresh thread may be re-making _DataItems
+                    self.param_aliases = self.config.get(self.BROKER_NAME,{}).get('aliases',{})
+                    for key,value in list(self.param_aliases.items()):
+                        this_data_item = getattr(self,value)
+                        setattr(self,key,this_data_item)
+                        self.data_points[key] = getattr(self,key)
+                        if debug_mode: print("Aliasing {0} to {1}".format(key,value))
                 if len(self.param_aliases) > 0:
                     self.logger.debug("Added {0} parameter aliases.".format(len(self.param_aliases)))
             elif result['_structure_data'] == 0:
@@ -423,6 +540,12 @@ class _BrokerClient(object):
             else:
                 pass # Error condition
         return result
+    def _next_json_id(self):
+        '''
+        Returns an id for a JSON-RPC request. Requests are sent from several threads (such as the
+        catalogue refresh), and itertools.count can't give the same id to two of them.
+        '''
+        return next(self._json_ids)
     def load_config(self,reload_config=False,**kwargs):
         '''
         Set variables based on self.config. Allows changes to avp.ini to be read in.
@@ -433,11 +556,29 @@ class _BrokerClient(object):
         # First try to get broker specific value, then global
 
         self.SOCKET_TIMEOUT = int(self.config.get(self.BROKER_NAME, {}).get('SOCKET_TIMEOUT',self.config.get('broker',{}).get('SOCKET_TIMEOUT',5)))
+        self.RECONNECT_MIN = float(self.config.get('broker',{}).get('RECONNECT_MIN',0.5))
+        self.RECONNECT_MAX = float(self.config.get('broker',{}).get('RECONNECT_MAX',30))
+        self.TOKEN_LEASE = float(self.config.get('broker',{}).get('TOKEN_LEASE',0))
         self.RESUME_TIMEOUT = int(self.config.get('broker',{}).get('RESUME_TIMEOUT',self.config.get('RESUME_TIMEOUT',50)))
         self.STALE_TIME = int(self.config.get('broker',{}).get('STALE_TIME',self.config.get('STALE_TIME',10)))
         #self.RESUME_TIMEOUT = int(self.config.get('broker',{}).get('RESUME_TIMEOUT',50))
         #self.STALE_TIME = int(self.config.get('broker',{}).get('STALE_TIME',10))
         self.host = avp_util.check_hostname(host,broker_name=self.BROKER_NAME,debug_mode=debug_mode)
+        # If set, connections are made through avp_proxy.py when it is listening.
+        self.PROXY = None
+        if avp_util.t_or_f(self.config.get('broker',{}).get('USE_PROXY',False)):
+            self.PROXY = (self.config.get('proxy',{}).get('HOST','localhost'),
+                          self.PORT + int(self.config.get('proxy',{}).get('PORT_OFFSET',100)))
+        # Shared memory table written by avp_collector.py. If it isn't there we just talk to the broker.
+        self.SHM_BUS = self.config.get('broker',{}).get('SHM_BUS',None)
+        self.bus = avp_shm.attach(self.SHM_BUS,debug_mode=debug_mode)
+        # Copy all broker traffic to a file which avp_record.py can replay.
+        self.RECORD_FILE = self.config.get('broker',{}).get('RECORD_FILE',None)
+        self.recorder = avp_record.open_recorder(self.RECORD_FILE)
+        # Parameter catalogues are cached here so clients can start without waiting for list_data
+        self.CATALOGUE_DIR = self.config.get('broker',{}).get('CATALOGUE_DIR','')
+        # Periodically write RPC latencies to the database, see avp_stats.py
+        avp_stats.start_snapshots(self.config,debug_mode=debug_mode)
         if reload_config is True:
             self.logger.debug('Re-loaded {0} for {1} broker'.format(self.config.filename,self.BROKER_NAME))
         # Set up broker constants
@@ -474,14 +615,17 @@ class _BrokerClient(object):
         if not self.connected():
             try:
                 self.socket_handler = SocketHandler(self.host, self.PORT, self._rx_r, self._rx_n,
-                    self.SOCKET_TIMEOUT,broker_name=self.BROKER_NAME,debug_mode=debug_mode)
+                    self.SOCKET_TIMEOUT,broker_name=self.BROKER_NAME,debug_mode=debug_mode,
+                    recorder=self.recorder,reconnect_min=self.RECONNECT_MIN,reconnect_max=self.RECONNECT_MAX,
+                    proxy=self.PROXY)
+                self.socket_handler.on_reconnect = self._restore_session
                 self.connected = self.socket_handler.is_connected
             except Exception as e:
                 self.logger.error("Could not create SocketHandler: {0}".format(e))
             try:
                 self.sub_handler = _SubscriptionHandler(self._rx_n, self.subscriptions, 
                                                         self.callbacks,broker_name=self.BROKER_NAME,
-                                                        debug_mode=debug_mode)
+                                                        debug_mode=debug_mode,publisher=self.publisher)
             except Exception as e:
                 self.logger.error("Could not create _SubscriptionHandler: {0}".format(e))
             try:
@@ -496,6 +640,39 @@ class _BrokerClient(object):
             '''
         
         return self.connected()
+    def _restore_session(self):
+        '''
+        Called by SocketHandler when it has re-connected. The broker has forgotten this connection's
+        subscriptions and token, so they are all asked for again in one batch.
+        '''
+        start_time = time.time()
+        groups = {}
+        for data_name,spec in list(self.subscription_specs.items()):
+            if data_name in self.subscriptions:
+                groups.setdefault(spec,[]).append(data_name)
+        requests = []
+        for spec,data_names in list(groups.items()):
+            params = dict(spec)
+            params['data'] = data_names
+            requests.append(('subscribe',self._next_json_id(),params))
+        if self.token_acquired and self.token_name:
+            requests.append(('tokenAcquire',self._next_json_id(),{'name':self.token_name}))
+        if not requests:
+            return
+        replies = self.socket_handler.send_batch(requests)
+        errors = 0
+        for (method,json_id,params),reply in zip(requests,replies):
+            result = self._result_checker(reply)
+            if 'error' in result:
+                errors += 1
+                self.logger.warning("Could not restore {0} {1} after reconnecting: {2}".format(method,params,result))
+                if method == 'tokenAcquire':
+                    self.token_acquired = False
+            elif method == 'tokenAcquire':
+                self._token_time = time.time()
+        self.logger.info("Re-connected to {0} broker, restored {1} subscriptions{2} in {3:.0f}ms with {4} errors.".format(
+                         self.BROKER_NAME,sum(len(names) for names in list(groups.values())),
+                         ' and token' if self.token_acquired else '',(time.time() - start_time) * 1000,errors))
     def disconnect(self,**kwargs):
         '''
         Releases token and shuts down SocketHandler and _SubscriptionHandler
@@ -539,6 +716,10 @@ class _BrokerClient(object):
         ''' Queries the broker as to what parameters are available. For each 
         value a _DataItem object is added to the parent object with that 
         data_point's name.
+        If the broker's catalogue has been cached (see CATALOGUE_DIR), the _DataItems are made from
+        the cache straight away and the broker is asked in a background thread. Only parameters
+        which have changed since are then re-made. Either way we are only initialized if
+        broker_status() says the broker is connected to the instrument.
         Args:
         Keyword Arguments:
             restructure -- If True, assumes that the object needs to be re-initialized.
@@ -551,6 +732,28 @@ class _BrokerClient(object):
         Raises:
         '''
         debug_mode = kwargs.pop('debug_mode',False)
+        if restructure is False and self._catalogue_fingerprint is None:
+            cached = self._load_catalogue()
+            if cached is not None:
+                with self._catalogue_lock:
+                    added_parameters = self._apply_catalogue(cached['catalogue'],debug_mode=debug_mode)
+                    self._catalogue_fingerprint = cached['fingerprint']
+                # Only initialized once the broker has said it is connected to the instrument.
+                self.broker_status(timeout=None,debug_mode=debug_mode)
+                self.initialized = self.connected() is True and self.instr_connected is True
+                refresh = threading.Thread(target=self._refresh_catalogue,name='{0}.catalogue'.format(self.BROKER_NAME),
+                                           kwargs={'connect_tries':connect_tries,'connect_pause':connect_pause,'debug_mode':debug_mode})
+                refresh.daemon = True
+                refresh.start()
+                return added_parameters
+        return self._refresh_catalogue(connect_tries=connect_tries,connect_pause=connect_pause,debug_mode=debug_mode)
+    def _refresh_catalogue(self,connect_tries=8,connect_pause=2,**kwargs):
+        '''
+        Gets the catalogue from the broker with list_data() and updates the _DataItems and the cache if it
+        is different from the one they were made from.
+        Returns the number of parameters added or changed, or -1 if the broker could not be asked.
+        '''
+        debug_mode = kwargs.pop('debug_mode',False)
         # See if we are connected to the instrument. If not, we can't go much further.
         self.broker_status(timeout=None,debug_mode=debug_mode)
         if self.connected() is False: # This is our socket connection to the broker.
@@ -577,33 +780,97 @@ class _BrokerClient(object):
             return -1
         if debug_mode:
             print(("Structuring data: parameters for {0} are:\n\t{1}".format(self.BROKER_NAME,data_list)))
+        # Only units and type describe a parameter. message_time comes back with its current value.
+        catalogue = {}
+        for data_name,data_dict in list(data_list.items()):
+            if isinstance(data_dict,dict) and 'type' in data_dict:
+                catalogue[data_name] = {'units':data_dict.get('units'),'type':data_dict.get('type')}
+            elif data_name != 'message_time':
+                self.logger.info("Not adding {0} parameter {1} with no type ({2})".format(self.BROKER_NAME,data_name,data_dict))
+        fingerprint = hashlib.sha1(json.dumps(catalogue,sort_keys=True).encode('utf-8')).hexdigest()
+        with self._catalogue_lock:
+            if fingerprint == self._catalogue_fingerprint:
+                self.initialized = True
+                return 0
+            if self._catalogue_fingerprint is not None:
+                self.logger.info("{0} broker parameters have changed, updating them.".format(self.BROKER_NAME))
+            changed_parameters = self._apply_catalogue(catalogue,debug_mode=debug_mode)
+            self._catalogue_fingerprint = fingerprint
+        self.initialized = True
+        self._save_catalogue(catalogue,fingerprint)
+        return changed_parameters
+    def _apply_catalogue(self,catalogue,**kwargs):
+        '''
+        Makes a _DataItem for each parameter in catalogue ({data_name:{'units','type'}}) which is new or whose
+        units or type have changed, and removes those which are no longer there.
+        Subscriptions, callbacks and aliases of a re-made _DataItem are moved to the new one.
+        Returns the number of _DataItems made.
+        '''
         added_parameters = 0
-        try:
-            for data_name in data_list:
-                data_type = data_units = ''
-                try:
-                    data_dict = data_list.get(data_name)
-                    data_type = data_dict.get('type') #Can be ('RW', 'RO', 'WO', or 'NI' (Not Implemented))
-                    data_units = data_dict.get('units')
-                except Exception as e:
-                    self.logger.error("In _structure_data. Extracting {dn} from {dl} data_list {e}".format(
-                                       e=e,dl=data_list,dn=data_name))
-                if data_type in ('RO','RW','WO','NI'):
-                    thisDI = getattr(self,data_name,None) # Ignore attributes initialized to None
-                    if thisDI is not None:
-                        self.logger.debug("{0} already has data object {1}".format(self.BROKER_NAME,data_name))
-                    else:
-                        setattr(self,data_name,_DataItem(self.BROKER_NAME,data_name,data_type,
-                                data_units,self.logger,self.set,self._status,self.STALE_TIME))
-                        self.data_points[data_name] = getattr(self,data_name)
-                        added_parameters += 1
-                else:
-                    # Not an error, just an odd occurance.
-                    self.logger.info("Not adding {0} parameter {1} of unknown type {2}".format(self.BROKER_NAME,data_name,data_type)) 
-            self.initialized = True
-        except Exception as e:
-            self.logger.error("Error in _structure_data:{0}".format(e))
+        for data_name,data_dict in list(catalogue.items()):
+            data_type = data_dict.get('type') #Can be ('RW', 'RO', 'WO', or 'NI' (Not Implemented))
+            data_units = data_dict.get('units')
+            if data_type not in ('RO','RW','WO','NI'):
+                # Not an error, just an odd occurance.
+                self.logger.info("Not adding {0} parameter {1} of unknown type {2}".format(self.BROKER_NAME,data_name,data_type)) 
+                continue
+            old_item = self.data_points.get(data_name)
+            if old_item is None and getattr(self,data_name,None) is not None: # Ignore attributes initialized to None
+                self.logger.debug("{0} already has data object {1}".format(self.BROKER_NAME,data_name))
+                continue
+            if old_item is not None and (old_item.data_type,getattr(old_item,'_units',None)) == (data_type,data_units):
+                continue
+            new_item = _DataItem(self.BROKER_NAME,data_name,data_type,
+                                 data_units,self.logger,self.set,self._status,self.STALE_TIME,bus=self.bus)
+            if old_item is not None:
+                new_item._subscribed = old_item._subscribed
+                for names in (self.data_points,self.subscriptions):
+                    for name,item in list(names.items()):
+                        if item is old_item:
+                            names[name] = new_item
+                            setattr(self,name,new_item)
+            setattr(self,data_name,new_item)
+            self.data_points[data_name] = new_item
+            added_parameters += 1
+        for name,item in list(self.data_points.items()):
+            if item.data_name not in catalogue:
+                if name in self.subscriptions:
+                    self.logger.warning("{0} broker no longer has subscribed parameter {1}".format(self.BROKER_NAME,name))
+                    continue
+                self.data_points.pop(name)
+                if getattr(self,name,None) is item:
+                    delattr(self,name)
         return added_parameters
+    def _catalogue_file(self):
+        return os.path.join(self.CATALOGUE_DIR,'{0}.json'.format(self.BROKER_NAME))
+    def _load_catalogue(self):
+        '''
+        Returns the cached {'fingerprint','catalogue'} for this broker or None.
+        '''
+        if not self.CATALOGUE_DIR:
+            return None
+        try:
+            with open(self._catalogue_file()) as cache:
+                cached = json.load(cache)
+            if cached.get('broker') == self.BROKER_NAME and cached.get('catalogue'):
+                return cached
+        except (IOError,OSError,ValueError) as e:
+            self.logger.debug("No cached catalogue for {0} ({1})".format(self.BROKER_NAME,e))
+        return None
+    def _save_catalogue(self,catalogue,fingerprint):
+        if not self.CATALOGUE_DIR:
+            return
+        path = self._catalogue_file()
+        temp_path = '{0}.{1}'.format(path,os.getpid())
+        try:
+            if not os.path.isdir(self.CATALOGUE_DIR):
+                os.makedirs(self.CATALOGUE_DIR)
+            with open(temp_path,'w') as cache:
+                json.dump({'broker':self.BROKER_NAME,'fingerprint':fingerprint,
+                           'saved':datetime.now().isoformat(),'catalogue':catalogue},cache,sort_keys=True,indent=1)
+            os.rename(temp_path,path) # Other programs never see a partly written file
+        except (IOError,OSError) as e:
+            self.logger.info("Could not cache {0} catalogue in {1} ({2})".format(self.BROKER_NAME,path,e))
     def _result_checker(self,raw_result,**kwargs): 
         ''' Strips out un-needed information from a given dictionary.
         Args:
@@ -645,6 +912,8 @@ class _BrokerClient(object):
         if raw_result_error:
             if debug_mode: print("error result: {0}".format(raw_result_error))
             result = raw_result
+            if raw_result_error.__class__ == {}.__class__ and raw_result_error.get('code') == -31928:
+                self._token_lost('broker says the token is required')
         elif raw_result.get('result') in bad_results:
             if debug_mode: print("Result was some sort of JAVA error")
             result = {'error':{'message':raw_result.get('result'),'code':0}}
@@ -698,11 +967,11 @@ class _BrokerClient(object):
         status_params = {'data':data_items,'style':style}
         status_dict = {}
         status_result = {}
-        self._json_id += 1
+        json_id = self._next_json_id()
         if debug_mode:
             print(("send_rpc 'status' {0} {1}".format(status_params,str(datetime.now(pytz.reference.LocalTimezone())))))
         status_dict = self.socket_handler.send_rpc(method='status',
-                                                   json_id=self._json_id,
+                                                   json_id=json_id,
                                                    timeout=timeout,
                                                    params=status_params,
                                                    debug_mode=debug_mode)
@@ -866,9 +1135,9 @@ class _BrokerClient(object):
         if params is None:
             params = []
         debug_mode = kwargs.pop('debug_mode',False)
-        self._json_id += 1
+        json_id = self._next_json_id()
         list_data_result = self.socket_handler.send_rpc('list_data',
-                                                        self._json_id,
+                                                        json_id,
                                                         timeout=timeout,
                                                         params=params,
                                                         debug_mode=debug_mode)
@@ -888,26 +1157,28 @@ class _BrokerClient(object):
             self.logger.debug("Subscription list is empty")
             return 0
         params_list.append('message_time')
-        checked_data_item_names = []
-        for parameter in params_list:
-            if hasattr(self,parameter):
-                this_data_item = getattr(self,parameter)    # This is to take care of aliases
-                data_name = this_data_item.data_name        # data_name is what the broker recognizes
-                if (parameter or data_name) not in self.subscriptions:
-                    if self.sub_handler.running is False:
-                        try:
-                            self.sub_handler.start()
-                        except Exception as e:
-                            self.logger.error("Could not start _SubscriptionHandler: {0}".format(e))
-                    checked_data_item_names.append(data_name)
-                    self.subscriptions[parameter] = this_data_item # Might be an alias, or just doing the same thing twice
-                    self.subscriptions[data_name] = this_data_item
-                    setattr(this_data_item,'_subscribed',True)
-                    if debug_mode: print("Subscribing to {0}".format(data_name))
+        # The catalogue refresh thread may be re-making _DataItems
+        with self._catalogue_lock:
+            checked_data_item_names = []
+            for parameter in params_list:
+                if hasattr(self,parameter):
+                    this_data_item = getattr(self,parameter)    # This is to take care of aliases
+                    data_name = this_data_item.data_name        # data_name is what the broker recognizes
+                    if (parameter or data_name) not in self.subscriptions:
+                        if self.sub_handler.running is False:
+                            try:
+                                self.sub_handler.start()
+                            except Exception as e:
+                                self.logger.error("Could not start _SubscriptionHandler: {0}".format(e))
+                        checked_data_item_names.append(data_name)
+                        self.subscriptions[parameter] = this_data_item # Might be an alias, or just doing the same thing twice
+                        self.subscriptions[data_name] = this_data_item
+                        setattr(this_data_item,'_subscribed',True)
+                        if debug_mode: print("Subscribing to {0}".format(data_name))
+                    else:
+                        if debug_mode: self.logger.debug( "Already subscribed to {0}.{1}".format(self.BROKER_NAME,parameter) )
                 else:
-                    if debug_mode: self.logger.debug( "Already subscribed to {0}.{1}".format(self.BROKER_NAME,parameter) )
-            else:
-                if ignore_missing is False: self.logger.error( "Broker object {0} has no parameter '{1}'".format(self.BROKER_NAME,parameter) )
+                    if ignore_missing is False: self.logger.error( "Broker object {0} has no parameter '{1}'".format(self.BROKER_NAME,parameter) )
         try:
             checked_data_item_names.remove('message_time')
         except:
@@ -920,13 +1191,16 @@ class _BrokerClient(object):
         params = {'data':checked_data_item_names,'style':style,'updates':'on_new'}# Puts parameters in a dictionary
         if on_change:
             params['updates'] = 'on_change'
-        if min_interval > 0:
+        if min_interval and min_interval > 0:
             params['min_update_ms'] = min_interval
-        if max_interval > 0:
+        if max_interval and max_interval > 0:
             params['max_update_ms'] = max_interval
-        self._json_id += 1
+        spec = tuple(sorted((key,value) for key,value in list(params.items()) if key != 'data'))
+        for data_name in checked_data_item_names:
+            self.subscription_specs[data_name] = spec
+        json_id = self._next_json_id()
         subscribe_result = self.socket_handler.send_rpc('subscribe',
-                                                        self._json_id,
+                                                        json_id,
                                                         timeout=timeout,
                                                         params=params,
                                                         debug_mode=debug_mode)
@@ -977,9 +1251,9 @@ class _BrokerClient(object):
         except:
             pass
         if len(checked_params) >= 1: # We may not have anything to send to broker.
-            self._json_id += 1   
+            json_id = self._next_json_id()
             result['send_rpc'] = self.socket_handler.send_rpc('unsubscribe',
-                                                              self._json_id,
+                                                              json_id,
                                                               timeout=timeout,
                                                               params={'data':checked_params},
                                                               debug_mode=debug_mode)
@@ -1031,6 +1305,15 @@ class _BrokerClient(object):
         # Probably need some more checking to see if the
         self.callbacks.update(cb_dict)
         return 1
+    def set_publisher(self,publisher):
+        '''
+        Sets a function which will be called with every _DataItem updated by a subscription.
+        Used by avp_collector.py to copy values into the shared memory table.
+        '''
+        self.publisher = publisher
+        if hasattr(self,'sub_handler'):
+            self.sub_handler.publisher = publisher
+        return 1
     def remove_callback(self,callback_list):
         '''
         Removes keys from callback dictionary
@@ -1078,9 +1361,9 @@ class _BrokerClient(object):
                     bn=self.BROKER_NAME, c=command)))
             if write_store: checked_params['write_store'] = True
             try:
-                self._json_id += 1
+                json_id = self._next_json_id()
                 set_result = self.socket_handler.send_rpc('set',
-                                                          self._json_id,
+                                                          json_id,
                                                           timeout=timeout,
                                                           params=checked_params,
                                                           debug_mode=debug_mode)
@@ -1091,7 +1374,7 @@ class _BrokerClient(object):
                 result =  self._result_checker(set_result)
             except Exception as e:
                 message = "Error {e} in _BrokerObject.socket_handler send_rpc({c},{ji},{cp})) failed".format(
-                            ji=self._json_id,cp=checked_params,e=e,c=command)
+                            ji=json_id,cp=checked_params,e=e,c=command)
                 result = {'error':{'message':message,'code':0}}
         else:
             if debug_mode: print(("No valid parameters in {0}".format(list(params.items()))))
@@ -1103,9 +1386,9 @@ class _BrokerClient(object):
         valid_commands = ('on','off','check')
         if command in valid_commands:
             param = {'status':command}
-            self._json_id += 1
+            json_id = self._next_json_id()
             result =  self.socket_handler.send_rpc('power',
-                                                   self._json_id,
+                                                   json_id,
                                                    timeout=timeout,
                                                    params=param,
                                                    **kwargs)
@@ -1120,9 +1403,10 @@ class _BrokerClient(object):
         The name argument should be a string which indicates who is requesting the token.
         '''
         debug_mode = kwargs.pop('debug_mode',False)
-        self._json_id += 1
+        quiet = kwargs.pop('quiet',False) # Don't warn if someone else has it, get_token may take it anyway
+        json_id = self._next_json_id()
         result = self.socket_handler.send_rpc('tokenAcquire',
-                                              self._json_id,
+                                              json_id,
                                               timeout=timeout,
                                               params = {"name":name},
                                               debug_mode=debug_mode,
@@ -1131,13 +1415,16 @@ class _BrokerClient(object):
         acquire_result = self._result_checker(result,debug_mode=debug_mode,**kwargs)
         if acquire_result.get('result') == 'ok':
             self.token_acquired = True
+            self.token_name = name
+            self._token_time = time.time()
         else:
             if 'error' in acquire_result:
                 error_msg = acquire_result.get('error',{}).get('message','bad msg')
                 error_data = acquire_result.get('error',{}).get('data','')
                 error_code = acquire_result.get('error',{}).get('code',0)
                 if error_code == -31929: # Another listener currently has the control token.
-                    self.logger.warning("{0} {1}[{2}]".format(error_msg,error_data,error_code))
+                    if not quiet:
+                        self.logger.warning("{0} {1}[{2}]".format(error_msg,error_data,error_code))
                 else:
                     self.logger.error("{0} {1}[{2}]".format(error_msg,error_data,error_code))
                 self.token_acquired = False
@@ -1150,9 +1437,9 @@ class _BrokerClient(object):
         The name argument should be a string which indicates who is requesting the token.
         '''
         debug_mode = kwargs.pop('debug_mode',False)
-        self._json_id += 1
+        json_id = self._next_json_id()
         _token_force_acquire_result = self.socket_handler.send_rpc('tokenForceAcquire',
-                                                                   self._json_id,
+                                                                   json_id,
                                                                    timeout=timeout,
                                                                    params = {"name":name},
                                                                    debug_mode=debug_mode)
@@ -1160,16 +1447,34 @@ class _BrokerClient(object):
         force_acquire_result = self._result_checker(_token_force_acquire_result)
         if force_acquire_result.get('result','error') == 'ok':
             self.token_acquired = True
+            self.token_name = name
+            self._token_time = time.time()
         else:
             self.logger.error(force_acquire_result)
             self.token_acquired = False
         return force_acquire_result
+    def _token_lost(self,reason):
+        '''
+        Called when the broker shows we no longer have the token, e.g. another program forced it
+        away from us. The broker doesn't tell us when that happens, so the next get_token asks it.
+        '''
+        if self.token_acquired:
+            self.logger.info("{0} token lost: {1}".format(self.BROKER_NAME,reason))
+        self.token_acquired = False
+    def token_held(self,name=None):
+        '''
+        True if we acquired the token (as name, if given) within the last TOKEN_LEASE seconds and
+        nothing since has shown we lost it.
+        '''
+        if not self.token_acquired or (name is not None and name != self.token_name):
+            return False
+        return time.time() - self._token_time < self.TOKEN_LEASE
     def tokenRelease(self,timeout=None,**kwargs):
         '''Releases the control token'''
         debug_mode = kwargs.pop('debug_mode',False)
-        self._json_id += 1
+        json_id = self._next_json_id()
         tokenRelease_result = self.socket_handler.send_rpc('tokenRelease',
-                                                           self._json_id,
+                                                           json_id,
                                                            timeout=timeout,
                                                            params=None,
                                                            debug_mode=debug_mode)
@@ -1182,9 +1487,9 @@ class _BrokerClient(object):
         '''Returns the name of the current token holder
         '''
         debug_mode = kwargs.pop('debug_mode',False)
-        self._json_id += 1
+        json_id = self._next_json_id()
         tokenOwner_result = self.socket_handler.send_rpc('tokenOwner',
-                                                         self._json_id,
+                                                         json_id,
                                                          timeout=timeout,
                                                          params=None,
                                                          debug_mode=debug_mode)
@@ -1192,48 +1497,47 @@ class _BrokerClient(object):
         if debug_mode:
             print(("owner_result result: {0}".format(owner_result)))
             print(("tokenOwner result: {0}".format(tokenOwner_result)))
+        owner = owner_result.get('result')
+        if self.token_acquired and owner.__class__ == ''.__class__ and owner != self.token_name:
+            self._token_lost("now owned by '{0}'".format(owner))
         return owner_result #.get('result',{})
     def get_token(self,program_name=None,calling_obj=None,override=False,**kwargs):
         '''
         Facilitates taking the token from yourself
+        If we acquired the token with the same name within TOKEN_LEASE seconds, the broker isn't asked
+        again and result['cached'] is True. Otherwise tokenAcquire is tried first, which succeeds if the
+        token is free or this connection already has it. If someone else has it, the broker's error
+        names them, and if that is this program (or override is set) tokenForceAcquire takes it.
         '''
         if program_name is None: program_name = __name__ # Module
         if calling_obj is None: calling_obj = self.__class__.__name__ # Class
         debug_mode = kwargs.pop('debug_mode',False)
         result = {}
         token_name = "{0}.{1}".format(program_name,calling_obj)
-        result['tokenOwner 1'] = self.tokenOwner(debug_mode=debug_mode)
-        try:
-            token_owner = result['tokenOwner 1'].get('result',result['tokenOwner 1'])
-        except:
-            token_owner = result['tokenOwner 1']
-        if program_name in token_owner:
-            self.logger.debug( "Token is owned by self ({0}). Using _token_force_acquire".format(token_owner))
-            result['_token_force_acquire'] = self._token_force_acquire(token_name)
-            result['acquire_result'] = result['_token_force_acquire']
-        elif token_owner == '':
-            self.logger.debug( "Token is unowned. Using _token_acquire")
-            result['_token_acquire'] = self._token_acquire(token_name)
-            result['acquire_result'] = result['_token_acquire']
-        else:
-            if override:
+        if self.token_held(token_name):
+            self.logger.debug("{0} token already held as {1}".format(self.BROKER_NAME,token_name))
+            result['cached'] = True
+            result['acquire_result'] = {'result':'ok'}
+            return result
+        result['acquire_type'] = '_token_acquire'
+        result['_token_acquire'] = self._token_acquire(token_name,quiet=True)
+        result['acquire_result'] = result['_token_acquire']
+        error = result['acquire_result'].get('error',{})
+        if error.get('code') == -31929: # Another listener currently has the control token.
+            token_owner = error.get('data','')
+            if program_name in token_owner:
+                self.logger.debug( "Token is owned by self ({0}). Using _token_force_acquire".format(token_owner))
+            elif override:
                 self.logger.info( "Override flag set, using _token_force_acquire to take token from {0}".format(token_owner))
+            if program_name in token_owner or override:
                 result['acquire_type'] = '_token_force_acquire'
                 result['_token_force_acquire'] = self._token_force_acquire(token_name)
                 result['acquire_result'] = result['_token_force_acquire']
-            else:
-                result['acquire_type'] = '_token_acquire'
-                result['_token_acquire'] = self._token_acquire(token_name)
-                if debug_mode: print(("Acquiring token from {0} for {1}".format(token_owner,token_name)))
-                result['acquire_result'] = result['_token_acquire']
+            elif debug_mode:
+                print(("Could not acquire token from {0} for {1}".format(token_owner,token_name)))
         # result['acquire_result'] should be {'result':'ok'} but might be {'error':{error stuff}}
         if result['acquire_result'].get('result','error') == 'ok':
-            result['tokenOwner 2'] = self.tokenOwner(debug_mode=debug_mode)
-            try:
-                token_owner = result['tokenOwner 2'].get('result',result['tokenOwner 2'])
-            except:
-                token_owner = result['tokenOwner 2']
-            self.logger.debug( "{0} token now owned by {1}".format(self.BROKER_NAME,token_owner))
+            self.logger.debug( "{0} token now owned by {1}".format(self.BROKER_NAME,token_name))
         elif 'error' in result['acquire_result']:
             error_msg = result['acquire_result'].get('error',{}).get('message','bad msg')
             error_data = result['acquire_result'].get('error',{}).get('data','')
@@ -1248,18 +1552,18 @@ class _BrokerClient(object):
         return result
     def shutdown_broker(self,timeout=None,**kwargs):
         debug_mode = kwargs.pop('debug_mode',False)
-        self._json_id += 1
+        json_id = self._next_json_id()
         self.token_acquired = False
         return self.socket_handler.send_rpc('shutdown',
-                                            self._json_id,
+                                            json_id,
                                             timeout=timeout,
                                             params=None,
                                             debug_mode=debug_mode)
     def suspend_broker(self,timeout=None,**kwargs):
         debug_mode = kwargs.pop('debug_mode',False)
-        self._json_id += 1
+        json_id = self._next_json_id()
         return self.socket_handler.send_rpc('suspend',
-                                            self._json_id,
+                                            json_id,
                                             timeout=timeout,
                                             params=None,
                                             debug_mode=debug_mode)
@@ -1270,9 +1574,9 @@ class _BrokerClient(object):
         debug_mode = kwargs.pop('debug_mode',False)
         if timeout is None:
             timeout = self.RESUME_TIMEOUT # Sonde takes longer to startup
-        self._json_id += 1
+        json_id = self._next_json_id()
         resume_result =  self.socket_handler.send_rpc('resume',
-                                                      self._json_id,
+                                                      json_id,
                                                       timeout=timeout,
                                                       params=None,
                                                       debug_mode=debug_mode)
@@ -1283,9 +1587,9 @@ class _BrokerClient(object):
         return self._result_checker(resume_result)
     def broker_status(self,timeout=None,**kwargs):
         debug_mode = kwargs.pop('debug_mode',False)
-        self._json_id += 1
+        json_id = self._next_json_id()
         result =  self.socket_handler.send_rpc('broker_status',
-                                               self._json_id,
+                                               json_id,
                                                timeout=timeout,
                                                params=None,
                                                debug_mode=debug_mode)
@@ -1309,6 +1613,7 @@ class _DataItem(object):
         data_units  --  Units for parameter
         ...
         stale_time  --  If a subscribed value is older than this (seconds), call status() before returning _value
+        bus         --  Optional avp_shm.ShmTable. Fresh values found there are used instead of calling status()
     We are using property() to use getters and setters for class attributes
     RW Class Attributes (getters and setters):
     The availability of these attributes vary by data_type
@@ -1336,6 +1641,8 @@ class _DataItem(object):
         self.set = set_method
         self.get = get_method
         self._stale_td = timedelta(seconds=stale_time)
+        self._stale_time = stale_time
+        self.bus = kwargs.get('bus',None)
         self._subscribed = False # For some this will always be False
         self._value = None
         self._tz = None
@@ -1400,11 +1707,36 @@ class _DataItem(object):
         if hasattr(self,'_value') and self.data_type in self.READ_CLASSES:
             if (self._subscribed == False or (self._sample_time < datetime.now(pytz.reference.LocalTimezone()) - self._stale_td)):
                 # RYAN is _sample_time not updating with subscriprions?
-                status_return = self.get([self.data_name]) # Only ask for it if we aren't subscribed.
+                if self._bus_read() is False: # Try the shared memory table before bothering the broker
+                    status_return = self.get([self.data_name]) # Only ask for it if we aren't subscribed.
             return self._value
         else:
             self.logger.debug("Parameter {1}.{2} of type {0} has no value.".format(self.data_type,self.BROKER_NAME,self._data_name))
             return None
+    def _bus_read(self):
+        '''
+        Updates _value from the shared memory table if it has a fresh value.
+        Returns True if it did, False if we need to ask the broker.
+        '''
+        if self.bus is None:
+            return False
+        try:
+            entry = self.bus.read(self.BROKER_NAME,self._data_name)
+        except Exception as e:
+            self.logger.debug("Shared memory read of {0}.{1} failed: {2}".format(self.BROKER_NAME,self._data_name,e))
+            return False
+        if entry is None:
+            return False
+        (value,units,sample_time_long,age) = entry
+        if age > self._stale_time:
+            return False
+        self._value = value
+        if units:
+            self._units = units
+        if sample_time_long and sample_time_long != self._sample_time_long:
+            self._sample_time_long = sample_time_long
+            self._sample_time = get_date_time(sample_time_long)
+        return True
     def value_setter(self,set_value):
         if hasattr(self,'_value'):
             if self.data_type in self.WRITE_CLASSES:
@@ -1489,9 +1821,9 @@ class SondeBroker(_BrokerClient):
         if self.sampling.value != False: 
             self.logger.error("Can not wipe while in sampling mode ({0}).".format(self.sampling.value))
             return 0
-        self._json_id += 1
+        json_id = self._next_json_id()
         wipe_result =  self.socket_handler.send_rpc('wipe',
-                                                    self._json_id,
+                                                    json_id,
                                                     timeout=self.WIPE_TIMEOUT,
                                                     params=None,
                                                     **kwargs)
@@ -1502,9 +1834,9 @@ class SondeBroker(_BrokerClient):
         debug_mode = kwargs.pop('debug_mode',False)
         if not self._is_initialized(method_name='_cal_press'): return {}
         if debug_mode: print("Calibrating pressure")
-        self._json_id += 1
+        json_id = self._next_json_id()
         calibrate_pressure_result =  self.socket_handler.send_rpc('calibratePressure',
-                                                                  self._json_id,
+                                                                  json_id,
                                                                   timeout=timeout,
                                                                   params=None,
                                                                   debug_mode=debug_mode)
@@ -1570,9 +1902,9 @@ class SondeBroker(_BrokerClient):
         debug_mode = kwargs.pop('debug_mode',False)
         if not self._is_initialized(method_name='start_sampling'): return {}
         if debug_mode: print("Starting sampling")
-        self._json_id += 1
+        json_id = self._next_json_id()
         start_sampling_result =  self.socket_handler.send_rpc('start_sampling',
-                                                                self._json_id,
+                                                                json_id,
                                                                 timeout=self.SAMPLE_TIMEOUT,
                                                                 params=None,
                                                                 debug_mode=debug_mode)
@@ -1587,9 +1919,9 @@ class SondeBroker(_BrokerClient):
         if self.is_logging(timeout=timeout,debug_mode=debug_mode):
             self.stop_logging(timeout=timeout,debug_mode=debug_mode)
         if debug_mode: print("Stopping sampling")
-        self._json_id += 1
+        json_id = self._next_json_id()
         stop_sampling_result =  self.socket_handler.send_rpc('stop_sampling',
-                                                               self._json_id,
+                                                               json_id,
                                                                params=None,
                                                                timeout=timeout,
                                                                debug_mode=debug_mode)
@@ -1603,9 +1935,9 @@ class SondeBroker(_BrokerClient):
         if not self._is_initialized(method_name='start_logging'): return {}
         if self.sampling.value != True:
             self.start_sampling(debug_mode=debug_mode)
-        self._json_id += 1
+        json_id = self._next_json_id()
         start_logging_result =  self.socket_handler.send_rpc('start_logging',
-                                                             self._json_id,
+                                                             json_id,
                                                              timeout=timeout,
                                                              params = {"cast_number":cast_number},
                                                              debug_mode=debug_mode)
@@ -1617,9 +1949,9 @@ class SondeBroker(_BrokerClient):
         '''
         debug_mode = kwargs.pop('debug_mode',False)
         if not self._is_initialized(method_name='stop_logging'): return {}
-        self._json_id += 1
+        json_id = self._next_json_id()
         stop_logging_result =  self.socket_handler.send_rpc('stop_logging',
-                                                            self._json_id,
+                                                            json_id,
                                                             timeout=timeout,
                                                             params=None,
                                                             debug_mode=debug_mode)
@@ -1725,6 +2057,7 @@ class MM3Broker(_BrokerClient):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.load_config(reload_config=False,debug_mode=debug_mode)
         try: # IPC Database stuff
+            import avp_db
             self.ipc_db = avp_db.AvpDB(self.config,self.IPC_TABLE,polling=True)
         except Exception as e:
             self.logger.critical('Error in {0}.__init__ initializing IPC database {1}'.format(self.BROKER_NAME,e))
@@ -2028,9 +2361,9 @@ class MM3Broker(_BrokerClient):
         debug_mode = kwargs.pop('debug_mode',False) 
         if not self._is_initialized(method_name='reset'):
             return 0
-        self._json_id += 1
+        json_id = self._next_json_id()
         result =  self.socket_handler.send_rpc('reset',
-                                               self._json_id,
+                                               json_id,
                                                timeout=timeout,
                                                params=None,
                                                debug_mode=debug_mode)
@@ -2043,9 +2376,9 @@ class MM3Broker(_BrokerClient):
         '''
         debug_mode = kwargs.pop('debug_mode',False) 
         if not self._is_initialized(method_name='restore'): return 0
-        self._json_id += 1
+        json_id = self._next_json_id()
         result =  self.socket_handler.send_rpc('restore',
-                                               self._json_id,
+                                               json_id,
                                                timeout=timeout,
                                                params=None,
                                                debug_mode=debug_mode)
@@ -2071,11 +2404,69 @@ class MM3Broker(_BrokerClient):
         result = self.do_write_store(params={'position':position}, debug_mode=debug_mode)
         return result
 
+class DepthEstimator(object):
+    '''
+    Rolling median and median absolute deviation (MAD) of the last window sounder pings.
+    The window is also kept sorted, so adding a ping is a bisect rather than a sort, and the median is
+    just the middle of it. Pings which aren't a depth (NaN when the sounder loses the bottom) or aren't
+    between min_depth and max_depth are dropped, as the java SounderAdapter does for its working depth,
+    and ones more than outlier MADs from the median aren't counted as good.
+    Arguments:
+        window      -- Number of pings to keep
+        outlier     -- How many scaled MADs (about a standard deviation for normal data) from the median
+                       a ping can be and still be good.
+        min_depth,max_depth -- meters. Only pings deeper than min_depth and shallower than max_depth are kept.
+    Public Methods: add, estimate, clear
+    '''
+    MAD_SCALE = 1.4826 # MAD * MAD_SCALE estimates the standard deviation of normally distributed pings
+    def __init__(self,window=60,outlier=3.0,min_depth=0.0,max_depth=float('inf')):
+        self.window = int(window)
+        self.outlier = float(outlier)
+        self.min_depth = float(min_depth)
+        self.max_depth = float(max_depth)
+        self._pings = deque()
+        self._sorted = []
+        self._lock = threading.Lock()
+    def add(self,depth):
+        try:
+            depth = float(depth)
+        except (TypeError,ValueError):
+            return False
+        if not self.min_depth < depth < self.max_depth: # Also catches NaN
+            return False
+        with self._lock:
+            self._pings.append(depth)
+            bisect.insort(self._sorted,depth)
+            if len(self._pings) > self.window:
+                del self._sorted[bisect.bisect_left(self._sorted,self._pings.popleft())]
+        return True
+    def clear(self):
+        with self._lock:
+            self._pings.clear()
+            del self._sorted[:]
+    def estimate(self):
+        '''
+        Returns {'depth':median,'std':MAD_SCALE * MAD,'pings':number in the window,'good':number within
+        outlier * std of the median}, or None if there aren't any pings.
+        '''
+        with self._lock:
+            values = list(self._sorted)
+        n = len(values)
+        if n == 0:
+            return None
+        median = (values[(n - 1) // 2] + values[n // 2]) / 2.0
+        deviations = sorted(abs(value - median) for value in values)
+        std = self.MAD_SCALE * (deviations[(n - 1) // 2] + deviations[n // 2]) / 2.0
+        limit = self.outlier * std
+        good = bisect.bisect_right(values,median + limit) - bisect.bisect_left(values,median - limit)
+        return {'depth':median,'std':std,'pings':n,'good':good}
+
+
 class SounderBroker(_BrokerClient):
     '''
     Adds methods and attributes specific to the NMEA depth sounder
-    Public Methods: None
-    Instance Variables: broker_name
+    Public Methods: track_depth, depth_estimate
+    Instance Variables: broker_name, depth_estimator
     '''
     BROKER_NAME = 'sounder'
     def __init__(self,config,**kwargs):
@@ -2083,6 +2474,7 @@ class SounderBroker(_BrokerClient):
         debug_mode = kwargs.get('debug_mode',False)
         self.logger = logging.getLogger(self.__class__.__name__)
         self.load_config(reload_config=False,debug_mode=debug_mode)
+        self.depth_estimator = DepthEstimator(self.DEPTH_WINDOW,self.DEPTH_OUTLIER,self.DEPTH_MIN_M,self.DEPTH_MAX_M)
         super(SounderBroker, self).__init__(self.config,self.BROKER_NAME,**kwargs) # Run Superclass __init__
     def load_config(self,reload_config=False,**kwargs):
         '''
@@ -2093,9 +2485,37 @@ class SounderBroker(_BrokerClient):
         debug_mode = kwargs.pop('debug_mode',False)
         if reload_config is True:
             self.config.reload()
-        # Sounder doesn't have anything to load.
+        # These are default values which are overwritten by [[constants]] in config when load_config
+        # is called below
+        self.DEPTH_WINDOW    = 60   # Pings in the rolling depth estimate
+        self.DEPTH_OUTLIER   = 3.0  # Pings further than this many standard deviations from the median aren't good
+        self.DEPTH_MIN_PINGS = 10   # Good pings needed before depth_estimate returns anything
+        self.DEPTH_MAX_STD   = 0.5  # meters. Spread above which depth_estimate doesn't trust the pings
+        self.DEPTH_MIN_M     = 1.0  # meters. Pings outside these are dropped, the java broker's MinDepthM and MaxDepthM
+        self.DEPTH_MAX_M     = 10.0
+        self.DEPTH_SOURCE    = 'working' # Casts use water_depth_working, or the estimate if 'median'
         super(SounderBroker, self).load_config(reload_config=reload_config,debug_mode=debug_mode) # Run Superclass load_config
         return
+    def track_depth(self,clear=True,**kwargs):
+        '''
+        Subscribes to water_depth and feeds every ping to depth_estimator, after emptying it if clear is True.
+        unsubscribe_all removes the callback, so call this again after it, with clear=False to keep the pings so far.
+        '''
+        if clear is True:
+            self.depth_estimator.clear()
+        self.add_callback({'water_depth':self._depth_cb})
+        return self.add_subscriptions(['water_depth'],on_change=False,**kwargs)
+    def _depth_cb(self,sample_time,data_item):
+        self.depth_estimator.add(data_item.value)
+    def depth_estimate(self):
+        '''
+        Returns the depth_estimator's estimate ({'depth','std','pings','good'}) if it has at least
+        DEPTH_MIN_PINGS good pings with a spread of no more than DEPTH_MAX_STD, otherwise None.
+        '''
+        estimate = self.depth_estimator.estimate()
+        if estimate is None or estimate['good'] < self.DEPTH_MIN_PINGS or estimate['std'] > self.DEPTH_MAX_STD:
+            return None
+        return estimate
 
 class GpsBroker(_BrokerClient):
     '''
@@ -2177,10 +2597,10 @@ class IscoBroker(_BrokerClient):
         # take a sample into a specific bottle using a specific volume
         debug_mode = kwargs.pop('debug_mode',False)
         if not self._is_initialized(method_name='take_sample'): return {}
-        self._json_id += 1
+        json_id = self._next_json_id()
         params = {"bottle_num":bottle, "sample_volume":volume, "cast_number":cast_number, "sample_depth":sample_depth}
         result =  self.socket_handler.send_rpc('take_sample',
-                                               self._json_id,
+                                               json_id,
                                                timeout=timeout,
                                                params=params,
                                                debug_mode=debug_mode)
@@ -2189,9 +2609,9 @@ class IscoBroker(_BrokerClient):
         # If the sampler is turned off via the panel, this will turn it on.
         debug_mode = kwargs.pop('debug_mode',False)
         if not self._is_initialized(method_name='sampler_on'): return {}
-        self._json_id += 1
+        json_id = self._next_json_id()
         result =  self.socket_handler.send_rpc('sampler_on',
-                                               self._json_id,
+                                               json_id,
                                                timeout=timeout,
                                                params=None,
                                                debug_mode=debug_mode)
@@ -2249,14 +2669,14 @@ class LisstBroker(_BrokerClient):
         # Process file from lisst data recorder.  Empty lisst_file retrieves most recent.
         debug_mode = kwargs.pop('debug_mode',False)
         if not self._is_initialized(method_name='get_file'): return {}
-        self._json_id += 1
+        json_id = self._next_json_id()
         self.logger.debug('Downloading LISST file')
         if lisst_file is None:
             params = None
         else:
             params = {'lisst_file':lisst_file}
         result = self.socket_handler.send_rpc('get_file',
-                                              self._json_id,
+                                              json_id,
                                               timeout=self.FILE_TIMEOUT,
                                               params=params,
                                               debug_mode=debug_mode)
@@ -2264,9 +2684,9 @@ class LisstBroker(_BrokerClient):
     def delete_file(self,lisst_file,timeout=None,**kwargs):
         # delete file from lisst data recorder.  File name must be given.
         if not self._is_initialized(method_name='delete_file'): return {}
-        self._json_id += 1
+        json_id = self._next_json_id()
         result =  self.socket_handler.send_rpc('delete_file',
-                                               self._json_id,
+                                               json_id,
                                                timeout=timeout,
                                                params={'lisst_file':lisst_file},
                                                **kwargs)
@@ -2275,9 +2695,9 @@ class LisstBroker(_BrokerClient):
         # start LISST data collection.
         debug_mode = kwargs.pop('debug_mode',False)
         if not self._is_initialized(method_name='start_collection'): return {}
-        self._json_id += 1
+        json_id = self._next_json_id()
         result =  self.socket_handler.send_rpc('start_collection',
-                                               self._json_id,
+                                               json_id,
                                                timeout=timeout,
                                                params={"cast_number":cast_number,"pump_delay":pump_delay},
                                               debug_mode=debug_mode)
@@ -2286,9 +2706,9 @@ class LisstBroker(_BrokerClient):
         # stop data collection.
         debug_mode = kwargs.pop('debug_mode',False)
         if not self._is_initialized(method_name='stop_collection'): return {}
-        self._json_id += 1
+        json_id = self._next_json_id()
         result = self.socket_handler.send_rpc('stop_collection',
-                                              self._json_id,
+                                              json_id,
                                               timeout=timeout,
                                               params=None,
                                               debug_mode=debug_mode)
@@ -2425,11 +2845,107 @@ class AIOBroker(_BrokerClient):
         return
 
 
+class CircularStats(object):
+    '''
+    Mean direction, spread and speed of the directions (and speeds) added in the last window seconds.
+    Running sums of the sines and cosines are kept, so adding a value and dropping the expired ones
+    doesn't depend on how many there are, and the gust is the head of a deque kept in decreasing order.
+    Arguments:
+        window      -- Seconds of values to keep
+    Public Methods: add, stats, clear
+    '''
+    def __init__(self,window=600):
+        self.window = float(window)
+        self._values = deque() # (time,sin,cos,speed)
+        self._gusts = deque() # (time,speed) with decreasing speeds
+        self._lock = threading.Lock()
+        self.clear()
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self._gusts.clear()
+            self._sin = self._cos = self._speed = 0.0
+            self._speeds = 0
+    def _expire(self,now):
+        while self._values and now - self._values[0][0] > self.window:
+            then,sin,cos,speed = self._values.popleft()
+            self._sin -= sin
+            self._cos -= cos
+            if speed is not None:
+                self._speed -= speed
+                self._speeds -= 1
+        if not self._values: # Start again from exactly zero
+            self._sin = self._cos = self._speed = 0.0
+        while self._gusts and now - self._gusts[0][0] > self.window:
+            self._gusts.popleft()
+    def add(self,direction,speed=None,now=None):
+        '''
+        Adds a direction in degrees and optionally a speed, at now (time.time() by default).
+        '''
+        try:
+            radians = math.radians(float(direction))
+            speed = None if speed is None else float(speed)
+        except (TypeError,ValueError):
+            return False
+        if math.isnan(radians) or (speed is not None and math.isnan(speed)):
+            return False
+        if now is None:
+            now = time.time()
+        with self._lock:
+            sin,cos = math.sin(radians),math.cos(radians)
+            self._values.append((now,sin,cos,speed))
+            self._sin += sin
+            self._cos += cos
+            if speed is not None:
+                self._speed += speed
+                self._speeds += 1
+                while self._gusts and self._gusts[-1][1] <= speed:
+                    self._gusts.pop()
+                self._gusts.append((now,speed))
+            self._expire(now)
+        return True
+    def stats(self,now=None):
+        '''
+        Returns {'direction':mean direction in degrees,'deviation':angular deviation in degrees,
+        'resultant':mean resultant length (1 if all the same, near 0 if all over the place),
+        'samples':count,'speed':mean speed,'gust':highest speed}, or None if nothing is in the window.
+        The speeds are None if none were added.
+        '''
+        if now is None:
+            now = time.time()
+        with self._lock:
+            self._expire(now)
+            n = len(self._values)
+            if n == 0:
+                return None
+            resultant = min(math.hypot(self._sin,self._cos) / n,1.0)
+            return {'direction':normalize_angle(math.degrees(math.atan2(self._sin,self._cos))),
+                    'deviation':math.degrees(math.sqrt(2 * (1 - resultant))),
+                    'resultant':resultant,
+                    'samples':n,
+                    'speed':self._speed / self._speeds if self._speeds else None,
+                    'gust':self._gusts[0][1] if self._gusts else None}
+
+
+def normalize_angle(angle):
+    '''
+    Returns angle in degrees as 0 <= angle < 360. A tiny negative angle % 360 rounds to 360.0, so that is made 0.
+    '''
+    angle = angle % 360
+    return 0.0 if angle >= 360 else angle
+
+def angle_difference(a,b):
+    '''
+    Returns a - b in degrees, between -180 and 180.
+    '''
+    return (a - b + 180) % 360 - 180
+
+
 class WindBroker(_BrokerClient):
     '''
     Adds methods and attributes specific to the RM Young 32500 wind instrument
-    Public Methods: start_collection, stop_collection
-    Instance Variables: broker_name
+    Public Methods: start_collection, stop_collection, track_wind, heading
+    Instance Variables: broker_name, wind_stats, heading_stats
     '''
     BROKER_NAME = 'wind'
     MPS_TO_KNOTS = 1.94384
@@ -2439,6 +2955,8 @@ class WindBroker(_BrokerClient):
         debug_mode = kwargs.get('debug_mode', False)
         self.logger = logging.getLogger(self.__class__.__name__)
         self.load_config(reload_config=False, debug_mode=debug_mode)
+        self.wind_stats = CircularStats(self.WIND_WINDOW)
+        self.heading_stats = CircularStats(self.HEADING_WINDOW)
         super(WindBroker, self).__init__(self.config, self.BROKER_NAME, **kwargs)  # Run Superclass __init__
         # super().__init__(self.config, self.BROKER_NAME, **kwargs)  # Run Superclass __init__
 
@@ -2455,6 +2973,9 @@ class WindBroker(_BrokerClient):
         # is called below
         self.COMPASS_TARGET = 0
         self.COMPASS_MARGIN = 90
+        self.WIND_WINDOW = 600      # Seconds of wind_direction and wind_speed in wind_stats
+        self.HEADING_WINDOW = 300   # Seconds of compass_direction in heading_stats
+        self.HEADING_MIN_SAMPLES = 10
         super(WindBroker, self).load_config(reload_config=reload_config,
                                               debug_mode=debug_mode)  # Run Superclass load_config
         return
@@ -2462,9 +2983,9 @@ class WindBroker(_BrokerClient):
     def start_collection(self, timeout=None, **kwargs):
         # Just testing
         if not self._is_initialized(method_name='start_collection'): return {}
-        self._json_id += 1
+        json_id = self._next_json_id()
         start_collection_result = self.socket_handler.send_rpc('startCollection',
-                                                               self._json_id,
+                                                               json_id,
                                                                timeout=timeout,
                                                                params=None,
                                                                **kwargs)
@@ -2473,14 +2994,40 @@ class WindBroker(_BrokerClient):
     def stop_collection(self, timeout=None, **kwargs):
         # Just testing...
         if not self._is_initialized(method_name='stop_collection'): return {}
-        self._json_id += 1
+        json_id = self._next_json_id()
         stop_collection_result = self.socket_handler.send_rpc('stopCollection',
-                                                              self._json_id,
+                                                              json_id,
                                                               timeout=timeout,
                                                               params=None,
                                                               **kwargs)
         return self._result_checker(stop_collection_result)
 
+    def track_wind(self, **kwargs):
+        '''
+        Subscribes to wind_speed, wind_direction and compass_direction and adds every update to
+        wind_stats and heading_stats. unsubscribe_all removes the callbacks, so call this again after it.
+        '''
+        self.add_callback({'wind_direction': self._wind_cb, 'compass_direction': self._heading_cb})
+        return self.add_subscriptions(['wind_speed', 'wind_direction', 'compass_direction'], on_change=False, **kwargs)
+
+    def _wind_cb(self, sample_time, data_item):
+        self.wind_stats.add(data_item.value, self.wind_speed.value)
+
+    def _heading_cb(self, sample_time, data_item):
+        self.heading_stats.add(data_item.value)
+
+    def heading(self):
+        '''
+        Returns (heading, degrees from COMPASS_TARGET, angular deviation) using the mean of heading_stats
+        if it has HEADING_MIN_SAMPLES, otherwise the current compass_direction with a deviation of None.
+        '''
+        stats = self.heading_stats.stats()
+        if stats is not None and stats['samples'] >= self.HEADING_MIN_SAMPLES:
+            heading, deviation = stats['direction'], stats['deviation']
+        else:
+            heading, deviation = self.compass_direction.value, None
+        return heading, angle_difference(heading, self.COMPASS_TARGET), deviation
+
 
 
 class PowerBroker(_BrokerClient):
@@ -2536,6 +3083,7 @@ def get_date_time(long_time,**kwargs):
     
 def example():
     from configobj import ConfigObj
+    import avp_db
     config = ConfigObj('./{hostname}_avp.ini'.format(hostname=socket.gethostname())) #This file will have all the needed configuration data
     
     
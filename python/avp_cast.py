@@ -330,6 +330,8 @@ class Cast(object):
         self.mm3 = self.winch.mm3
         result['02 mm3.add_subscriptions'] = self.mm3.add_subscriptions(self.REQUIRED_MM3_SUBSCRIPTIONS,on_change=False) # Changed on_change from True to False (on_new)
         self.sounder = self.context.sounder
+        # Start collecting pings now, so there are enough for a depth estimate by check_depth
+        result['02.1 sounder.track_depth'] = self.sounder.track_depth(verbose=False)
         
         self.lisst = self.isco = self.gps = None
         if hasattr(self.context,'gps') is True:
@@ -344,49 +346,30 @@ class Cast(object):
     def get_tokens(self,**kwargs):
         '''
         DO NOT override the mm3 token!
+        The tokens are all requested at once, then checked in order.
         '''
         if self.abort_cast: return {}
         self.logger.debug('Cast.get_tokens')
         self._update_status('get_tokens')
         result = {}
-        result['01 sonde.get_token'] = self.sonde.get_token(calling_obj=self.__class__.__name__,
-                                                         program_name=self.program_name,
-                                                         override=True,debug_mode=self.debug_mode)
-        if self.debug_mode: print("    Sonde token acquire result:{0}".format(result['01 sonde.get_token']['acquire_result']))
-        if 'error' in result['01 sonde.get_token'].get('acquire_result',None):
-            self.abort_cast['type'] = 'soft'
-            self.abort_cast['reason'] = 'Aborting Cast {0}. Unable to acquire sonde token.'.format(self.cast_number)
-            self.logger.critical(self.abort_cast['reason'])
-            return result
-        result['02 mm3.get_token'] = self.mm3.get_token(calling_obj=self.__class__.__name__,
-                                                     program_name=self.program_name,
-                                                     override=False,debug_mode=self.debug_mode)
-        if self.debug_mode: print("    MM3 token acquire result:{0}".format(result['02 mm3.get_token']['acquire_result']))
-        if 'error' in result['02 mm3.get_token'].get('acquire_result',None):
-            self.abort_cast['type'] = 'soft'
-            self.abort_cast['reason'] = 'Aborting Cast {0}. Unable to acquire mm3 token.'.format(self.cast_number)
-            self.logger.critical(self.abort_cast['reason'])
-            return result['02 mm3.get_token']
+        # (result key,broker,override,name in abort message)
+        wanted = [('01 sonde.get_token','sonde',True,'sonde'),
+                  ('02 mm3.get_token','mm3',False,'mm3')]
         if self.lisst_cast is True:
-            result['03 lisst.get_token'] = self.lisst.get_token(calling_obj=self.__class__.__name__,
-                                                             program_name=self.program_name,
-                                                             override=True,debug_mode=self.debug_mode)
-            if self.debug_mode: print("    LISST token acquire result:{0}".format(result['03 lisst.get_token']['acquire_result']))
-            if 'error' in result['03 lisst.get_token'].get('acquire_result',None):
-                self.abort_cast['type'] = 'soft'
-                self.abort_cast['reason'] = 'Aborting Cast {0}. Unable to acquire LISST token.'.format(self.cast_number)
-                self.logger.critical(self.abort_cast['reason'])
-                return result['03 lisst.get_token']
+            wanted.append(('03 lisst.get_token','lisst',True,'LISST'))
         if self.isco_cast is True: # We need the ISCO token 
-            result['04 isco.get_token'] = self.isco.get_token(calling_obj=self.__class__.__name__,
-                                                           program_name=self.program_name,
-                                                           override=True,debug_mode=self.debug_mode)
-            if self.debug_mode: print("    ISCO token acquire result:{0}".format(result['04 isco.get_token']['acquire_result']))
-            if 'error' in result['04 isco.get_token'].get('acquire_result',None):
+            wanted.append(('04 isco.get_token','isco',True,'ISCO'))
+        acquired = self.context.get_tokens([(broker,override) for key,broker,override,name in wanted],
+                                           calling_obj=self.__class__.__name__,
+                                           program_name=self.program_name,debug_mode=self.debug_mode)
+        for key,broker,override,name in wanted:
+            result[key] = acquired[broker]
+            if self.debug_mode: print("    {0} token acquire result:{1}".format(name,result[key]['acquire_result']))
+            if 'error' in result[key].get('acquire_result',None):
                 self.abort_cast['type'] = 'soft'
-                self.abort_cast['reason'] = 'Aborting Cast {0}. Unable to acquire ISCO token.'.format(self.cast_number)
+                self.abort_cast['reason'] = 'Aborting Cast {0}. Unable to acquire {1} token.'.format(self.cast_number,name)
                 self.logger.critical(self.abort_cast['reason'])
-                return result['04 isco.get_token']
+                return result if broker == 'sonde' else result[key]
         return result
     def check_instrument_status(self,**kwargs):
         '''
@@ -422,6 +405,7 @@ class Cast(object):
                 self.abort_cast['reason'] = 'Aborting cast {0}. Sounder broker unable to connect to instrument'.format(self.cast_number)
                 self.logger.critical(self.abort_cast['reason'])
         result['08 sounder.add_subscriptions'] = self.sounder.add_subscriptions(self.REQUIRED_SOUNDER_SUBSCRIPTIONS,on_change=True,verbose=False)
+        result['08.1 sounder.track_depth'] = self.sounder.track_depth(clear=False,verbose=False) # In case the broker was resumed
         if self.lisst_cast is True:
             result['09 lisst.broker_status 1'] = self.lisst.broker_status(timeout=None,debug_mode=self.debug_mode)
             if self.lisst.power_on is False and self.lisst.instr_connected is True:
@@ -487,8 +471,16 @@ class Cast(object):
         self.logger.debug('Cast.check_depth')
         self._update_status('check_depth')
         result = {}
-        # calculate cast depth
-        result['01 max_depth'] = float(self.sounder.water_depth_working.value - self.sonde.INSTRUMENT_OFFSET - self.sonde.BOTTOM_OFFSET)
+        # calculate cast depth from the broker's working depth, or if the sounder's DEPTH_SOURCE is
+        # 'median' from the median of the recent pings if there are enough good ones
+        water_depth = self.sounder.water_depth_working.value
+        estimate = self.sounder.depth_estimate()
+        if estimate is not None:
+            self.logger.debug("Sounder median depth {depth:.2f}m (std {std:.2f}m, {good} of {pings} pings good), "
+                              "working depth {0}m.".format(water_depth,**estimate))
+            if self.sounder.DEPTH_SOURCE == 'median':
+                water_depth = estimate['depth']
+        result['01 max_depth'] = float(water_depth - self.sonde.INSTRUMENT_OFFSET - self.sonde.BOTTOM_OFFSET)
         #DEFAULT_DEPTH=5.5
         #result['01 max_depth'] = float(DEFAULT_DEPTH - self.sonde.INSTRUMENT_OFFSET - self.sonde.BOTTOM_OFFSET)																												
         if result['01 max_depth'] > self.winch.CABLE_LENGTH:
@@ -503,7 +495,7 @@ class Cast(object):
         elif self.depth_target == 0:
             self.depth_target = result['01 max_depth']
             #self.logger.info("Using DEFAULT DEPTH target of {0}m. ".format(self.depth_target,DEFAULT_DEPTH))
-            self.logger.info("Using calculated depth target of {0}m based upon depth of {1}m.".format(self.depth_target,self.sounder.water_depth_working.value))
+            self.logger.info("Using calculated depth target of {0}m based upon depth of {1}m.".format(self.depth_target,water_depth))
         else:
             self.logger.info("Depth target is {0}m.".format(self.depth_target))
         return result
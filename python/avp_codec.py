@@ -0,0 +1,94 @@
+#! /usr/bin/env python
+#-------------------------------------------------------------------------------
+# Name:        avp_codec
+# Purpose:     JSON encoding and newline framing for the broker socket path.
+#              Uses orjson or ujson when one is installed and falls back to the
+#              standard library json module. Set AVP_JSON_CODEC to orjson, ujson or
+#              json to force a particular one.
+#              All functions work on bytes so nothing is decoded to str on the way
+#              in or out of a socket.
+#              Examples:
+#                 sock.sendall(avp_codec.dumps({'method':'status','id':1}))
+#                 framer = avp_codec.FrameReader()
+#                 for frame in framer.read(sock):
+#                     msg = avp_codec.loads(frame)
+#
+# Author:      whipple
+#
+# Created:     10/19/2026
+#-------------------------------------------------------------------------------
+#Built in Modules
+import json
+import os
+
+RECV_SIZE = 65536
+
+
+def _json_dumps(obj):
+    return json.dumps(obj,separators=(',',':')).encode('utf-8')
+
+def _ujson_dumps(obj):
+    return ujson.dumps(obj,ensure_ascii=False).encode('utf-8')
+
+_preferred = os.environ.get('AVP_JSON_CODEC','')
+NAME = 'json'
+loads = json.loads # Takes bytes
+dumps = _json_dumps
+for _name in ('orjson','ujson'):
+    if _preferred and _preferred != _name:
+        continue
+    try:
+        if _name == 'orjson':
+            import orjson
+            loads = orjson.loads
+            dumps = orjson.dumps # Already returns bytes
+        else:
+            import ujson
+            loads = ujson.loads
+            dumps = _ujson_dumps
+        NAME = _name
+        break
+    except ImportError:
+        pass
+# Raised by loads() on bad input. orjson.JSONDecodeError and ujson.JSONDecodeError are both ValueErrors.
+DecodeError = ValueError
+
+
+class FrameReader(object):
+    '''
+    Splits a byte stream into newline terminated frames.
+    Keeps one bytearray and only copies out complete frames, so a frame split across
+    several recv() calls is never decoded, and several frames in one recv() are all returned.
+    Public Methods: read, feed, reset
+    '''
+    def __init__(self,recv_size=RECV_SIZE):
+        self.recv_size = recv_size
+        self._buffer = bytearray()
+    def read(self,sock):
+        '''
+        Does one recv() on sock and returns a list of complete frames (bytes, without the newline).
+        Returns None if the other end closed the connection.
+        '''
+        data = sock.recv(self.recv_size)
+        if not data:
+            return None
+        return self.feed(data)
+    def feed(self,data):
+        '''
+        Adds data to the buffer and returns a list of complete frames.
+        '''
+        buffer = self._buffer
+        buffer += data
+        frames = []
+        start = 0
+        end = buffer.find(b'\n',start)
+        while end >= 0:
+            if end > start:
+                frames.append(bytes(buffer[start:end]))
+            start = end + 1
+            end = buffer.find(b'\n',start)
+        if start:
+            del buffer[:start]
+        return frames
+    def reset(self):
+        del self._buffer[:]
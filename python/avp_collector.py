@@ -0,0 +1,135 @@
+#! /usr/bin/env python
+#-------------------------------------------------------------------------------
+# Name:        avp_collector
+# Purpose:     Subscribes once to every broker in the supervisor's brokerList and
+#              publishes the latest value of every parameter into the shared memory
+#              table (see avp_shm). Other programs (avp_cast, avp_console, supervisor,
+#              Local_Interface, avp_sched) then read un-subscribed values from the table
+#              instead of each making their own status requests of the java brokers.
+#
+#              Enable by setting SHM_BUS in the [broker] section of the config file.
+#              usage: avp_collector.py <ini-file>
+#
+# Author:      whipple
+#
+# Created:     10/19/2026
+#-------------------------------------------------------------------------------
+#Built in Modules
+import logging
+import os
+import signal
+import sys
+from time import sleep, time
+#Installed Modules
+from configobj import ConfigObj
+#Custom Modules
+import avp_broker
+import avp_db
+import avp_shm
+import avp_util
+
+
+class Collector(object):
+    '''
+    Copies subscribed broker values into the shared memory table.
+    Public Methods: main_loop, publish, shutdown
+    Instance Variables: broker_list, table
+    '''
+    def __init__(self,config,program_name=__name__,**kwargs):
+        self.debug_mode = kwargs.get('debug_mode',False)
+        self.config = config
+        self.program_name = program_name
+        self._running = True
+        signal.signal(signal.SIGTERM, self._stop_running)
+        signal.signal(signal.SIGHUP, self._stop_running)
+        signal.signal(signal.SIGQUIT, self._stop_running)
+        self.logger = logging.getLogger(self.__class__.__name__)
+        if self.debug_mode is False:
+            self.logger.setLevel(logging.INFO)
+        collector_config = config.get('collector',{})
+        self.SHM_BUS = config.get('broker',{}).get('SHM_BUS','/dev/shm/avp_bus')
+        self.N_SLOTS = int(collector_config.get('N_SLOTS',avp_shm.N_SLOTS))
+        self.CHECK_FREQ = float(collector_config.get('CHECK_FREQ',10)) # Seconds between broker checks
+        self.broker_list = list(config.get('supervisor',{}).get('brokerList',{}).values())
+        self.table = avp_shm.ShmTable(self.SHM_BUS,writer=True,n_slots=self.N_SLOTS,debug_mode=self.debug_mode)
+        self.logger.info("Publishing {0} to {1}".format(self.broker_list,self.SHM_BUS))
+        self.context = avp_util.AVPContext(config,startup=self.broker_list,program_name=self.program_name,
+                                           check_defaults=False,debug_mode=self.debug_mode)
+        self.subscribed = [] # Brokers we have subscribed to
+    def publish(self,data_item):
+        '''
+        Called from each broker's _SubscriptionHandler with an updated _DataItem.
+        '''
+        self.table.publish(data_item.BROKER_NAME,data_item.data_name,data_item.mem_value,
+                           data_item.units,data_item.sample_time_long)
+    def _subscribe_all(self,broker_name):
+        broker = getattr(self.context,broker_name)
+        if broker.initialized is False:
+            broker.re_structure_data(connect_tries=1)
+            if broker.initialized is False:
+                return
+        # Skip aliases, they are the same _DataItem under another name.
+        params = [name for name,data_item in list(broker.data_points.items())
+                  if name == data_item.data_name and data_item.data_type in avp_broker._DataItem.READ_CLASSES]
+        broker.set_publisher(self.publish)
+        # max_interval keeps values which don't change from going stale in the readers.
+        result = broker.add_subscriptions(params,subscriber=self.program_name,on_change=True,
+                                          max_interval=int(broker.STALE_TIME * 500),ignore_missing=True)
+        if isinstance(result,dict) and 'error' in result:
+            self.logger.warning("Could not subscribe to {0}: {1}".format(broker_name,result))
+            broker.unsubscribe_all()
+            return
+        self.subscribed.append(broker_name)
+        self.logger.info("Collecting {0} {1} parameters".format(len(params),broker_name))
+    def _check_brokers(self):
+        missing = [broker_name for broker_name in self.broker_list if broker_name not in self.context.brokers]
+        if missing:
+            self.context.startup(startup=missing,check_defaults=False,debug_mode=self.debug_mode)
+        for broker_name in list(self.subscribed):
+            broker = getattr(self.context,broker_name,None)
+            if broker is None or broker.connected() is False or len(broker.subscriptions) == 0:
+                self.logger.warning("Lost {0} subscriptions, will re-subscribe".format(broker_name))
+                self.subscribed.remove(broker_name)
+        for broker_name in self.context.brokers:
+            if broker_name not in self.subscribed:
+                self._subscribe_all(broker_name)
+    def main_loop(self):
+        next_check = 0
+        while self._running:
+            self.table.heartbeat()
+            if time() >= next_check:
+                self._check_brokers()
+                next_check = time() + self.CHECK_FREQ
+            sleep(1)
+        self.shutdown()
+    def _stop_running(self, signal_number, *args):
+        self._running = False
+        self.logger.warning('Caught signal number {0}, shutting down.'.format(signal_number))
+    def shutdown(self):
+        self.logger.info("Shutting down collector")
+        self.context.shutdown('all')
+        self.table.close()
+        sleep(1)
+        logging.shutdown()
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print('Usage: ', sys.argv[0], ' ini-file')
+        sys.exit(1)
+    if os.path.exists(sys.argv[1]) is False:
+        print(sys.argv[1], "does not exist")
+        sys.exit(1)
+    logger = logging.getLogger('')
+    logging.basicConfig(stream=sys.stdout, level=logging.DEBUG,
+                        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s")
+    config = ConfigObj(sys.argv[1])  # Read the config file
+    dbh = avp_db.DB_LogHandler(config)
+    dbh.setLevel(logging.INFO)
+    logger.addHandler(dbh)
+    collector = Collector(config,program_name='avp_collector',debug_mode=False)
+    try:
+        collector.main_loop()
+    except KeyboardInterrupt:
+        collector.shutdown()
@@ -18,6 +18,7 @@ import avp_broker
 import avp_cast
 import avp_db
 from avp_sched import AVPScheduleStatus
+import avp_stats
 import avp_util
 from avp_winch import Winch
 import gislib
@@ -154,6 +155,12 @@ class _BrokerConsole(_BaseConsole):
     def help_sock(self):
         print("Turns printing of lowest level socket messages on")
         print("Usage: sock [on]")
+    def help_rpcstats(self):
+        print("Prints how many calls this console has made to the {0} broker, and how long they took.".format(self.obj.BROKER_NAME))
+        print("    'notification' is the time between subscription updates.")
+    def do_rpcstats(self,args):
+        for line in avp_stats.report([self.obj.socket_handler.stats]):
+            print(line)
     def help_report(self):
         print("Like para, but requests all values and prints them IN THE FORMAT THEY ARE RECIEVED.")
         print("    To se the values as they are in memory, use 'mem all'.")
@@ -703,6 +710,8 @@ class MainConsole(_BaseConsole):
         self.intro += "|          {0:<68}|{cr}".format(line,cr=CR)
         line = "{cmd:<10}- Set parameter value.".format(cmd='set')
         self.intro += "|          {0:<68}|{cr}".format(line,cr=CR)
+        line = "{cmd:<10}- Broker call counts and latencies.".format(cmd='rpcstats')
+        self.intro += "|          {0:<68}|{cr}".format(line,cr=CR)
         line = "{cmd:<10}- Subscribe to automatic parameter updates.".format(cmd='sub')
         self.intro += "|          {0:<68}|{cr}".format(line,cr=CR)
         line = "{cmd:<10}- Un-subscribe from automatic parameter updates.".format(cmd='unsub')
@@ -728,6 +737,10 @@ class MainConsole(_BaseConsole):
     def do_sonde(self,args):
         self.start_sub_menu('sonde')
     def help_sonde(self): print("Enters the sonde sub-menu")
+    def do_rpcstats(self,args):
+        for line in avp_stats.report(avp_stats.all_brokers()):
+            print(line)
+    def help_rpcstats(self): print("Prints call counts and latencies for every broker this console has used.")
     def do_powermon(self,args):
         self.start_sub_menu('powermon')
     def help_powermon(self): print("Enters the power monitor sub-menu")
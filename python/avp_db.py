@@ -3,20 +3,78 @@
 #Built in Modules
 from collections import deque
 from datetime import datetime
+from decimal import Decimal
+import json
 import logging
+import os
+from select import select
 import socket 
 import sys
+import threading
+import time
 import traceback
 
 #Installed Modules
 import psycopg2 # connect
 from psycopg2.extensions import adapt, register_adapter, AsIs
 import psycopg2.extras
+import psycopg2.sql
+import pytz
 import pytz.reference
 
 #Custom Modules
 import avp_util
 
+
+NUMERIC_TYPES = (20,21,23,700,701,1700) # PostgreSQL type oids of int8, int2, int4, float4, float8 and numeric
+TIMESTAMP_TYPES = (1114,1184) # timestamp and timestamptz
+
+
+def description_dtype(description):
+    '''
+    Returns the rows_to_array dtype for the columns of a psycopg2 cursor.description. Unlike guessing
+    from the values, this is the same for every chunk of a query, even one where a column is all NULL.
+    '''
+    dtype = []
+    for column in description:
+        if column[1] in NUMERIC_TYPES:
+            dtype.append((column[0],'f8'))
+        elif column[1] in TIMESTAMP_TYPES:
+            dtype.append((column[0],'M8[us]'))
+        else:
+            dtype.append((column[0],'O'))
+    return dtype
+
+def rows_to_array(rows,names,dtype=None):
+    '''
+    Converts rows (sequences of values in the order of names) to a NumPy structured array.
+    Numeric columns become float64 with NULL as nan and timestamps become UTC datetime64[us] with
+    NULL as NaT. Any other column is kept as Python objects. Column types are taken from the values
+    unless dtype (see description_dtype) is given.
+    '''
+    import numpy # Only needed for arrays, so not a requirement of this module
+    if dtype is None:
+        dtype = []
+        for name,values in zip(names,zip(*rows)):
+            sample = next((value for value in values if value is not None),None)
+            if isinstance(sample,(int,float,Decimal)) and not isinstance(sample,bool):
+                dtype.append((name,'f8'))
+            elif isinstance(sample,datetime):
+                dtype.append((name,'M8[us]'))
+            else:
+                dtype.append((name,'O'))
+    array = numpy.empty(len(rows),dtype=dtype)
+    for i,(name,kind) in enumerate(dtype):
+        if kind == 'f8':
+            array[name] = [numpy.nan if row[i] is None else float(row[i]) for row in rows]
+        elif kind == 'M8[us]':
+            array[name] = [numpy.datetime64('NaT') if row[i] is None else
+                           numpy.datetime64(row[i].astimezone(pytz.utc).replace(tzinfo=None) if row[i].tzinfo else row[i],'us')
+                           for row in rows]
+        else:
+            array[name] = [row[i] for row in rows]
+    return array
+
 class DB_LogHandler(logging.Handler):
     '''
     A handler class which sends log strings to the database
@@ -63,13 +121,210 @@ class DB_LogHandler(logging.Handler):
         #self.log_db.close()
         logging.Handler.close(self)
 
+def parse_notify(notify):
+    '''
+    Returns a notification as a dictionary of its channel and pid, plus the items of its payload if
+    that is a JSON object such as dbscripts/avp_ipc_notify sends. A payload time is made a datetime.
+    '''
+    result = {'channel':notify.channel,'pid':notify.pid}
+    if notify.payload[:1] == '{':
+        try:
+            result.update(json.loads(notify.payload))
+            if result.get('time'):
+                # Always UTC to the microsecond, e.g. 2026-10-19T14:07:21.123456+00:00. Parsed with
+                # strptime because the scheduler and supervisor still run on python 2.
+                result['time'] = datetime.strptime(result['time'][:26],'%Y-%m-%dT%H:%M:%S.%f').replace(tzinfo=pytz.utc)
+        except Exception as e:
+            # Something we don't understand shouldn't stop the notification getting through
+            logging.getLogger('AvpDB').warning("Bad {0} notification payload {1} ({2})".format(notify.channel,notify.payload,e))
+    elif notify.payload:
+        result['payload'] = notify.payload
+    return result
+
+
+class Listener(object):
+    '''
+    One consumer of the notifications on a channel, see listen().
+    Notifications (psycopg2.extensions.Notify, with channel, payload and pid) are queued until
+    get() or wait() takes them, and are also passed to callback, if given, in the dispatcher's thread.
+    After the dispatcher has had to re-connect, a Notify with pid 0 and an empty payload is
+    delivered because real notifications may have been missed.
+    Public Methods: get, wait, close
+    Instance Variables: channel, event
+    '''
+    MAX_QUEUED = 1000 # Older notifications are dropped if nobody takes them
+    def __init__(self,dispatcher,channel,callback=None):
+        self.dispatcher = dispatcher
+        self.channel = channel
+        self.callback = callback
+        self.event = threading.Event() # Set while notifications are queued
+        self._queue = deque(maxlen=self.MAX_QUEUED)
+        self._lock = threading.Lock()
+    def _deliver(self,notify):
+        with self._lock:
+            self._queue.append(notify)
+            self.event.set()
+        if self.callback is not None:
+            try:
+                self.callback(notify)
+            except Exception as e:
+                logging.getLogger('Listener').error("Error in {0} notification callback: {1}".format(self.channel,e))
+    def get(self):
+        '''
+        Returns the list of notifications since the last get() or wait(), oldest first, without blocking.
+        '''
+        with self._lock:
+            notifies = list(self._queue)
+            self._queue.clear()
+            self.event.clear()
+        return notifies
+    def wait(self,timeout=None):
+        '''
+        Blocks until there is a notification or timeout seconds have passed, then returns get().
+        '''
+        self.event.wait(timeout)
+        return self.get()
+    def close(self):
+        self.dispatcher.remove(self)
+
+
+class _NotifyDispatcher(threading.Thread):
+    '''
+    Holds a process's one LISTEN connection to a database and passes each notification to the
+    Listeners for its channel. The thread sleeps in select() on the connection's socket, and on a
+    pipe which wakes it when a channel is added or removed.
+    Public Methods: add, remove
+    '''
+    RECONNECT_TIME = 5 # Seconds between attempts to re-connect
+    def __init__(self,connect_args):
+        super(_NotifyDispatcher,self).__init__()
+        self.daemon = True
+        self.name = self.__class__.__name__
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.connect_args = connect_args
+        self.conn = None
+        self.listeners = {} # channel:[Listener,...]
+        self.listening = set() # Channels LISTENed to on the current connection
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock) # Notified when self.listening catches up
+        self._wake_r,self._wake_w = os.pipe()
+    def add(self,channel,callback=None,timeout=5):
+        '''
+        Returns a Listener for channel. Waits up to timeout seconds for the LISTEN, so that
+        notifications sent after this returns aren't missed.
+        '''
+        listener = Listener(self,channel,callback)
+        with self._lock:
+            self.listeners.setdefault(channel,[]).append(listener)
+            os.write(self._wake_w,b'x')
+            end_time = time.time() + timeout
+            while channel not in self.listening and time.time() < end_time:
+                self._changed.wait(end_time - time.time())
+        if channel not in self.listening:
+            self.logger.warning("Not yet listening to {0}, will keep trying".format(channel))
+        return listener
+    def remove(self,listener):
+        with self._lock:
+            listeners = self.listeners.get(listener.channel,[])
+            if listener in listeners:
+                listeners.remove(listener)
+            if not listeners:
+                self.listeners.pop(listener.channel,None)
+            os.write(self._wake_w,b'x')
+    def _connect(self):
+        try:
+            self.conn = psycopg2.connect(**self.connect_args)
+            self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        except psycopg2.Error as e:
+            self.logger.warning("Unable to connect to database for notifications: {0}".format(e))
+            self.conn = None
+        self.listening = set()
+    def _update_channels(self):
+        '''
+        LISTENs to new channels and UNLISTENs to ones nobody wants any more.
+        '''
+        with self._lock:
+            wanted = set(self.listeners)
+        cursor = self.conn.cursor()
+        for channel in wanted - self.listening:
+            cursor.execute(psycopg2.sql.SQL("LISTEN {0};").format(psycopg2.sql.Identifier(channel)))
+        for channel in self.listening - wanted:
+            cursor.execute(psycopg2.sql.SQL("UNLISTEN {0};").format(psycopg2.sql.Identifier(channel)))
+        with self._lock:
+            self.listening = wanted
+            self._changed.notify_all()
+    def _dispatch(self,notify):
+        with self._lock:
+            listeners = list(self.listeners.get(notify.channel,[]))
+        for listener in listeners:
+            listener._deliver(notify)
+    def run(self):
+        reconnected = False
+        while True:
+            if self.conn is None or self.conn.closed:
+                self._connect()
+                if self.conn is None:
+                    time.sleep(self.RECONNECT_TIME)
+                    continue
+            try:
+                self._update_channels()
+                if reconnected:
+                    # Anything sent while we weren't connected is lost, so tell everyone to look again
+                    reconnected = False
+                    for channel in self.listening:
+                        self._dispatch(psycopg2.extensions.Notify(0,channel,''))
+                readable = select([self.conn,self._wake_r],[],[])[0]
+                if self._wake_r in readable:
+                    os.read(self._wake_r,1024)
+                self.conn.poll()
+                while self.conn.notifies:
+                    self._dispatch(self.conn.notifies.pop(0))
+            except Exception as e:
+                # Anything else, such as a LISTEN the server refuses, would otherwise end the thread
+                # and silently stop notifications for every polled table in the process.
+                if isinstance(e,(psycopg2.OperationalError,psycopg2.InterfaceError)):
+                    self.logger.warning('Notification connection error {0}, re-connecting.'.format(e))
+                else:
+                    self.logger.error('Error handling notifications {0}, re-connecting.'.format(e))
+                try:
+                    self.conn.close()
+                except Exception:
+                    pass
+                self.conn = None
+                reconnected = True
+                time.sleep(self.RECONNECT_TIME)
+
+
+_dispatchers = {}
+_dispatchers_lock = threading.Lock()
+
+
+def listen(db,channel,callback=None):
+    '''
+    Returns a Listener for NOTIFYs on channel in the database db (an AvpDB) is connected to.
+    All the Listeners for a database share one connection and thread, whatever table they are for.
+    channel is folded to lower case, as the unquoted table names in the NOTIFY rules are.
+    '''
+    channel = channel.lower()
+    connect_args = {'host':db.db_host,'port':db.PORT,'user':db.DB_USER,'password':db.DB_PASS,'database':db.DB_NAME}
+    key = tuple(sorted(connect_args.items()))
+    with _dispatchers_lock:
+        dispatcher = _dispatchers.get(key)
+        if dispatcher is None:
+            dispatcher = _dispatchers[key] = _NotifyDispatcher(connect_args)
+            dispatcher.start()
+    return dispatcher.add(channel,callback)
+
+
 class AvpDB(object):
     '''
     Database object for log database
     '''
     def __init__(self, config, table,polling=False,**kwargs):
         '''
-        If polling is set to True, connection will be setup for polling and connections will not be closed after commits.
+        If polling is set to True, connection will not be closed after commits, and NOTIFYs on the
+        table's channel can be had from poll() or wait(). They arrive through the process's shared
+        LISTEN connection (see listen()), so poll() doesn't query the database.
         '''
         debug_mode = kwargs.get('debug_mode',False)
         self.logger = logging.getLogger(self.__class__.__name__)
@@ -84,6 +339,7 @@ class AvpDB(object):
             #self.DB_NAME = config['db']['DB_NAME']
             self.DB_USER = config['db']['DB_USER']
             self.DB_PASS = config['db']['DB_PASS']
+            self.ITERSIZE = int(config.get('db',{}).get('ITERSIZE',2000)) # Rows fetched at a time by iter_select
         except KeyError as e:
             self.logger.critical('Error in AvpDB.__init__() finding configuration key '+str(e))
             sys.exit(1)
@@ -93,12 +349,15 @@ class AvpDB(object):
         self.db_host = avp_util.check_hostname(hostname=db_host,**kwargs) # See if this is localhost
         self.enabled = avp_util.t_or_f(enabled)
         self.connected = False
+        self.listener = None # Set for polled tables, see _listener()
         self.ins_que = deque([])
         self.log_items = {}  # This will hold the fields and values to be inserted or updated.
         self.columns = self._get_column_names(**kwargs)
         #self.logger.debug("Table {0} has columns {1}".format(self.table,self.columns))
         if self.polling:
+            self._cursor_type = {'DC':kwargs.get('DC',False),'RDC':kwargs.get('RDC',False)} # For re-connecting
             self._connect(**kwargs)
+            self._listener()
     def _get_column_names(self,**kwargs):
         '''
         Conects to table and gets column name. Returns None if table has no records.
@@ -162,12 +421,14 @@ class AvpDB(object):
                 if debug_mode: print("Connected to",self.DB_NAME)
                 if self.polling:
                     self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-                    self.cursor.execute("LISTEN {0};".format(self.table))
             else:
                 print("Problem with conn,cursor:",self.conn,self.cursor)
             return self.conn,self.cursor
     def close(self,**kwargs):
         debug_mode = kwargs.get('debug_mode',False)  
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
         if self.enabled:
             if self.connected:
                 try:
@@ -269,8 +530,13 @@ class AvpDB(object):
         return result
     def select(self,columns,where_condition=None,where_join='AND',where_oper='=',fetch_type='all',**kwargs):
         '''
+        fetch_type is 'all' (a list of rows), 'one' (the first row) or 'iter', which returns the
+        iter_select() generator so rows are only read from the database as they are used.
         '''
         debug_mode = kwargs.get('debug_mode',False) 
+        if 'iter' in fetch_type:
+            return self.iter_select(columns,where_condition=where_condition,where_join=where_join,
+                                    where_oper=where_oper,**kwargs)
         if where_condition is None:
             where_condition = {}
         result = []
@@ -353,11 +619,105 @@ class AvpDB(object):
             result = {'error':{'message':'database not enabled.','code':0}}
         if debug_mode: print("result['avp_db.AvpDB.update'] = {0}".format(result))
         return result
-    def _gen_string(self,exec_type,set_values,where_condition=None,where_join='AND',where_oper='=',returning=False,**kwargs):
+    def iter_select(self,columns,where_condition=None,where_join='AND',where_oper='=',itersize=None,arrays=False,order_by=None,**kwargs):
+        '''
+        Generator version of select() for reading more rows than will fit in memory, e.g. years of a
+        sonde table. Rows come from a named (server side) cursor, itersize at a time (defaults to
+        [db] ITERSIZE), on a connection of its own which is closed when the generator finishes or
+        is closed. Database errors are logged and raised, so a partial result isn't mistaken for all of it.
+        Keyword Arguments:
+            itersize    -- Rows fetched from the server at a time
+            arrays      -- If True, yield NumPy structured arrays of up to itersize rows (see rows_to_array) instead of rows
+            order_by    -- ORDER BY clause, e.g. 'sample_time'
+            DC,RDC      -- Yield DictCursor or RealDictCursor rows, as for _connect()
+        Example:
+            sonde_db = AvpDB(config,'avp1_sonde')
+            for chunk in sonde_db.iter_select(('sample_time','depth_m'),order_by='sample_time',arrays=True):
+                print(chunk['depth_m'].max())
+        '''
+        debug_mode = kwargs.get('debug_mode',False)
+        if where_condition is None:
+            where_condition = {}
+        if not self.enabled:
+            print("Database not enabled")
+            return
+        if itersize is None:
+            itersize = self.ITERSIZE
+        select_command = self._gen_string('SELECT',
+                                          tuple(columns),
+                                          where_condition=where_condition,
+                                          where_join=where_join,
+                                          where_oper=where_oper,
+                                          order_by=order_by,
+                                          **kwargs)
+        if kwargs.get('DC',False) and not arrays:
+            cursor_factory = psycopg2.extras.DictCursor
+        elif kwargs.get('RDC',False) and not arrays:
+            cursor_factory = psycopg2.extras.RealDictCursor
+        else:
+            cursor_factory = None
+        conn = None
+        try:
+            conn = psycopg2.connect(host=self.db_host,
+                                    port=self.PORT,
+                                    user=self.DB_USER,
+                                    password=self.DB_PASS,
+                                    database=self.DB_NAME)
+            # Named cursors only exist inside a transaction, which is why this isn't the polling connection
+            cursor = conn.cursor(name='{0}_iter'.format(self.table),cursor_factory=cursor_factory)
+            cursor.itersize = itersize
+            if debug_mode: print("Executing: {0},{1}".format(select_command,where_condition))
+            cursor.execute(select_command,where_condition)
+            if arrays:
+                dtype = None # From the first chunk's cursor.description, which a named cursor only has after a fetch
+                while True:
+                    rows = cursor.fetchmany(itersize)
+                    if not rows:
+                        break
+                    if dtype is None:
+                        dtype = description_dtype(cursor.description)
+                    yield rows_to_array(rows,[name for name,kind in dtype],dtype)
+            else:
+                for row in cursor:
+                    yield row
+        except psycopg2.Error as e:
+            self.logger.error("Error in AvpDB.iter_select from {0}: {1}".format(self.table,e))
+            raise
+        finally:
+            if conn is not None:
+                conn.close()
+    def execute(self,command,values=None,**kwargs):
+        '''
+        Runs any SQL command and commits it, for maintenance scripts such as db_trim.py which need
+        more than insert, select, update and delete. Returns the rows the command returned (an
+        empty list if it returns none) or None if it failed.
+        '''
+        debug_mode = kwargs.get('debug_mode',False)
+        result = None
+        if self.enabled:
+            try:
+                if not self.connected:
+                    self._connect(**kwargs)
+                if debug_mode: print("Executing: {0},{1}".format(command,values))
+                self.cursor.execute(command,values)
+                result = self.cursor.fetchall() if self.cursor.description else []
+                self._commit(**kwargs)
+            except Exception as e:
+                self.logger.error("Error in AvpDB.execute on {0}: {1} ({2})".format(self.table,e,command))
+                if self.conn is not None and not self.conn.closed:
+                    self.conn.rollback()
+            finally:
+                if not self.polling:
+                    self.close(**kwargs)
+        else:
+            print("Database not enabled")
+        return result
+    def _gen_string(self,exec_type,set_values,where_condition=None,where_join='AND',where_oper='=',returning=False,order_by=None,**kwargs):
         '''
         exec_type = <'UPDATE'>|                 -- Type of command to build
         set_values = {field_N:value_N,...} or (field_N,...) dict or tuple. Not list.
         where_condition = {field_N:value_N,...} -- Optional WHERE condition
+        order_by = 'field_N [DESC],...'         -- Optional ORDER BY for SELECT
         usage:
         self.cursor.execute(<return string from this function>,<set_values|where_condition for SELECT>)
         '''
@@ -422,6 +782,8 @@ class AvpDB(object):
                     set_values.update(where_condition) # Now that we've mangled where_condition, we can join them without fear of a conflict
                 except:
                     pass #This will fail for SELECT, but that is ok.
+            if order_by and exec_type == 'SELECT':
+                exec_command += ' ORDER BY {0}'.format(order_by)
             if returning:
                 exec_command += ' RETURNING {0}'.format(returning)
             exec_command += ";"
@@ -429,23 +791,53 @@ class AvpDB(object):
             print("Error: {0} not in {1}".format(exec_type,valid_types))
             exec_command = None
         return exec_command
-    def poll(self,**kwargs):
+    def poll(self,match=None,**kwargs):
+        '''
+        Returns the latest notification on the table since the last poll() or wait(), or () if
+        there hasn't been one. Doesn't block. Notifications are dictionaries, see parse_notify().
+        If match is given, e.g. {'broker':'mm3','param':'stop_reason'}, notifications whose payload
+        doesn't have those values are skipped. Ones with no payload always match since they could
+        be about anything (such as the one sent after the listening connection has re-connected).
+        '''
         debug_mode = kwargs.get('debug_mode',False)
         result = ()
         if self.polling:
-            try:
-                self.conn.poll()
-                while self.conn.notifies: 
-                    result = self.conn.notifies.pop()
-                    if debug_mode: print("Got NOTIFY:", result)
-            except psycopg2.OperationalError as e:
-                # If this happens we should close and re-open the table.
-                self.logger.warning('Polling error {0} closing  and re-connecting polled database connection.'.format(e))
-                self.close()
-                self._connect()
+            for notify in self._listener().get():
+                notify = parse_notify(notify)
+                if match and any(key in notify and notify[key] != value for key,value in list(match.items())):
+                    continue
+                result = notify
+            if result and debug_mode: print("Got NOTIFY:", result)
+            self._check_connection()
         else:
             self.logger.warning("Table {0} was not initialized as polled table".format(self.table))
         return result
+    def wait(self,timeout=None,match=None,**kwargs):
+        '''
+        Like poll() but blocks for up to timeout seconds until there is a notification.
+        '''
+        self.notified(timeout)
+        return self.poll(match=match,**kwargs)
+    def notified(self,timeout=None):
+        '''
+        Blocks for up to timeout seconds until there is a notification, but leaves it for poll().
+        Returns True if there is one.
+        '''
+        if not self.polling:
+            return False
+        return self._listener().event.wait(timeout)
+    def _listener(self):
+        # close() stops listening, so start again if the table is polled after that
+        if self.listener is None:
+            self.listener = listen(self,self.table)
+        return self.listener
+    def _check_connection(self):
+        # The polled connection stays open, so if the server has dropped it get a new one.
+        if self.connected and self.conn.closed:
+            self.logger.warning('Polled database connection to {0} closed, re-connecting.'.format(self.table))
+            # Only this connection, notifications come through the listener's own one
+            self.connected = False
+            self._connect(**self._cursor_type)
 
 class CastDB(AvpDB):
     '''
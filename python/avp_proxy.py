@@ -0,0 +1,615 @@
+#! /usr/bin/env python
+#-------------------------------------------------------------------------------
+# Name:        avp_proxy
+# Purpose:     Local multiplexing proxy for the java brokers.
+#              Holds one connection to each broker in the supervisor's brokerList and
+#              accepts any number of _BrokerClient connections on PORT + PORT_OFFSET.
+#              Identical subscriptions from several programs become one subscription
+#              on the broker, notifications are fanned out to every subscriber, JSON-RPC
+#              ids are re-written so replies get back to the right program, and 'status'
+#              requests for freshly subscribed values are answered from the proxy's cache.
+#              This keeps avp_console, avp_cast and supervisor from polling the serial
+#              instruments behind the brokers for the same values.
+#
+#              The broker only knows about one client (the proxy), so the proxy keeps
+#              track of which program holds the control token and refuses token
+#              restricted requests from the others.
+#
+#              Enable by setting USE_PROXY = True in the [broker] section of the config file.
+#              usage: avp_proxy.py <ini-file>
+#
+# Author:      whipple
+#
+# Created:     10/19/2026
+#-------------------------------------------------------------------------------
+#Built in Modules
+import errno
+import json
+import logging
+import os
+import selectors
+import signal
+import socket
+import sys
+from time import time
+#Installed Modules
+from configobj import ConfigObj
+#Custom Modules
+import avp_codec
+import avp_db
+import avp_util
+
+# Broker error codes (see javp BrokerError.java)
+E_SUB_NOT_FOUND = -31939
+E_TOKEN_NOT_AVAILABLE = -31929
+E_TOKEN_REQUIRED = -31928
+# Requests which never need the token, so any client may make them while another holds it.
+OPEN_METHODS = ('status','subscribe','unsubscribe','list_data','broker_status',
+                'tokenOwner','tokenAcquire','tokenForceAcquire')
+RECV_SIZE = 65536
+
+
+def _error(message,code=0):
+    return {'message':message,'code':code}
+
+
+class _Connection(object):
+    '''
+    Non-blocking socket with JSON stream decoding and an output buffer.
+    The python clients do not terminate their requests, so the input is decoded as a stream
+    of JSON objects rather than split on newlines.
+    '''
+    def __init__(self,sock,name):
+        self.sock = sock
+        self.name = name
+        self.sock.setblocking(False)
+        self._rx = ''
+        self._tx = b''
+        self._decoder = json.JSONDecoder()
+        self.write_failed = False # Set on any socket error, the main loop then drops the connection.
+    def fileno(self):
+        return self.sock.fileno()
+    def read(self):
+        '''
+        Returns a list of decoded messages, or None if the other end has closed the connection.
+        '''
+        try:
+            data = self.sock.recv(RECV_SIZE)
+        except (IOError,OSError) as e:
+            if e.errno in (errno.EAGAIN,errno.EWOULDBLOCK,errno.EINTR):
+                return []
+            return None
+        if not data:
+            return None
+        self._rx += data.decode('utf-8','replace')
+        messages = []
+        while True:
+            self._rx = self._rx.lstrip()
+            if not self._rx:
+                break
+            try:
+                msg,end = self._decoder.raw_decode(self._rx)
+            except ValueError:
+                break # Incomplete, wait for the rest
+            self._rx = self._rx[end:]
+            messages.append(msg)
+        return messages
+    def write(self,msg):
+        '''
+        Queues msg to be sent. Messages are newline terminated like the broker's.
+        '''
+        self._tx += avp_codec.dumps(msg) + b'\n'
+        self.flush()
+    def flush(self):
+        '''
+        Sends as much of the output buffer as the socket will take.
+        '''
+        try:
+            while self._tx:
+                sent = self.sock.send(self._tx)
+                self._tx = self._tx[sent:]
+        except (IOError,OSError) as e:
+            if e.errno not in (errno.EAGAIN,errno.EWOULDBLOCK,errno.EINTR):
+                self.write_failed = True
+    def pending(self):
+        return len(self._tx) > 0
+    def close(self):
+        try:
+            self.sock.close()
+        except (IOError,OSError):
+            pass
+
+
+class _Client(_Connection):
+    '''
+    A downstream program (typically a _BrokerClient).
+    Instance Variables: upstream, subs, last_sent
+    '''
+    def __init__(self,sock,name,upstream):
+        super(_Client,self).__init__(sock,name)
+        self.upstream = upstream
+        self.subs = {}      # param:spec this client asked for
+        self.last_sent = {} # param:(value,time) last forwarded to this client
+
+
+class _Upstream(object):
+    '''
+    One connection to a java broker and everything the proxy knows about it.
+    Arguments:
+        broker_name -- Name of the broker's config section
+        address     -- (host,PORT) of the broker
+    Instance Variables: broker_name, address, conn, clients, subs, cache, token_owner
+    '''
+    def __init__(self,broker_name,address,logger):
+        self.broker_name = broker_name
+        self.address = address
+        self.logger = logger
+        self.conn = None
+        self.next_connect = 0
+        self.clients = []
+        self.subs = {}          # param:{'spec':spec,'max_ms':max_update_ms,'clients':[_Client,...]}
+        self.cache = {}         # param:(param_dict,received time)
+        self.message_time = None
+        self.pending = {}       # upstream id:(client,client id,method,param list)
+        self._json_id = 0
+        self.token_owner = None # _Client which holds the token, None if no local client has it.
+        self.token_name = ''
+    def connected(self):
+        return self.conn is not None
+    def next_id(self):
+        self._json_id += 1
+        return self._json_id
+    def send(self,method,params=None,client=None,client_id=None,params_list=None):
+        '''
+        Sends a request to the broker. The reply will be routed back to client with client_id.
+        '''
+        json_id = self.next_id()
+        msg = {'method':method,'id':json_id}
+        if params is not None:
+            msg['params'] = params
+        self.pending[json_id] = (client,client_id,method,params_list)
+        self.conn.write(msg)
+        return json_id
+
+
+class BrokerProxy(object):
+    '''
+    Multiplexes many local broker clients onto one connection per broker.
+    Public Methods: main_loop, shutdown
+    Instance Variables: upstreams, HOST, PORT_OFFSET, CACHE_GRACE, RECONNECT_TIME
+    '''
+    def __init__(self,config,program_name=__name__,**kwargs):
+        self.debug_mode = kwargs.get('debug_mode',False)
+        self.config = config
+        self.program_name = program_name
+        self._running = True
+        signal.signal(signal.SIGTERM, self._stop_running)
+        signal.signal(signal.SIGHUP, self._stop_running)
+        signal.signal(signal.SIGQUIT, self._stop_running)
+        self.logger = logging.getLogger(self.__class__.__name__)
+        if self.debug_mode is False:
+            self.logger.setLevel(logging.INFO)
+        proxy_config = config.get('proxy',{})
+        self.HOST = proxy_config.get('HOST','localhost')
+        self.PORT_OFFSET = int(proxy_config.get('PORT_OFFSET',100))
+        self.CACHE_GRACE = float(proxy_config.get('CACHE_GRACE',1))         # Seconds a cached value may be late
+        self.RECONNECT_TIME = float(proxy_config.get('RECONNECT_TIME',5))   # Seconds between broker re-connect attempts
+        self.selector = selectors.DefaultSelector()
+        self.upstreams = {}
+        for broker_name in list(config.get('supervisor',{}).get('brokerList',{}).values()):
+            broker_config = config.get(broker_name,{})
+            host = avp_util.check_hostname(broker_config.get('host',socket.gethostname()),debug_mode=self.debug_mode)
+            port = int(broker_config.get('PORT',0))
+            if port == 0:
+                self.logger.error("No PORT for {0} broker, not proxying it".format(broker_name))
+                continue
+            upstream = _Upstream(broker_name,(host,port),self.logger)
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((self.HOST,port + self.PORT_OFFSET))
+            listener.listen(16)
+            listener.setblocking(False)
+            self.selector.register(listener,selectors.EVENT_READ,('listen',upstream))
+            self.upstreams[broker_name] = upstream
+            self.logger.info("Proxying {0} {1} on port {2}".format(broker_name,upstream.address,port + self.PORT_OFFSET))
+    #---------------------------------------------------------------------- Connections
+    def _connect(self,upstream):
+        upstream.next_connect = time() + self.RECONNECT_TIME
+        try:
+            sock = socket.create_connection(upstream.address,timeout=2)
+        except (IOError,OSError) as e:
+            self.logger.debug("Could not connect to {0} broker ({1})".format(upstream.broker_name,e))
+            return False
+        upstream.conn = _Connection(sock,upstream.broker_name)
+        self.selector.register(upstream.conn,selectors.EVENT_READ,('upstream',upstream))
+        self.logger.info("Connected to {0} broker at {1}".format(upstream.broker_name,upstream.address))
+        # Put back anything the clients had before we lost the broker.
+        if upstream.subs:
+            self._subscribe_upstream(upstream,list(upstream.subs.keys()))
+        if upstream.token_owner is not None:
+            upstream.send('tokenAcquire',params={'name':upstream.token_name})
+        return True
+    def _drop_upstream(self,upstream):
+        self.logger.warning("Lost connection to {0} broker".format(upstream.broker_name))
+        self._unregister(upstream.conn)
+        upstream.conn.close()
+        upstream.conn = None
+        upstream.cache.clear()
+        for sub in list(upstream.subs.values()):
+            sub['spec'] = None # The broker drops our subscriptions with the connection.
+            sub['max_ms'] = None
+        upstream.next_connect = time() + self.RECONNECT_TIME
+        for json_id,(client,client_id,method,params_list) in list(upstream.pending.items()):
+            if isinstance(client,dict):
+                # A subscribe join (see _subscribe_upstream), which may be waiting on several requests
+                join = client
+                client,client_id = join['client'],join['client_id']
+                if join['remaining'] <= 0 or client not in upstream.clients:
+                    continue
+                join['remaining'] = 0 # Only one reply, however many of its requests were pending
+            if client is not None:
+                self._reply(client,client_id,error=_error('Proxy lost connection to {0} broker'.format(upstream.broker_name)))
+        upstream.pending.clear()
+    def _accept(self,listener,upstream):
+        try:
+            sock,address = listener.accept()
+        except (IOError,OSError):
+            return
+        client = _Client(sock,'{0}:{1}'.format(*address),upstream)
+        upstream.clients.append(client)
+        self.selector.register(client,selectors.EVENT_READ,('client',client))
+        self.logger.debug("{0} client {1} connected".format(upstream.broker_name,client.name))
+    def _drop_client(self,client):
+        upstream = client.upstream
+        self.logger.debug("{0} client {1} disconnected".format(upstream.broker_name,client.name))
+        self._unregister(client)
+        client.close()
+        if client in upstream.clients:
+            upstream.clients.remove(client)
+        self._remove_subs(client,list(client.subs.keys()))
+        if upstream.token_owner is client:
+            upstream.token_owner = None
+            upstream.token_name = ''
+            if upstream.connected():
+                upstream.send('tokenRelease')
+        for json_id,(pending_client,client_id,method,params_list) in list(upstream.pending.items()):
+            if pending_client is client:
+                upstream.pending[json_id] = (None,client_id,method,params_list)
+    def _unregister(self,conn):
+        try:
+            self.selector.unregister(conn)
+        except (KeyError,ValueError):
+            pass
+    def _reply(self,client,client_id,result=None,error=None):
+        msg = {'id':client_id}
+        if error is not None:
+            msg['error'] = error
+        else:
+            msg['result'] = result
+        client.write(msg)
+    #---------------------------------------------------------------------- Client requests
+    def _client_request(self,client,msg):
+        upstream = client.upstream
+        method = msg.get('method')
+        client_id = msg.get('id')
+        params = msg.get('params')
+        if method == 'subscribe':
+            return self._client_subscribe(client,client_id,params or {})
+        if method == 'unsubscribe':
+            return self._client_unsubscribe(client,client_id,params or {})
+        if method == 'status' and self._status_from_cache(client,client_id,params or {}):
+            return
+        if not upstream.connected():
+            return self._reply(client,client_id,error=_error('Proxy is not connected to {0} broker'.format(upstream.broker_name)))
+        if method == 'tokenAcquire' and upstream.token_owner not in (None,client):
+            # Like the broker, the error's data is who has the token so get_token can decide whether to force it
+            return self._reply(client,client_id,error=dict(_error('Another listener currently has the control token.',
+                                                                   E_TOKEN_NOT_AVAILABLE),data=upstream.token_name))
+        if method == 'tokenRelease' and upstream.token_owner is not client:
+            return self._reply(client,client_id,error=_error('Token required',E_TOKEN_REQUIRED))
+        if method not in OPEN_METHODS and upstream.token_owner not in (None,client):
+            # The broker thinks the proxy has the token, so we have to enforce it here.
+            return self._reply(client,client_id,error=_error('Token required',E_TOKEN_REQUIRED))
+        upstream.send(method,params=params,client=client,client_id=client_id,
+                      params_list=(params or {}).get('name') if method.startswith('token') else None)
+    def _status_from_cache(self,client,client_id,params):
+        '''
+        Answers a status request from the cache if every value asked for is subscribed and fresh.
+        '''
+        upstream = client.upstream
+        data = [param for param in params.get('data',[]) if param != 'message_time']
+        if not data or upstream.message_time is None:
+            return False
+        now = time()
+        result = {}
+        for param in data:
+            sub = upstream.subs.get(param)
+            cached = upstream.cache.get(param)
+            if sub is None or cached is None or sub.get('max_ms') is None:
+                return False
+            param_dict,received = cached
+            if now - received > sub['max_ms'] / 1000.0 + self.CACHE_GRACE:
+                return False
+            result[param] = dict(param_dict)
+        result['message_time'] = dict(upstream.message_time)
+        self._reply(client,client_id,result=result)
+        return True
+    #---------------------------------------------------------------------- Subscriptions
+    def _spec(self,params):
+        return {'style':params.get('style','verbose'),
+                'updates':params.get('updates','on_new'),
+                'min_update_ms':params.get('min_update_ms'),
+                'max_update_ms':params.get('max_update_ms')}
+    def _merged_spec(self,clients,param):
+        '''
+        The least demanding upstream subscription which satisfies every client.
+        '''
+        specs = [client.subs[param] for client in clients]
+        mins = [spec['min_update_ms'] for spec in specs if spec['min_update_ms']]
+        maxes = [spec['max_update_ms'] for spec in specs if spec['max_update_ms']]
+        merged = {'style':'verbose' if 'verbose' in [spec['style'] for spec in specs] else 'terse',
+                  'updates':'on_new' if 'on_new' in [spec['updates'] for spec in specs] else 'on_change'}
+        if mins:
+            merged['min_update_ms'] = min(mins)
+        if maxes:
+            merged['max_update_ms'] = min(maxes)
+        if 'min_update_ms' in merged and 'max_update_ms' in merged and merged['min_update_ms'] > merged['max_update_ms']:
+            merged['min_update_ms'] = merged['max_update_ms']
+        return merged
+    def _client_subscribe(self,client,client_id,params):
+        upstream = client.upstream
+        spec = self._spec(params)
+        data = [param for param in params.get('data',[]) if param != 'message_time']
+        changed = []
+        for param in data:
+            client.subs[param] = spec
+            client.last_sent.pop(param,None)
+            sub = upstream.subs.setdefault(param,{'spec':None,'max_ms':None,'clients':[]})
+            if client not in sub['clients']:
+                sub['clients'].append(client)
+            if self._merged_spec(sub['clients'],param) != sub['spec']:
+                changed.append(param)
+        if changed and upstream.connected():
+            join = self._subscribe_upstream(upstream,changed,client,client_id)
+            for param in data:
+                if param not in changed:
+                    join['result'][param] = {'status':'ok'}
+        else:
+            # Everything is already subscribed on the broker, reply for it.
+            result = dict((param,{'status':'ok'}) for param in data)
+            max_ms = [upstream.subs[param]['max_ms'] for param in data if upstream.subs[param]['max_ms']]
+            if max_ms:
+                result['max_update_ms'] = min(max_ms)
+            result['min_update_ms'] = spec['min_update_ms'] or 0
+            self._reply(client,client_id,result=result)
+    def _subscribe_upstream(self,upstream,params_list,client=None,client_id=None):
+        '''
+        (Re)subscribes params_list on the broker, one request per distinct merged spec.
+        A subscribe for a parameter we already have would start a second subscription thread
+        in the broker, so those are unsubscribed first.
+        '''
+        already = [param for param in params_list if upstream.subs[param]['spec'] is not None]
+        if already:
+            upstream.send('unsubscribe',params={'data':already})
+        groups = []
+        for param in params_list:
+            sub = upstream.subs[param]
+            sub['spec'] = self._merged_spec(sub['clients'],param)
+            sub['max_ms'] = None
+            for spec,group in groups:
+                if spec == sub['spec']:
+                    group.append(param)
+                    break
+            else:
+                groups.append((sub['spec'],[param]))
+        join = {'client':client,'client_id':client_id,'remaining':len(groups),'result':{}}
+        for spec,group in groups:
+            request = dict(spec)
+            request['data'] = group
+            upstream.send('subscribe',params=request,client=join,params_list=group)
+        return join
+    def _client_unsubscribe(self,client,client_id,params):
+        result = {}
+        data = [param for param in params.get('data',[]) if param != 'message_time']
+        for param in data:
+            if param in client.subs:
+                result[param] = {'status':'ok'}
+            else:
+                result[param] = _error('Subscription not found.',E_SUB_NOT_FOUND)
+        self._remove_subs(client,data)
+        self._reply(client,client_id,result=result)
+    def _remove_subs(self,client,params_list):
+        upstream = client.upstream
+        unsubscribe = []
+        for param in params_list:
+            client.subs.pop(param,None)
+            client.last_sent.pop(param,None)
+            sub = upstream.subs.get(param)
+            if sub is None or client not in sub['clients']:
+                continue
+            sub['clients'].remove(client)
+            if not sub['clients']:
+                # Last subscriber gone. If others remain we keep the (possibly faster) broker subscription.
+                upstream.subs.pop(param)
+                upstream.cache.pop(param,None)
+                if sub['spec'] is not None:
+                    unsubscribe.append(param)
+        if unsubscribe and upstream.connected():
+            upstream.send('unsubscribe',params={'data':unsubscribe})
+    #---------------------------------------------------------------------- Broker messages
+    def _upstream_message(self,upstream,msg):
+        if 'id' not in msg:
+            if msg.get('method') == 'subscription':
+                self._notification(upstream,msg.get('params',{}))
+            return
+        pending = upstream.pending.pop(msg.get('id'),None)
+        if pending is None:
+            self.logger.debug("Unexpected reply from {0}: {1}".format(upstream.broker_name,msg))
+            return
+        client,client_id,method,params_list = pending
+        if method == 'subscribe':
+            return self._subscribe_reply(upstream,client,msg,params_list)
+        if 'error' not in msg:
+            if method in ('tokenAcquire','tokenForceAcquire') and isinstance(client,_Client):
+                upstream.token_owner = client
+                upstream.token_name = params_list or '(unnamed)'
+            elif method in ('tokenAcquire','tokenForceAcquire') and upstream.token_owner is None:
+                # The client went away before the broker answered, so nobody should hold it.
+                upstream.send('tokenRelease')
+            elif method == 'tokenRelease' and client is upstream.token_owner:
+                upstream.token_owner = None
+                upstream.token_name = ''
+        elif client is None:
+            self.logger.warning("{0} {1} error: {2}".format(upstream.broker_name,method,msg.get('error')))
+        if isinstance(client,_Client):
+            msg['id'] = client_id
+            client.write(msg)
+    def _subscribe_reply(self,upstream,join,msg,params_list):
+        result = msg.get('result')
+        if not isinstance(result,dict):
+            result = {}
+            for param in params_list:
+                result[param] = msg.get('error') or _error('Subscription failed')
+        for param in params_list:
+            sub = upstream.subs.get(param)
+            if sub is None:
+                continue
+            if 'status' in result.get(param,{}):
+                sub['max_ms'] = result.get('max_update_ms')
+            else:
+                # The broker refused it, so nobody is subscribed.
+                sub['spec'] = None
+                for client in sub['clients']:
+                    client.subs.pop(param,None)
+                upstream.subs.pop(param)
+        if join['client'] is None:
+            return
+        join['result'].update(result)
+        join['remaining'] -= 1
+        if join['remaining'] == 0 and join['client'] in join['client'].upstream.clients:
+            self._reply(join['client'],join['client_id'],result=join['result'])
+    def _notification(self,upstream,params):
+        now = time()
+        message_time = params.get('message_time')
+        if message_time is not None:
+            upstream.message_time = message_time
+        for param,param_dict in list(params.items()):
+            if param != 'message_time' and isinstance(param_dict,dict) and 'value' in param_dict:
+                upstream.cache[param] = (param_dict,now)
+        for client in list(upstream.clients):
+            out = {}
+            for param,param_dict in list(params.items()):
+                spec = client.subs.get(param)
+                if spec is None or not isinstance(param_dict,dict):
+                    continue
+                if self._wanted(client,param,spec,param_dict.get('value'),now):
+                    out[param] = param_dict
+                    client.last_sent[param] = (param_dict.get('value'),now)
+            if out:
+                if message_time is not None:
+                    out['message_time'] = message_time
+                client.write({'method':'subscription','params':out})
+    def _wanted(self,client,param,spec,value,now):
+        '''
+        Applies a client's own subscription spec to a notification from the merged subscription.
+        '''
+        last = client.last_sent.get(param)
+        if last is None:
+            return True
+        last_value,last_time = last
+        elapsed_ms = (now - last_time) * 1000
+        if spec['min_update_ms'] and elapsed_ms < spec['min_update_ms']:
+            return False
+        if spec['updates'] == 'on_new' or value != last_value:
+            return True
+        max_ms = spec['max_update_ms'] or client.upstream.subs.get(param,{}).get('max_ms')
+        return bool(max_ms) and elapsed_ms >= max_ms
+    #---------------------------------------------------------------------- Main loop
+    def main_loop(self):
+        while self._running:
+            now = time()
+            for upstream in list(self.upstreams.values()):
+                if upstream.conn is None and now >= upstream.next_connect:
+                    self._connect(upstream)
+            self._update_write_interest()
+            for key,events in self.selector.select(timeout=0.5):
+                kind,obj = key.data
+                if kind == 'listen':
+                    self._accept(key.fileobj,obj)
+                    continue
+                conn = key.fileobj
+                if events & selectors.EVENT_WRITE:
+                    conn.flush()
+                if events & selectors.EVENT_READ:
+                    messages = conn.read()
+                    if messages is None:
+                        conn.write_failed = True
+                    else:
+                        for msg in messages:
+                            try:
+                                if kind == 'upstream':
+                                    self._upstream_message(obj,msg)
+                                else:
+                                    self._client_request(obj,msg)
+                            except Exception as e:
+                                self.logger.error("Error handling {0} from {1}: {2}".format(msg,conn.name,e))
+            self._reap()
+        self.shutdown()
+    def _update_write_interest(self):
+        for key in list(self.selector.get_map().values()):
+            kind,obj = key.data
+            if kind == 'listen':
+                continue
+            events = selectors.EVENT_READ
+            if key.fileobj.pending():
+                events |= selectors.EVENT_WRITE
+            if events != key.events:
+                self.selector.modify(key.fileobj,events,key.data)
+    def _reap(self):
+        # Errors are logged, so one bad connection can't stop the proxy for everyone else.
+        for upstream in list(self.upstreams.values()):
+            for client in list(upstream.clients):
+                if client.write_failed:
+                    try:
+                        self._drop_client(client)
+                    except Exception as e:
+                        self.logger.error("Error dropping {0} client {1}: {2}".format(upstream.broker_name,client.name,e))
+            if upstream.conn is not None and upstream.conn.write_failed:
+                try:
+                    self._drop_upstream(upstream)
+                except Exception as e:
+                    self.logger.error("Error dropping {0} broker connection: {1}".format(upstream.broker_name,e))
+    def _stop_running(self, signal_number, *args):
+        self._running = False
+        self.logger.warning('Caught signal number {0}, shutting down.'.format(signal_number))
+    def shutdown(self):
+        self.logger.info("Shutting down broker proxy")
+        for key in list(self.selector.get_map().values()):
+            try:
+                key.fileobj.close()
+            except Exception:
+                pass
+        self.selector.close()
+        logging.shutdown()
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print('Usage: ', sys.argv[0], ' ini-file')
+        sys.exit(1)
+    if os.path.exists(sys.argv[1]) is False:
+        print(sys.argv[1], "does not exist")
+        sys.exit(1)
+    logger = logging.getLogger('')
+    logging.basicConfig(stream=sys.stdout, level=logging.DEBUG,
+                        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s")
+    config = ConfigObj(sys.argv[1])  # Read the config file
+    dbh = avp_db.DB_LogHandler(config)
+    dbh.setLevel(logging.INFO)
+    logger.addHandler(dbh)
+    proxy = BrokerProxy(config,program_name='avp_proxy',debug_mode=False)
+    try:
+        proxy.main_loop()
+    except KeyboardInterrupt:
+        proxy.shutdown()
@@ -0,0 +1,108 @@
+#! /usr/bin/env python
+#-------------------------------------------------------------------------------
+# Name:        avp_record
+# Purpose:     Records broker JSON-RPC traffic so avp_replay.py can play it back.
+#              When RECORD_FILE is set in the [broker] section of the config file, every
+#              SocketHandler appends each request, reply and notification it sees to that
+#              file, one line per message:
+#                  <time.time()> <broker name> <kind> <tag> <JSON exactly as sent or received>
+#              where kind is C (connected, JSON is the broker address), > (request),
+#              < (reply) or ! (notification), and tag identifies the client connection
+#              (process id and connection number) so replies can be matched to requests
+#              when several programs record to the same file.
+#              Example:
+#                 recorder = avp_record.open_recorder('/data/cast_1234.rec')
+#                 tag = avp_record.connection_tag()
+#                 recorder.request('sonde',tag,avp_codec.dumps({'method':'status','id':1}))
+#
+# Author:      whipple
+#
+# Created:     10/19/2026
+#-------------------------------------------------------------------------------
+#Built in Modules
+import itertools
+import logging
+import os
+import threading
+from time import time
+#Custom Modules
+import avp_codec
+
+KINDS = {b'C':'connect',b'>':'request',b'<':'reply',b'!':'notification'}
+
+_recorders = {}
+_recorders_lock = threading.Lock()
+_connection_numbers = itertools.count(1)
+
+
+def open_recorder(path):
+    '''
+    Returns the shared Recorder for path, or None if path is not set or can't be opened.
+    '''
+    if not path:
+        return None
+    with _recorders_lock:
+        recorder = _recorders.get(path)
+        if recorder is None:
+            try:
+                recorder = Recorder(path)
+            except (IOError,OSError) as e:
+                logging.getLogger('avp_record').error("Can not record broker traffic to {0} ({1})".format(path,e))
+                return None
+            _recorders[path] = recorder
+    return recorder
+
+def connection_tag():
+    '''
+    Returns a tag for one client connection which no other connection in any program will have.
+    '''
+    return '{0}-{1}'.format(os.getpid(),next(_connection_numbers))
+
+def read_recording(path):
+    '''
+    Yields (time,broker_name,kind,tag,message) for each line of a recording, where kind is
+    'connect', 'request', 'reply' or 'notification'. Lines which can't be decoded (such as
+    a partial last line) are skipped.
+    '''
+    with open(path,'rb') as recording:
+        for line in recording:
+            try:
+                stamp,broker_name,kind,frame = line.split(b' ',3)
+                tag = b''
+                if not frame.startswith(b'{'): # Older recordings don't have a tag
+                    tag,frame = frame.split(b' ',1)
+                yield float(stamp),broker_name.decode('utf-8'),KINDS[kind],tag.decode('utf-8'),avp_codec.loads(frame)
+            except (ValueError,KeyError):
+                continue
+
+
+class Recorder(object):
+    '''
+    Appends broker traffic to a recording. Each message is written with a single os.write() on
+    a file opened for appending, so lines from different threads and programs don't interleave.
+    Public Methods: connected, request, reply, notification, close
+    '''
+    def __init__(self,path):
+        self.path = path
+        self._fd = os.open(path,os.O_WRONLY | os.O_APPEND | os.O_CREAT,0o644)
+    def _write(self,broker_name,kind,tag,frame):
+        if self._fd is None:
+            return
+        line = b'%.3f %s %s %s %s\n' % (time(),broker_name.encode('utf-8'),kind,tag.encode('utf-8'),frame)
+        try:
+            os.write(self._fd,line)
+        except (IOError,OSError) as e:
+            logging.getLogger('avp_record').error("Stopped recording to {0} ({1})".format(self.path,e))
+            self.close()
+    def connected(self,broker_name,tag,address):
+        self._write(broker_name,b'C',tag,avp_codec.dumps({'host':address[0],'port':address[1]}))
+    def request(self,broker_name,tag,frame):
+        self._write(broker_name,b'>',tag,frame)
+    def reply(self,broker_name,tag,frame):
+        self._write(broker_name,b'<',tag,frame)
+    def notification(self,broker_name,tag,frame):
+        self._write(broker_name,b'!',tag,frame)
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
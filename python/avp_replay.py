@@ -0,0 +1,352 @@
+#! /usr/bin/env python
+#-------------------------------------------------------------------------------
+# Name:        avp_replay
+# Purpose:     Plays back broker traffic recorded by avp_record.py (see [broker] RECORD_FILE).
+#              ReplayServer serves a recording back to _BrokerClients on the recorded broker
+#              ports (plus an optional offset). Notifications are sent on the recorded
+#              schedule, speeded up by a factor, to clients which have subscribed to them.
+#              Requests are answered with the recorded reply to the same request nearest in
+#              time, after the recorded delay. A speed of 0 sends everything as fast as the
+#              clients will take it, which makes a recording a repeatable benchmark.
+#              Examples:
+#                 avp_replay.py /data/cast_1234.rec 10       # Replay ten times as fast
+#                 avp_replay.py /data/cast_1234.rec 0 100    # Flat out, on PORT + 100
+#              then run the program under test with each broker's PORT pointing at the replay.
+#
+#              usage: avp_replay.py <recording> [speed] [port offset]
+#
+# Author:      whipple
+#
+# Created:     10/19/2026
+#-------------------------------------------------------------------------------
+#Built in Modules
+import heapq
+import json
+import logging
+import os
+import selectors
+import signal
+import socket
+import sys
+from time import time
+#Custom Modules
+import avp_proxy
+import avp_record
+
+# Broker error codes (see javp BrokerError.java)
+E_UNSUPPORTED_METHOD = -32601
+E_UNSUPPORTED_SUB_PARAM = -31959
+
+
+def _request_key(method,params):
+    return '{0} {1}'.format(method,json.dumps(params,sort_keys=True))
+
+
+class _Recorded(object):
+    '''
+    Everything recorded from one broker.
+    Instance Variables: broker_name, port, replies, notifications, params
+    '''
+    def __init__(self,broker_name):
+        self.broker_name = broker_name
+        self.port = None
+        self.replies = {}           # request key:[(offset,latency,reply)] in time order, also by method alone
+        self.notifications = []     # [(offset,params)] in time order, each param value only once
+        self.params = set()         # Every parameter the broker reported
+        self.sub_replies = {}       # param:recorded per-param subscribe reply
+        self._pending = {}          # (connection tag,id):request, ids are only unique within a connection
+        self._seen = set()
+    def add(self,offset,kind,tag,msg):
+        if kind == 'connect':
+            if self.port is None:
+                self.port = int(msg.get('port',0))
+        elif kind == 'request':
+            self._pending[(tag,msg.get('id'))] = (offset,msg.get('method'),msg.get('params'))
+        elif kind == 'reply':
+            request = self._pending.pop((tag,msg.get('id')),None)
+            if request is None:
+                return
+            request_offset,method,params = request
+            entry = (request_offset,offset - request_offset,msg)
+            self.replies.setdefault(_request_key(method,params),[]).append(entry)
+            self.replies.setdefault(method,[]).append(entry)
+            result = msg.get('result')
+            if method in ('list_data','status') and isinstance(result,dict):
+                self.params.update(result.keys())
+            elif method == 'subscribe' and isinstance(result,dict):
+                for param,value in list(result.items()):
+                    if isinstance(value,dict) and 'status' in value:
+                        self.sub_replies[param] = value
+        elif kind == 'notification':
+            params = msg.get('params')
+            if not isinstance(params,dict):
+                return
+            new_params = {}
+            for param,value in list(params.items()):
+                if param == 'message_time' or not isinstance(value,dict):
+                    continue
+                # Several recorded clients will have had the same notification.
+                key = (param,value.get('sample_time',params.get('message_time',{}).get('value')),str(value.get('value')))
+                if key not in self._seen:
+                    self._seen.add(key)
+                    new_params[param] = value
+            if new_params:
+                new_params['message_time'] = params.get('message_time',{})
+                self.params.update(new_params.keys())
+                self.notifications.append((offset,new_params))
+
+
+class _ReplayClient(avp_proxy._Connection):
+    '''
+    A _BrokerClient connected to the replay.
+    Instance Variables: recorded, subs, cursor
+    '''
+    def __init__(self,sock,name,recorded):
+        super(_ReplayClient,self).__init__(sock,name)
+        self.recorded = recorded
+        self.subs = set()
+        self.cursor = 0 # Index of the next notification in recorded.notifications
+
+
+class ReplayServer(object):
+    '''
+    Serves a recording back to broker clients.
+    Arguments:
+        path        -- Recording to play
+        speed       -- Playback speed, 1 is real time, 0 is as fast as possible
+        port_offset -- Listen on each recorded broker port + port_offset
+    Public Methods: main_loop, shutdown
+    Instance Variables: recorded, speed, HOST, start_time, stats
+    '''
+    MAX_PENDING = 65536 # Bytes queued to a client before we stop sending it notifications
+    def __init__(self,path,speed=1.0,port_offset=0,host='localhost',**kwargs):
+        self.debug_mode = kwargs.get('debug_mode',False)
+        self.logger = logging.getLogger(self.__class__.__name__)
+        if self.debug_mode is False:
+            self.logger.setLevel(logging.INFO)
+        self.speed = float(speed)
+        self.HOST = host
+        self._running = True
+        signal.signal(signal.SIGTERM, self._stop_running)
+        signal.signal(signal.SIGHUP, self._stop_running)
+        signal.signal(signal.SIGQUIT, self._stop_running)
+        self.recorded = {}
+        first_time = None
+        for stamp,broker_name,kind,tag,msg in avp_record.read_recording(path):
+            if first_time is None:
+                first_time = stamp
+            if broker_name not in self.recorded:
+                self.recorded[broker_name] = _Recorded(broker_name)
+            self.recorded[broker_name].add(stamp - first_time,kind,tag,msg)
+        self.start_time = None # Set when the first client connects
+        self.stats = {'requests':0,'unanswered':0,'notifications':0}
+        self._delayed = [] # heap of (send time,sequence,client,message)
+        self._sequence = 0
+        self.selector = selectors.DefaultSelector()
+        for broker_name,recorded in list(self.recorded.items()):
+            if not recorded.port:
+                self.logger.warning("No connection to {0} in {1}, not replaying it".format(broker_name,path))
+                continue
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((self.HOST,recorded.port + port_offset))
+            listener.listen(16)
+            listener.setblocking(False)
+            self.selector.register(listener,selectors.EVENT_READ,('listen',recorded))
+            self.logger.info("Replaying {0} ({1} notifications) on port {2}".format(
+                             broker_name,len(recorded.notifications),recorded.port + port_offset))
+    def _clock(self):
+        '''
+        Returns the position in the recording, in recorded seconds.
+        '''
+        if self.start_time is None:
+            return 0.0
+        if self.speed <= 0:
+            return float('inf')
+        return (time() - self.start_time) * self.speed
+    #---------------------------------------------------------------------- Requests
+    def _request(self,client,msg):
+        self.stats['requests'] += 1
+        method = msg.get('method')
+        params = msg.get('params')
+        recorded = client.recorded
+        if method == 'subscribe':
+            params = params or {}
+            client.subs.update(params.get('data',[]))
+            reply = self._find_reply(recorded,method,params)
+            if reply is None:
+                reply = self._subscribe_reply(recorded,params)
+        else:
+            if method == 'unsubscribe':
+                client.subs.difference_update((params or {}).get('data',[]))
+            reply = self._find_reply(recorded,method,params)
+        if reply is None:
+            self.stats['unanswered'] += 1
+            reply = {'error':{'code':E_UNSUPPORTED_METHOD,'message':'Not in recording: {0}'.format(method)},'latency':0}
+        latency = reply.pop('latency')
+        reply['id'] = msg.get('id')
+        if self.speed <= 0 or latency <= 0:
+            client.write(reply)
+        else:
+            self._sequence += 1
+            heapq.heappush(self._delayed,(time() + latency / self.speed,self._sequence,client,reply))
+    def _find_reply(self,recorded,method,params):
+        '''
+        Returns a copy of the recorded reply to this request closest to the current point in the
+        recording, falling back to any reply to the same method, with its latency added.
+        '''
+        candidates = recorded.replies.get(_request_key(method,params)) or recorded.replies.get(method)
+        if not candidates:
+            return None
+        clock = self._clock()
+        request_offset,latency,reply = candidates[0]
+        for entry in candidates:
+            if entry[0] > clock:
+                break
+            request_offset,latency,reply = entry
+        reply = dict((key,value) for key,value in list(reply.items()) if key != 'id')
+        reply['latency'] = latency
+        return reply
+    def _subscribe_reply(self,recorded,params):
+        result = {}
+        for param in params.get('data',[]):
+            if param in recorded.sub_replies:
+                result[param] = recorded.sub_replies[param]
+            elif param in recorded.params:
+                result[param] = {'status':'ok'}
+            else:
+                result[param] = {'status':'error','code':E_UNSUPPORTED_SUB_PARAM,'message':'Unsupported subscription parameter'}
+        for key in ('min_update_ms','max_update_ms'):
+            if key in params:
+                result[key] = params[key]
+        return {'result':result,'latency':0}
+    #---------------------------------------------------------------------- Notifications
+    def _notify(self,client,clock):
+        '''
+        Sends client every notification it has subscribed to up to clock, unless it is falling behind.
+        '''
+        notifications = client.recorded.notifications
+        while client.cursor < len(notifications) and notifications[client.cursor][0] <= clock:
+            if len(client._tx) > self.MAX_PENDING:
+                return
+            offset,params = notifications[client.cursor]
+            client.cursor += 1
+            if not client.subs:
+                continue
+            wanted = dict((param,value) for param,value in list(params.items()) if param in client.subs)
+            if wanted:
+                wanted['message_time'] = params['message_time']
+                client.write({'method':'subscription','params':wanted})
+                self.stats['notifications'] += 1
+    def _next_due(self,clients):
+        '''
+        Returns how many seconds main_loop may wait before something else has to be sent.
+        '''
+        now = time()
+        wait = 0.5
+        if self._delayed:
+            wait = min(wait,self._delayed[0][0] - now)
+        for client in clients:
+            if client.cursor < len(client.recorded.notifications):
+                if self.speed <= 0:
+                    return 0 if not client.pending() else wait
+                due = self.start_time + client.recorded.notifications[client.cursor][0] / self.speed
+                wait = min(wait,due - now)
+        return max(wait,0)
+    #---------------------------------------------------------------------- Loop
+    def _accept(self,listener,recorded):
+        try:
+            sock,address = listener.accept()
+        except (IOError,OSError):
+            return
+        if self.start_time is None:
+            self.start_time = time()
+            self.logger.info("Replay started")
+        client = _ReplayClient(sock,'{0}:{1}'.format(*address),recorded)
+        # Start with the recording as it is now, like connecting to a running broker.
+        clock = self._clock()
+        while client.cursor < len(recorded.notifications) and recorded.notifications[client.cursor][0] < clock:
+            client.cursor += 1
+        self.selector.register(client,selectors.EVENT_READ,('client',client))
+        self.logger.debug("{0} client {1} connected".format(recorded.broker_name,client.name))
+    def _drop_client(self,client):
+        self.logger.debug("{0} client {1} disconnected".format(client.recorded.broker_name,client.name))
+        try:
+            self.selector.unregister(client)
+        except (KeyError,ValueError):
+            pass
+        client.close()
+    def _clients(self):
+        return [key.data[1] for key in list(self.selector.get_map().values()) if key.data[0] == 'client']
+    def main_loop(self):
+        while self._running:
+            clients = self._clients()
+            now = time()
+            while self._delayed and self._delayed[0][0] <= now:
+                due,sequence,client,reply = heapq.heappop(self._delayed)
+                if not client.write_failed:
+                    client.write(reply)
+            if self.start_time is not None:
+                clock = self._clock()
+                for client in clients:
+                    self._notify(client,clock)
+            for client in clients:
+                events = selectors.EVENT_READ
+                if client.pending():
+                    events |= selectors.EVENT_WRITE
+                key = self.selector.get_key(client)
+                if events != key.events:
+                    self.selector.modify(client,events,key.data)
+            timeout = self._next_due(clients) if self.start_time is not None else 0.5
+            for key,events in self.selector.select(timeout=timeout):
+                kind,obj = key.data
+                if kind == 'listen':
+                    self._accept(key.fileobj,obj)
+                    continue
+                if events & selectors.EVENT_WRITE:
+                    obj.flush()
+                if events & selectors.EVENT_READ:
+                    messages = obj.read()
+                    if messages is None:
+                        obj.write_failed = True
+                    else:
+                        for msg in messages:
+                            try:
+                                self._request(obj,msg)
+                            except Exception as e:
+                                self.logger.error("Error replying to {0} from {1}: {2}".format(msg,obj.name,e))
+            for client in self._clients():
+                if client.write_failed:
+                    self._drop_client(client)
+        self.shutdown()
+    def _stop_running(self, signal_number, *args):
+        self._running = False
+        self.logger.warning('Caught signal number {0}, shutting down.'.format(signal_number))
+    def shutdown(self):
+        self.logger.info("Replay finished: {requests} requests ({unanswered} not in recording), {notifications} notifications sent".format(**self.stats))
+        for key in list(self.selector.get_map().values()):
+            try:
+                key.fileobj.close()
+            except Exception:
+                pass
+        self.selector.close()
+        logging.shutdown()
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print('Usage: ', sys.argv[0], ' recording [speed] [port offset]')
+        sys.exit(1)
+    if os.path.exists(sys.argv[1]) is False:
+        print(sys.argv[1], "does not exist")
+        sys.exit(1)
+    logging.basicConfig(stream=sys.stdout, level=logging.DEBUG,
+                        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s")
+    speed = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    port_offset = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    server = ReplayServer(sys.argv[1],speed=speed,port_offset=port_offset)
+    try:
+        server.main_loop()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -693,7 +693,8 @@ class _AVPSchedule(threading.Thread):
                 #reload_db_time = datetime.now(pytz.reference.LocalTimezone()) + timedelta(days=1) # reload once a day. If all is working this can be much bigger.
             sleep_time = 60 - datetime.now(pytz.reference.LocalTimezone()).second 
             if self.debug_mode: print("Scheduler sleeping {0} sec.".format(sleep_time))
-            time.sleep(sleep_time) # Once per minute, on the minute
+            # Once per minute, on the minute, or sooner if the schedule table changes
+            self.sch_db.notified(sleep_time)
         #super(_AVPSchedule,self).__init__() # may allow us to re-start thread later
 
 class CronTime(object):
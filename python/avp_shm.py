@@ -0,0 +1,235 @@
+#! /usr/bin/env python
+#-------------------------------------------------------------------------------
+# Name:        avp_shm
+# Purpose:     Shared-memory latest-value table for broker parameters.
+#              A single writer (avp_collector.py) subscribes once to every broker and
+#              publishes the latest value, units and sample_time of each parameter into
+#              a memory mapped file. Any number of reader processes can then look up
+#              <broker>.<parameter> without any socket I/O.
+#
+#              Each slot is protected by a sequence lock. The writer makes the sequence
+#              number odd, writes the slot and makes it even again. A reader copies the
+#              slot and only accepts the copy if the sequence number was even and did
+#              not change while it was reading.
+#
+#              Examples:
+#                 bus = ShmTable('/dev/shm/avp_bus')            # reader
+#                 value,units,sample_time_long,age = bus.read('sonde','depth_m')
+#
+# Author:      whipple
+#
+# Created:     10/19/2026
+#-------------------------------------------------------------------------------
+#Built in Modules
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+'''
+File layout:
+    header (64 bytes)   -- magic, version, number of slots, slot size, writer pid, heartbeat
+    slots               -- N_SLOTS * SLOT_SIZE bytes
+'''
+MAGIC = b'AVPB'
+VERSION = 1
+HEADER_FMT = '<4sIIIId36x'
+HEADER_SIZE = struct.calcsize(HEADER_FMT)
+HEARTBEAT_OFFSET = 20 # Offset of the heartbeat double in the header
+#           seq  pub_time  sample_time_long  ivalue  fvalue  tag  key  units  svalue
+SLOT_FMT = '<Q   d         q                 q       d       B7x  48s  24s    64s'.replace(' ','')
+SLOT_SIZE = struct.calcsize(SLOT_FMT)
+SEQ_FMT = '<Q'
+KEY_OFFSET = 48 # Offset of the key within a slot
+KEY_SIZE = 48
+N_SLOTS = 1024
+MAX_READ_TRIES = 100
+# Value type tags
+T_EMPTY,T_NONE,T_FLOAT,T_INT,T_BOOL,T_STR = list(range(6))
+
+
+class ShmTable(object):
+    '''
+    Memory mapped seqlock table of the most recent broker values.
+
+    Arguments:
+        path    -- File backing the table. Should be on a tmpfs such as /dev/shm
+        writer  -- If True, create/initialize the table and take the writer lock.
+        n_slots -- Number of slots when creating a new table.
+    Public Methods: publish, read, heartbeat, close
+    Instance Variables: path, writer, n_slots
+    '''
+    def __init__(self,path,writer=False,n_slots=N_SLOTS,**kwargs):
+        debug_mode = kwargs.get('debug_mode',False)
+        self.logger = logging.getLogger(self.__class__.__name__)
+        if debug_mode is False:
+            self.logger.setLevel(logging.INFO)
+        self.path = path
+        self.writer = writer
+        self._index = {} # key:slot offset cache
+        self._lock = threading.Lock() # Several subscription handler threads may publish at once
+        if writer:
+            self._fd = os.open(path,os.O_RDWR | os.O_CREAT,0o644)
+            try:
+                # Only one collector may write to a table.
+                fcntl.flock(self._fd,fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError,OSError) as e:
+                os.close(self._fd)
+                raise IOError("Another process is already writing to {0} ({1})".format(path,e))
+            # Never shrink, readers may still have a bigger table mapped and would get SIGBUS.
+            size = max(HEADER_SIZE + n_slots * SLOT_SIZE,os.fstat(self._fd).st_size)
+            if size > os.fstat(self._fd).st_size:
+                os.ftruncate(self._fd,size)
+            self._mm = mmap.mmap(self._fd,size,mmap.MAP_SHARED,mmap.PROT_READ | mmap.PROT_WRITE)
+            self._mm[:] = b'\x00' * size # Start from a clean table every time the writer starts.
+            struct.pack_into(HEADER_FMT,self._mm,0,MAGIC,VERSION,n_slots,SLOT_SIZE,os.getpid(),time.time())
+        else:
+            self._fd = os.open(path,os.O_RDONLY)
+            size = os.fstat(self._fd).st_size
+            self._mm = mmap.mmap(self._fd,size,mmap.MAP_SHARED,mmap.PROT_READ)
+            (magic,version,n_slots,slot_size,pid,heartbeat) = struct.unpack_from(HEADER_FMT,self._mm,0)
+            if magic != MAGIC or version != VERSION or slot_size != SLOT_SIZE:
+                self.close()
+                raise ValueError("{0} is not a version {1} AVP shared memory table".format(path,VERSION))
+        self.n_slots = n_slots
+    def _key(self,broker_name,data_name):
+        return '{0}.{1}'.format(broker_name,data_name).encode('utf-8')[:KEY_SIZE]
+    def _find(self,key,claim=False):
+        '''
+        Returns the offset of the slot holding key using open addressing with linear probing.
+        If claim is True (writer only) an empty slot will be returned for a new key.
+        '''
+        offset = self._index.get(key)
+        if offset is not None:
+            return offset
+        start = zlib.crc32(key) % self.n_slots
+        for i in range(self.n_slots):
+            offset = HEADER_SIZE + ((start + i) % self.n_slots) * SLOT_SIZE
+            slot_key = self._mm[offset + KEY_OFFSET:offset + KEY_OFFSET + KEY_SIZE].rstrip(b'\x00')
+            if slot_key == key:
+                self._index[key] = offset
+                return offset
+            if not slot_key:
+                # Keys are never removed, so an empty slot ends the probe.
+                return offset if claim else None
+        return None
+    def publish(self,broker_name,data_name,value,units=None,sample_time_long=0):
+        '''
+        Writes a value to the table. Writer only.
+        '''
+        if not self.writer:
+            raise IOError("{0} was not opened for writing".format(self.path))
+        key = self._key(broker_name,data_name)
+        ivalue,fvalue,svalue = 0,0.0,b''
+        if value is None:
+            tag = T_NONE
+        elif value is True or value is False:
+            tag,ivalue = T_BOOL,int(value)
+        elif isinstance(value,int) and -2**63 <= value < 2**63:
+            tag,ivalue = T_INT,value
+        elif isinstance(value,int):
+            tag,fvalue = T_FLOAT,float(value)
+        elif isinstance(value,float):
+            tag,fvalue = T_FLOAT,value
+        else:
+            tag,svalue = T_STR,str(value).encode('utf-8')[:64]
+        try:
+            sample_time_long = int(sample_time_long or 0)
+        except (TypeError,ValueError):
+            sample_time_long = 0
+        units = (units or '').encode('utf-8')[:24]
+        with self._lock:
+            offset = self._find(key,claim=True)
+            if offset is None:
+                self.logger.error("Shared memory table {0} is full, can not add {1}".format(self.path,key))
+                return False
+            (seq,) = struct.unpack_from(SEQ_FMT,self._mm,offset)
+            struct.pack_into(SEQ_FMT,self._mm,offset,seq + 1) # Odd, readers will retry
+            struct.pack_into(SLOT_FMT,self._mm,offset,seq + 1,time.time(),sample_time_long,
+                             ivalue,fvalue,tag,key,units,svalue)
+            struct.pack_into(SEQ_FMT,self._mm,offset,seq + 2) # Even again, slot is consistent
+            self._index[key] = offset
+        return True
+    def heartbeat(self):
+        '''
+        Writer only. Lets readers know the collector is still alive.
+        '''
+        struct.pack_into('<d',self._mm,HEARTBEAT_OFFSET,time.time())
+    def writer_age(self):
+        '''
+        Returns the number of seconds since the writer last updated its heartbeat.
+        '''
+        (heartbeat,) = struct.unpack_from('<d',self._mm,HEARTBEAT_OFFSET)
+        return time.time() - heartbeat
+    def read(self,broker_name,data_name):
+        '''
+        Returns (value,units,sample_time_long,age) or None if the parameter is not in the table.
+        age is the number of seconds since the value was published.
+        '''
+        key = self._key(broker_name,data_name)
+        offset = self._find(key)
+        if offset is None:
+            return None
+        for i in range(MAX_READ_TRIES):
+            (seq1,) = struct.unpack_from(SEQ_FMT,self._mm,offset)
+            if seq1 & 1:
+                time.sleep(0) # Writer is part way through an update
+                continue
+            (seq,pub_time,sample_time_long,ivalue,fvalue,tag,
+             slot_key,units,svalue) = struct.unpack_from(SLOT_FMT,self._mm,offset)
+            (seq2,) = struct.unpack_from(SEQ_FMT,self._mm,offset)
+            if seq1 == seq2 == seq:
+                break
+            time.sleep(0)
+        else:
+            self.logger.debug("Could not get a consistent read of {0}".format(key))
+            return None
+        if slot_key.rstrip(b'\x00') != key:
+            # The writer has restarted and re-ordered the table.
+            self._index.pop(key,None)
+            return None
+        if tag == T_FLOAT:
+            value = fvalue
+        elif tag == T_INT:
+            value = ivalue
+        elif tag == T_BOOL:
+            value = bool(ivalue)
+        elif tag == T_STR:
+            value = svalue.rstrip(b'\x00').decode('utf-8','replace')
+        else:
+            value = None
+        units = units.rstrip(b'\x00').decode('utf-8','replace')
+        return (value,units,sample_time_long,time.time() - pub_time)
+    def close(self):
+        try:
+            self._mm.close()
+        except Exception:
+            pass
+        try:
+            os.close(self._fd) # Also releases the writer lock
+        except OSError:
+            pass
+
+_readers = {} # path:ShmTable, so each process maps a table only once.
+_readers_lock = threading.Lock()
+
+def attach(path,**kwargs):
+    '''
+    Returns a shared reader for the table at path, or None if there is no usable table.
+    '''
+    if not path:
+        return None
+    with _readers_lock:
+        table = _readers.get(path)
+        if table is None:
+            try:
+                table = ShmTable(path,writer=False,**kwargs)
+            except (IOError,OSError,ValueError) as e:
+                logging.getLogger('avp_shm').debug("Shared memory table {0} not available ({1})".format(path,e))
+                return None
+            _readers[path] = table
+    return table
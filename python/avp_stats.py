@@ -0,0 +1,282 @@
+#! /usr/bin/env python
+#-------------------------------------------------------------------------------
+# Name:        avp_stats
+# Purpose:     Counters and latency histograms for broker JSON-RPC calls.
+#              Every SocketHandler records each call it makes, per broker and per method,
+#              into the BrokerStats returned by for_broker(), along with the time between
+#              subscription notifications. Recording is a dictionary update under a lock.
+#              The avp_console 'rpcstats' command prints them and, if RPC_STATS_INTERVAL is
+#              set in the [broker] section of the config file, a SnapshotWriter thread writes
+#              the calls made in each interval to the RPC_STATS_TABLE in the database.
+#              Examples:
+#                 stats = avp_stats.for_broker('sonde')
+#                 stats.rpc('status',0.012)
+#                 print('\n'.join(avp_stats.report([stats])))
+#
+# Author:      whipple
+#
+# Created:     10/19/2026
+#-------------------------------------------------------------------------------
+#Built in Modules
+from datetime import datetime
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+#Installed Modules
+import pytz.reference
+
+SUB_BITS = 4 # 16 sub-buckets per power of two, so values are within about 3% of what was recorded
+_SUB_COUNT = 1 << SUB_BITS
+
+
+def _index(value):
+    '''
+    Bucket index for a whole number of microseconds. Exact below 32us, then log-linear.
+    '''
+    if value < 2 * _SUB_COUNT:
+        return value
+    shift = value.bit_length() - SUB_BITS - 1
+    return (shift << SUB_BITS) + (value >> shift)
+
+def _value(index):
+    '''
+    Middle of the bucket, in microseconds.
+    '''
+    if index < 2 * _SUB_COUNT:
+        return index
+    shift = (index >> SUB_BITS) - 1
+    return (((index & (_SUB_COUNT - 1)) + _SUB_COUNT) << shift) + (1 << shift) // 2
+
+
+class LatencyHistogram(object):
+    '''
+    HDR style histogram of durations. Values are kept in buckets whose width grows with the value,
+    so the memory used depends on the range of values, not how many there are.
+    Public Methods: record, percentile, mean, since, copy
+    Instance Variables: count, total, max
+    '''
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    def record(self,seconds):
+        index = _index(int(seconds * 1e6))
+        self.counts[index] = self.counts.get(index,0) + 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+    def percentile(self,percent):
+        '''
+        Returns the duration in seconds which percent of the recorded values were at or below.
+        '''
+        if self.count == 0:
+            return None
+        wanted = self.count * percent / 100.0
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= wanted:
+                return min(_value(index) / 1e6,self.max)
+        return self.max
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.total / self.count
+    def copy(self):
+        other = LatencyHistogram()
+        other.counts = dict(self.counts)
+        other.count = self.count
+        other.total = self.total
+        other.max = self.max
+        return other
+    def since(self,earlier):
+        '''
+        Returns a histogram of what has been recorded since the copy earlier was taken.
+        The max is the middle of the highest bucket with new values.
+        '''
+        delta = LatencyHistogram()
+        for index,count in list(self.counts.items()):
+            count -= earlier.counts.get(index,0)
+            if count > 0:
+                delta.counts[index] = count
+        delta.count = self.count - earlier.count
+        delta.total = self.total - earlier.total
+        if delta.counts:
+            delta.max = min(_value(max(delta.counts)) / 1e6,self.max)
+        return delta
+
+
+class BrokerStats(object):
+    '''
+    RPC counters and latencies for one broker, shared by every client of that broker in this program.
+    Public Methods: rpc, notification, snapshot
+    Instance Variables: broker_name, methods, notifications, interarrival
+    '''
+    def __init__(self,broker_name):
+        self.broker_name = broker_name
+        self.methods = {} # method:{'calls','errors','timeouts','latency'}
+        self.notifications = 0
+        self.interarrival = LatencyHistogram()
+        self._last_notification = None
+        self._lock = threading.Lock()
+    def rpc(self,method,seconds,error=False,timed_out=False):
+        with self._lock:
+            counters = self.methods.get(method)
+            if counters is None:
+                counters = self.methods[method] = {'calls':0,'errors':0,'timeouts':0,'latency':LatencyHistogram()}
+            counters['calls'] += 1
+            if error:
+                counters['errors'] += 1
+            if timed_out:
+                counters['timeouts'] += 1
+            else:
+                counters['latency'].record(seconds)
+    def notification(self,now):
+        with self._lock:
+            self.notifications += 1
+            if self._last_notification is not None:
+                self.interarrival.record(now - self._last_notification)
+            self._last_notification = now
+    def snapshot(self):
+        '''
+        Returns a copy of the counters, {method:{'calls','errors','timeouts','latency'}}, with
+        notifications under 'notification' (calls is the number of notifications, latency the
+        time between them).
+        '''
+        with self._lock:
+            snapshot = {}
+            for method,counters in list(self.methods.items()):
+                snapshot[method] = dict(counters,latency=counters['latency'].copy())
+            snapshot['notification'] = {'calls':self.notifications,'errors':0,'timeouts':0,
+                                        'latency':self.interarrival.copy()}
+            return snapshot
+
+
+_brokers = {}
+_brokers_lock = threading.Lock()
+
+
+def for_broker(broker_name):
+    '''
+    Returns the BrokerStats for broker_name, creating it the first time.
+    '''
+    with _brokers_lock:
+        stats = _brokers.get(broker_name)
+        if stats is None:
+            stats = _brokers[broker_name] = BrokerStats(broker_name)
+        return stats
+
+def all_brokers():
+    with _brokers_lock:
+        return [_brokers[name] for name in sorted(_brokers)]
+
+def _ms(seconds):
+    if seconds is None:
+        return None
+    return round(seconds * 1000,1)
+
+def rows(snapshot,earlier=None):
+    '''
+    Returns {method:{calls,errors,timeouts,p50_ms,p90_ms,p99_ms,max_ms,mean_ms}} from a
+    BrokerStats.snapshot(), only counting what happened since the snapshot earlier if it is given.
+    Methods with no calls are left out.
+    '''
+    result = {}
+    earlier = earlier or {}
+    for method,counters in list(snapshot.items()):
+        before = earlier.get(method,{'calls':0,'errors':0,'timeouts':0,'latency':LatencyHistogram()})
+        calls = counters['calls'] - before['calls']
+        if calls <= 0:
+            continue
+        latency = counters['latency'].since(before['latency'])
+        result[method] = {'calls':calls,
+                          'errors':counters['errors'] - before['errors'],
+                          'timeouts':counters['timeouts'] - before['timeouts'],
+                          'p50_ms':_ms(latency.percentile(50)),
+                          'p90_ms':_ms(latency.percentile(90)),
+                          'p99_ms':_ms(latency.percentile(99)),
+                          'max_ms':_ms(latency.max if latency.count else None),
+                          'mean_ms':_ms(latency.mean())}
+    return result
+
+def report(stats_list):
+    '''
+    Returns a list of lines describing each BrokerStats in stats_list, for the console.
+    '''
+    lines = ["{0:<8} {1:<18} {2:>7} {3:>6} {4:>5} {5:>8} {6:>8} {7:>8} {8:>8}".format(
+             'broker','method','calls','errors','t/o','p50 ms','p90 ms','p99 ms','max ms')]
+    for stats in stats_list:
+        for method,row in sorted(rows(stats.snapshot()).items()):
+            values = [row[key] if row[key] is not None else '-' for key in ('p50_ms','p90_ms','p99_ms','max_ms')]
+            lines.append("{0:<8} {1:<18} {2:>7} {3:>6} {4:>5} {5:>8} {6:>8} {7:>8} {8:>8}".format(
+                         stats.broker_name,method,row['calls'],row['errors'],row['timeouts'],*values))
+    if len(lines) == 1:
+        lines.append("No broker calls made yet.")
+    return lines
+
+
+class SnapshotWriter(threading.Thread):
+    '''
+    Every interval seconds, writes what each broker's stats recorded during the interval to the
+    database, one row per broker and method.
+    Arguments:
+        config      -- ConfigObj of the avp.ini file
+        interval    -- Seconds between snapshots
+    Public Methods: snapshot, shutdown
+    '''
+    def __init__(self,config,interval,**kwargs):
+        super(SnapshotWriter,self).__init__()
+        self.daemon = True
+        self.name = self.__class__.__name__
+        self.logger = logging.getLogger(self.__class__.__name__)
+        if kwargs.get('debug_mode',False) is False:
+            self.logger.setLevel(logging.INFO)
+        self.interval = interval
+        self.program = os.path.basename(sys.argv[0]) or 'python'
+        self.config = config
+        self.table = config.get('db',{}).get('RPC_STATS_TABLE','{0}_rpc_stats'.format(socket.gethostname()))
+        self.db = None # Connected by the first snapshot, so short lived programs never connect
+        self._previous = {}
+        self._stop = threading.Event()
+    def run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.snapshot()
+            except Exception as e:
+                self.logger.error("Could not write RPC statistics: {0}".format(e))
+    def snapshot(self):
+        if self.db is None:
+            import avp_db
+            self.db = avp_db.AvpDB(self.config,self.table)
+        sample_time = datetime.now(pytz.reference.LocalTimezone())
+        for stats in all_brokers():
+            snapshot = stats.snapshot()
+            for method,row in list(rows(snapshot,self._previous.get(stats.broker_name)).items()):
+                row.update({'sample_time':sample_time,'program':self.program,
+                            'broker':stats.broker_name,'method':method})
+                self.db.buffered_insert(row)
+            self._previous[stats.broker_name] = snapshot
+    def shutdown(self):
+        self._stop.set()
+
+
+_writer = None
+
+
+def start_snapshots(config,**kwargs):
+    '''
+    Starts this program's SnapshotWriter if [broker] RPC_STATS_INTERVAL is set. Only the first call does anything.
+    '''
+    global _writer
+    interval = float(config.get('broker',{}).get('RPC_STATS_INTERVAL',0))
+    with _brokers_lock:
+        if _writer is not None or interval <= 0:
+            return _writer
+        _writer = SnapshotWriter(config,interval,**kwargs)
+    _writer.start()
+    return _writer
@@ -2,26 +2,22 @@
 
 #Built in Modules
 from __future__ import print_function
+import importlib
 import logging
 import os
-import pprint
 import socket
 import sys
 import threading
 import time
-#Installed Modules
-from configobj import ConfigObj
-from optparse import OptionParser
-#Custom Modules
-import avp_broker
-
+# pprint, optparse, configobj and the broker modules are imported where they are used, so that
+# programs which only need the database or a helper function here start quickly (see bench_imports.py).
 
 
 class AVPContext(object):
     ''' Provides a context object which contains some or all the device objects
     associated with the avp
-    Public Methods: verbose, startup, shutdown
-    Instance Variables: debug_mode
+    Public Methods: verbose, startup, get_tokens, shutdown
+    Instance Variables: debug_mode, STARTUP_TIMEOUT
     '''
     
     # This is nested tuples and not a dictionary because the order is important.
@@ -48,6 +44,9 @@ class AVPContext(object):
             self.logger.setLevel(logging.INFO)
         token_name = "AVPContext"
         self.brokers = []
+        self._brokers_lock = threading.Lock()
+        # Seconds each broker client has to start, counted from when startup() is called
+        self.STARTUP_TIMEOUT = float(self.config.get('broker',{}).get('STARTUP_TIMEOUT',60))
         self.program_name = program_name + ".{0}".format(self.__class__.__name__)
         # Set up broker_config will replace (BROKER_CLASSES)
         self.broker_config = [] # needs to be ordered, so no dictionary
@@ -79,34 +78,65 @@ class AVPContext(object):
         except:
             startup_l = startup #Otherwise just assume it is a list
         self.debug_mode = kwargs.get('debug_mode',False)
-        # Start up brokers
+        # Start up brokers, all at once so that a slow or missing broker only delays itself.
+        deadline = time.time() + self.STARTUP_TIMEOUT
+        threads = []
         for info_set in self.broker_config:
             # Each info_set is a dictionary
             broker = info_set['instance']
             broker_class = info_set['broker_class']
             if broker in startup_l or 'all' in startup_l:
-                # If you are having problems, get rid of this try temporarily as it seems to hide a lot
-                try:
-                    self.start_broker(broker,broker_class,check_defaults=check_defaults)
-                except AttributeError as e:
-                    # This happens if the broker is not ready for the client
-                    self.logger.info("Could not start {0}. Waiting {1}s to try again.{2}".format(broker,self.BROKER_WAIT_TIME,e))
-                    time.sleep(self.BROKER_WAIT_TIME)
-                    try:
-                        self.start_broker(broker,broker_class,check_defaults=check_defaults)
-                    except AttributeError as e:
-                        self.logger.error("Could not start {broker} broker client. {e}".format(broker=broker,e=e))
+                thread = threading.Thread(target=self._start_with_retry,name='startup.{0}'.format(broker),
+                                          args=(broker,broker_class,check_defaults,deadline))
+                thread.daemon = True
+                thread.start()
+                threads.append((broker,thread))
+        for broker,thread in threads:
+            thread.join(max(deadline - time.time(),0))
+            if thread.is_alive():
+                self.logger.error("{0} broker client did not start within {1}s.".format(broker,self.STARTUP_TIMEOUT))
+        with self._brokers_lock:
+            # Keep the config file order
+            order = [info_set['instance'] for info_set in self.broker_config]
+            self.brokers.sort(key=lambda name: order.index(name) if name in order else len(order))
         return self.brokers
-    def start_broker(self,broker_name,broker_class,check_defaults=False):
+    def _start_with_retry(self,broker,broker_class,check_defaults,deadline):
+        while True:
+            # If you are having problems, get rid of this try temporarily as it seems to hide a lot
+            try:
+                return self.start_broker(broker,broker_class,check_defaults=check_defaults,deadline=deadline)
+            except AttributeError as e:
+                # This happens if the broker is not ready for the client
+                wait = min(self.BROKER_WAIT_TIME,deadline - time.time())
+                if wait <= 0:
+                    self.logger.error("Could not start {broker} broker client. {e}".format(broker=broker,e=e))
+                    return
+                self.logger.info("Could not start {0}. Waiting {1:.0f}s to try again.{2}".format(broker,wait,e))
+                time.sleep(wait)
+            except Exception as e:
+                self.logger.error("Could not start {broker} broker client. {e}".format(broker=broker,e=e))
+                return
+    def start_broker(self,broker_name,broker_class,check_defaults=False,deadline=None):
+        '''
+        Instantiates a broker client and adds it to the context.
+        If deadline (a time.time()) has passed by the time the client is ready, startup() has given
+        up on it, so it is shut down rather than added.
+        '''
         if broker_name in self.brokers:
             self.logger.debug("Already have {broker} broker client".format(broker=broker_name))
         elif broker_class is not None:
             self.logger.debug("Starting up {broker} broker client".format(broker=broker_name))
-            broker_class = getattr(avp_broker,broker_class)
+            broker_class = self._broker_class(broker_name,broker_class)
             # Instantiate new broker!
-            setattr(self, broker_name,
-                broker_class(self.config,program_name=self.program_name,check_defaults=check_defaults,debug_mode=self.debug_mode))
-            self.brokers.append(broker_name)
+            client = broker_class(self.config,program_name=self.program_name,check_defaults=check_defaults,debug_mode=self.debug_mode)
+            if deadline is not None and time.time() > deadline:
+                self.logger.warning('{0} broker client was ready too late. Shutting down instance'.format(broker_name))
+                client.unsubscribe_all()
+                threading.Thread(target=client.disconnect).start()
+                return
+            with self._brokers_lock:
+                setattr(self, broker_name, client)
+                self.brokers.append(broker_name)
             if getattr(self,broker_name).connected() is False:
                 # We were unable to connect, so broker is crippled. Do some cleanup
                 self.logger.warning('{0} was unable to connect to broker. Shutting down instance'.format(broker_name))
@@ -114,6 +144,66 @@ class AVPContext(object):
         else:
             #broker not enabled
             pass
+    def _broker_class(self,broker_name,class_name):
+        '''
+        Returns the broker client class, importing its module the first time it is needed.
+        Classes are looked for in the module named in the broker's BROKER_CLIENT entry (on its own,
+        then in the brokers package) and then in avp_broker, which has all of them.
+        '''
+        module_names = []
+        for info_set in self.broker_config:
+            if info_set['instance'] == broker_name:
+                module_names.extend([info_set['module'],'brokers.{0}'.format(info_set['module'])])
+        module_names.append('avp_broker')
+        for module_name in module_names:
+            try:
+                module = importlib.import_module(module_name)
+            except ImportError as e:
+                self.logger.debug("Could not import {0} for {1} ({2})".format(module_name,broker_name,e))
+                continue
+            if hasattr(module,class_name):
+                return getattr(module,class_name)
+        raise AttributeError("No broker client class {0} in {1}".format(class_name,module_names))
+    def get_tokens(self,requests,calling_obj=None,program_name=None,**kwargs):
+        '''
+        Acquires the token from several brokers at once, rather than one broker after another.
+        Arguments:
+        requests        -- List of (broker name,override) pairs, see _BrokerClient.get_token
+        calling_obj     -- Passed to each get_token
+        program_name    -- Passed to each get_token, defaults to the context's program_name
+        Returns {broker name:get_token result}. Brokers not in the context get an error acquire_result.
+        If any token can't be acquired, the ones this call acquired are released again and their
+        results get 'released':True, so nothing is left holding a token for work which won't happen.
+        Tokens which were already held before the call are kept.
+        '''
+        if program_name is None: program_name = self.program_name
+        results = {}
+        held = set() # Brokers whose token we had before this call, they are never released here
+        threads = []
+        for broker_name,override in requests:
+            client = getattr(self,broker_name,None)
+            if client is None:
+                results[broker_name] = {'acquire_result':{'error':{'message':'No {0} broker client'.format(broker_name),'code':0}}}
+                continue
+            def acquire(broker_name=broker_name,client=client,override=override):
+                results[broker_name] = client.get_token(program_name=program_name,calling_obj=calling_obj,
+                                                        override=override,**kwargs)
+            if client.token_held("{0}.{1}".format(program_name,calling_obj)):
+                held.add(broker_name)
+                acquire() # Nothing to wait for
+                continue
+            thread = threading.Thread(target=acquire,name='get_token.{0}'.format(broker_name))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if any('error' in result.get('acquire_result',{}) for result in list(results.values())):
+            for broker_name,result in list(results.items()):
+                if result.get('acquire_result',{}).get('result') == 'ok' and broker_name not in held:
+                    getattr(self,broker_name).tokenRelease(**kwargs)
+                    result['released'] = True
+        return results
     def shutdown(self,shutdown=''):
         try:
             args_l = shutdown.split() #Convert to a list if a string....
@@ -127,15 +217,18 @@ class AVPContext(object):
                     this_obj = getattr(self,instance_name)
                     this_obj.unsubscribe_all()
                     threading.Thread(target=this_obj.disconnect).start()
-                    try:
-                        self.brokers.remove(instance_name)
-                    except:
-                        pass
+                    with self._brokers_lock:
+                        try:
+                            self.brokers.remove(instance_name)
+                        except:
+                            pass
 def get_config(option_set=None):
     ''' Get command line options
 
     option_set -- ([avp_cast,][,console,])
     '''
+    from optparse import OptionParser
+    from configobj import ConfigObj
     parser = OptionParser("usage: %prog [options] arg1 arg2")
     parser.set_defaults(configfile='./{hostname}_avp.ini'.format(hostname=socket.gethostname()),verbose=False,debug_mode=False)
     parser.add_option("-c", "--config", action="store", type="string",
@@ -203,6 +296,7 @@ def print_dict(input_dict,tab_size=1,width=124):
     '''
     formats a dictionary so that nesting can more easily be seen.
     '''
+    import pprint
     pp = pprint.PrettyPrinter(indent=tab_size,width=width)
     return pp.pformat(input_dict)
     #------------------------------------------------------OLD WAY BELOW
@@ -725,6 +725,7 @@ class Winch(object):
         # Some database stuff
         select_columns = ('value',)
         where_condition = {'broker':self.mm3.BROKER_NAME,'param':'stop_reason'}
+        stop_reason_match = dict(where_condition) # where_condition gets changed by select and update
         # Other variables we will need in our loop
         stop_reason = {'stop_code':None,'stop_desc':None} # If we have a reason, there will be two items. The stop_code, and a stop_desc.
         iterations = 0 # times through the while loop
@@ -762,15 +763,18 @@ class Winch(object):
             # Look for external stop notifications, usually due to callbacks
             if ipc_poll is True: # And it usually is...
                 try: 
-                    poll_result = self.mm3.ipc_db.poll(debug_mode=debug_mode)
+                    poll_result = self.mm3.ipc_db.poll(match=stop_reason_match,debug_mode=debug_mode)
                     if poll_result:
                         if debug_mode: print("monitor_move poll result {0}".format(poll_result))
                         try:
-                            select_result = self.mm3.ipc_db.select(select_columns,
-                                                                   fetch_type='one',
-                                                                   where_condition=where_condition,
-                                                                   **kwargs)
-                            select_result = select_result[0]
+                            if 'value' in poll_result: # The notification has the new stop_reason
+                                select_result = poll_result['value']
+                            else: # Old style notification, so we have to look
+                                select_result = self.mm3.ipc_db.select(select_columns,
+                                                                       fetch_type='one',
+                                                                       where_condition=where_condition,
+                                                                       **kwargs)
+                                select_result = select_result[0]
                             if select_result:
                                 self.stop_reason = select_result
                                 stop_reason['stop_code'] = 'ipc_conn'
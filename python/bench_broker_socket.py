@@ -0,0 +1,103 @@
+#! /usr/bin/env python
+#-------------------------------------------------------------------------------
+# Name:        bench_broker_socket
+# Purpose:     Measures how many subscription notifications per second make it through
+#              avp_broker.SocketHandler and _SubscriptionHandler.
+#              A local server thread sends pre-encoded notifications as fast as the
+#              socket will take them, the same shape the java brokers send.
+#              Nothing here talks to a real broker or the database.
+#
+#              usage: bench_broker_socket.py [number of notifications] [parameters per notification]
+#              Set AVP_JSON_CODEC=json to compare against the standard library codec.
+#
+# Author:      whipple
+#
+# Created:     10/19/2026
+#-------------------------------------------------------------------------------
+#Built in Modules
+import json
+import logging
+import socket
+import sys
+import threading
+import time
+#Custom Modules
+import avp_broker
+
+
+def _server(listener,notifications):
+    conn,address = listener.accept()
+    conn.sendall(notifications)
+    time.sleep(60) # Hold the connection open until the client is done
+    conn.close()
+
+def _notifications(count,n_params):
+    '''
+    Returns count newline terminated verbose notifications like the sonde broker sends.
+    '''
+    lines = []
+    for i in range(count):
+        params = {'message_time':{'value':20261019120000000 + i,'units':'America/New_York'}}
+        for p in range(n_params):
+            params['param_{0}'.format(p)] = {'value':i * 0.001 + p,'sample_time':20261019120000000 + i,'units':'m'}
+        lines.append(json.dumps({'method':'subscription','params':params}))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+def _time_socket_handler(notifications,count,subscriptions=None,n_params=0):
+    '''
+    Returns (seconds,values published). With subscriptions, a _SubscriptionHandler is run too
+    and the clock stops when it has published every value, otherwise when SocketHandler has
+    queued every notification.
+    '''
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('localhost',0))
+    listener.listen(1)
+    server = threading.Thread(target=_server,args=(listener,notifications))
+    server.daemon = True
+    server.start()
+    processed = [0]
+    def publisher(data_item):
+        processed[0] += 1
+    rx_r,rx_n = {},[]
+    socket_handler = avp_broker.SocketHandler('localhost',listener.getsockname()[1],rx_r,rx_n,5,'bench')
+    sub_handler = None
+    if subscriptions:
+        sub_handler = avp_broker._SubscriptionHandler(rx_n,subscriptions,{},'bench',publisher=publisher)
+        sub_handler.start()
+    start_time = time.time()
+    socket_handler.start()
+    while time.time() - start_time < 120:
+        if sub_handler and processed[0] >= count * n_params:
+            break
+        if sub_handler is None and len(rx_n) >= count:
+            break
+        time.sleep(0.001)
+    elapsed = time.time() - start_time
+    socket_handler.shutdown()
+    if sub_handler:
+        sub_handler.shutdown()
+    listener.close()
+    return elapsed,processed[0]
+
+def run(count=20000,n_params=10):
+    notifications = _notifications(count,n_params)
+    logger = logging.getLogger('bench')
+    subscriptions = {}
+    for p in range(n_params):
+        name = 'param_{0}'.format(p)
+        subscriptions[name] = avp_broker._DataItem('bench',name,'RO','m',logger,None,None)
+    codec = getattr(avp_broker,'avp_codec',None)
+    print("codec:          {0}".format(codec.NAME if codec else 'json (no codec layer)'))
+    print("notifications:  {0} x {1} parameters, {2} bytes".format(count,n_params,len(notifications)))
+    elapsed,processed = _time_socket_handler(notifications,count)
+    print("SocketHandler:  {0:9.0f} notifications/s".format(count / elapsed))
+    elapsed,processed = _time_socket_handler(notifications,count,subscriptions,n_params)
+    print("End to end:     {0:9.0f} notifications/s ({1} of {2} values)".format(
+           processed / n_params / elapsed,processed,count * n_params))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
+    logging.disable(logging.INFO) # SocketHandler logs its own shutdown at INFO
+    args = [int(arg) for arg in sys.argv[1:3]]
+    run(*args)
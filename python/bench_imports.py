@@ -0,0 +1,65 @@
+#! /usr/bin/env python
+#-------------------------------------------------------------------------------
+# Name:        bench_imports
+# Purpose:     Measures how long it takes to import the modules that cron launched programs
+#              start with, each in a fresh interpreter, and which imports cost the most.
+#              Nothing is run, connected to or written; only the module level code is timed.
+#
+#              usage: bench_imports.py [number of runs] [module [module ...]]
+#              Defaults to 5 runs of avp_cast, db_trim and ping_test.
+#
+# Author:      whipple
+#
+# Created:     10/19/2026
+#-------------------------------------------------------------------------------
+#Built in Modules
+import os
+import subprocess
+import sys
+
+MODULES = ('avp_cast','db_trim','ping_test')
+TOP_IMPORTS = 8 # How many of the slowest imports to list
+
+
+def _import_times(module):
+    '''
+    Imports module in a new interpreter with -X importtime.
+    Returns (total microseconds,{imported module:self microseconds}).
+    '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run([sys.executable,'-X','importtime','-c','import {0}'.format(module)],
+                            cwd=here,stdout=subprocess.DEVNULL,stderr=subprocess.PIPE,universal_newlines=True)
+    total = None
+    self_times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us,cumulative_us,name = line[len('import time:'):].split('|')
+        self_times[name.strip()] = int(self_us)
+        if name.strip() == module:
+            total = int(cumulative_us)
+    if total is None:
+        raise RuntimeError("Could not import {0}: {1}".format(module,result.stderr.strip().splitlines()[-1:]))
+    return total,self_times
+
+def run(runs=5,modules=MODULES):
+    for module in modules:
+        totals = []
+        self_times = {}
+        for i in range(runs):
+            total,times = _import_times(module)
+            totals.append(total)
+            for name,self_us in list(times.items()):
+                self_times[name] = self_times.get(name,0) + self_us
+        totals.sort()
+        print("{0:<12} median {1:7.1f} ms, min {2:7.1f} ms over {3} runs".format(
+               module,totals[len(totals) // 2] / 1000.0,totals[0] / 1000.0,runs))
+        slowest = sorted(list(self_times.items()),key=lambda item: item[1],reverse=True)[:TOP_IMPORTS]
+        for name,self_us in slowest:
+            print("    {0:<30} {1:7.1f} ms".format(name,self_us / 1000.0 / runs))
+
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    modules = sys.argv[2:] or MODULES
+    run(runs,modules)
@@ -1,211 +1,751 @@
+#! /usr/bin/env python
+#-------------------------------------------------------------------------------
+# Name:        py_broker
+# Purpose:     Pure python broker server. Speaks the same JSON-RPC protocol as the java
+#              brokers (javp edu.unc.ims.avp.Broker), so avp_broker._BrokerClient can't
+#              tell them apart, but runs as a single asyncio process with no JVM.
+#              An instrument is brokered by writing a BrokerAdapter (or SerialAdapter)
+#              subclass and naming it in the broker's section of the config file:
+#                  [sounder]
+#                      PORT = 8884
+#                      PY_ADAPTER = py_broker, NmeaSounderAdapter
+#                      SERIAL_PORT = /dev/ttyS3
+#                      BAUD = 4800
+#              usage: py_broker.py <ini-file> <broker name>
+#
+#              Subscriptions follow the java broker: values are checked every
+#              min_update_ms and sent 'on_new' (every check) or 'on_change'. Unlike
+#              the java broker, an unchanged value is also re-sent every max_update_ms.
+#
+# Author:      whipple
+#
+# Created:     10/19/2026
+#-------------------------------------------------------------------------------
 #Built in Modules
-from datetime import datetime,timedelta
+import asyncio
+from datetime import datetime
+import importlib
 import json
 import logging
-from select import select as sselect
-import socket
-import threading
+import os
+import signal
+import sys
 import time
-
 #Installed Modules
+from configobj import ConfigObj
+try:
+    import serial # pyserial, only needed by SerialAdapter
+except ImportError:
+    serial = None
+#Custom Modules
+# avp_codec and avp_db are in the python directory above this one.
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import avp_codec
+import avp_db
+
+# Error codes and messages, see javp BrokerError.java
+E_PARSE = -32700
+E_UNSUPPORTED_METHOD = -32601
+E_PARAMS_PARSE = -32602
+E_SYSTEM_ERROR = -31999
+E_TIMEOUT = -31998
+E_IO = -31997
+E_CONNECTION = -31994
+E_EXCEPTION = -31990
+E_METHOD_PARSE = -31988
+E_ID_PARSE = -31987
+E_UNSUPPORTED_SET_PARAM = -31979
+E_SET_PARAM_RO = -31978
+E_UNSUPPORTED_VALUE = -31977
+E_UNSUPPORTED_STATUS_PARAM = -31969
+E_STYLE_PARSE = -31968
+E_UNSUPPORTED_SUB_PARAM = -31959
+E_SUB_INTERVAL = -31958
+E_UPDATES_PARSE = -31957
+E_SUB_NOT_FOUND = -31939
+E_TOKEN_NOT_AVAILABLE = -31929
+E_TOKEN_REQUIRED = -31928
+E_BROKER_IS_SUSPENDED = -31917
+ERROR_MESSAGES = {
+    E_PARSE:'Parse error.',
+    E_UNSUPPORTED_METHOD:'Method not supported.',
+    E_PARAMS_PARSE:'"params" could not be parsed.',
+    E_SYSTEM_ERROR:'System error.',
+    E_TIMEOUT:'Response from instrument timed out.',
+    E_IO:'Instrument I/O error.',
+    E_CONNECTION:'Broker not connected to instrument.',
+    E_EXCEPTION:'Unspecified python exception.',
+    E_METHOD_PARSE:'"method" could not be parsed.',
+    E_ID_PARSE:'"id" could not be parsed.',
+    E_UNSUPPORTED_SET_PARAM:'Set parameter not supported.',
+    E_SET_PARAM_RO:'Set parameter is read-only.',
+    E_UNSUPPORTED_VALUE:'Parameter value not supported.',
+    E_UNSUPPORTED_STATUS_PARAM:'Status parameter not supported.',
+    E_STYLE_PARSE:'"style" could not be parsed.',
+    E_UNSUPPORTED_SUB_PARAM:'Subscribe parameter not supported.',
+    E_SUB_INTERVAL:'Subscription "min_update_ms" greater than "max_update_ms".',
+    E_UPDATES_PARSE:'"updates" could not be parsed.',
+    E_SUB_NOT_FOUND:'No such subscription in unsubscribe request.',
+    E_TOKEN_NOT_AVAILABLE:'Another listener currently has the control token.',
+    E_TOKEN_REQUIRED:'Control token required for requested method.',
+    E_BROKER_IS_SUSPENDED:'Broker is suspended'}
+# Methods which need the control token (see Broker.java and BrokerRequest.java)
+RESTRICTED_METHODS = ('shutdown','connect','disconnect','softReset','tokenRelease','suspend','resume',
+                      'power','sampling','logging','set')
+# Methods which still work while the broker is suspended
+SUSPENDED_METHODS = ('tokenAcquire','tokenForceAcquire','tokenRelease','tokenOwner','power','sampling',
+                     'logging','shutdown','suspend','resume','broker_status')
+SUBSCRIPTION_RANGE = 4 # max_update_ms = min_update_ms * SUBSCRIPTION_RANGE if only one is given
+MAX_WRITE_BUFFER = 1048576 # Drop a client which has stopped reading once this much is waiting for it
+
+
+class BrokerError(Exception):
+    '''
+    Raised by adapters and the broker. Becomes a JSON-RPC error object.
+    '''
+    def __init__(self,code,data=None):
+        self.code = code
+        self.data = data
+        super(BrokerError,self).__init__(ERROR_MESSAGES.get(code,'Unknown error.'))
+    def to_dict(self):
+        error = {'code':self.code,'message':str(self)}
+        if self.data:
+            error['data'] = self.data
+        return error
 
-class SocketHandler(threading.Thread):
+def ts_value(t=None):
+    '''
+    Time as a long in the brokers' yyyyMMddHHmmssSSS format.
     '''
-    Handles sending jSON strings and awaiting replys via the public send_rpc() method.
-    
+    if t is None:
+        t = time.time()
+    return int(time.strftime('%Y%m%d%H%M%S',time.localtime(t)) + '{0:03d}'.format(int((t % 1) * 1000)))
+
+def tz_name():
+    return time.strftime('%Z')
+
+
+class BrokerAdapter(object):
+    '''
+    Base class for instruments, the equivalent of javp's BrokerAdapter.
+    Subclasses set PARAMETERS and override connect(), disconnect(), is_connected(), put()
+    and poll() as needed. New readings are passed to update(). Extra JSON-RPC methods are
+    coroutines named rpc_<method> which take the request's params and return a result.
+
     Arguments:
-        host        -- Host to connect to
-        PORT        -- Port to connect to
-        rx_rpc      -- Shared list of received JSON-RPC messages (dicts)
-        tx_reply    -- Shared list of messages (dict) to be transmitted
-        so_timeout  -- Default socket timeout.
-        broker_name -- Used for naming thread
-    Instance attributes:
-        connected   -- Are we connected to broker server
-        
-    '''
-    def __init__(self, host, PORT, rx_rpc, tx_reply, broker_name):
+        config      -- ConfigObj
+        broker_name -- Section of config for this broker
+    Class Variables:
+        PARAMETERS          -- {name:(units,type)}, type is one of 'RO','RW','WO'
+        RESTRICTED_METHODS  -- rpc_ methods which need the control token
+        MIN_SUB_INTERVAL    -- Fastest subscription update (ms)
+        POLL_INTERVAL       -- If not None, poll() is called this often (s)
+    Public Methods: connect, disconnect, is_connected, poll, get, put, update, wait_for_data,
+                    set_power, set_sampling, set_logging, soft_reset
+    Instance Variables: values, version, suspended, power_on, sampling, logging, last_data_time, last_db_time
+    '''
+    PARAMETERS = {}
+    RESTRICTED_METHODS = ()
+    MIN_SUB_INTERVAL = 250
+    POLL_INTERVAL = None
+    def __init__(self,config,broker_name,**kwargs):
+        self.debug_mode = kwargs.get('debug_mode',False)
         self.logger = logging.getLogger(self.__class__.__name__)
-        self.host = host
-        self.PORT = PORT
-        self.rx_rpc = rx_rpc
-        self.tx_reply = tx_reply
-        self.so_timeout = 0
+        if self.debug_mode is False:
+            self.logger.setLevel(logging.INFO)
+        self.config = config
         self.broker_name = broker_name
-        self.running = False
-        self.connected = False
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        super(SocketHandler,self).__init__()
-        self.name = "{0}.{1}".format(self.broker_name,self.__class__.__name__)
-    def send_rpc(self, response, error=False,json_id,timeout=None,**kwargs):
-        '''
-        
-        '''
-        debug_mode = kwargs.get('debug_mode',False)
-        if not self.connected:
-            error_msg = '{0} not connected to broker.'.format(self.name)
-            self.logger.error(error_msg)
-            return 0
-        if error:
-            self.msg = {'error':response, 'id':json_id}
-        else:
-            self.msg = {'result':response, 'id':json_id}
-        if debug_mode: print "send_rpc message:{0}".format(self.msg)
-        self._send(json.dumps(self.msg))
-        return 1
-    def _send(self, data):
-        if not self.running:
-            self.logger.debug("Socket not connected.")
+        self.values = {} # name:(value,sample_time)
+        self.version = 0 # Counts update() calls
+        self.suspended = False
+        self.power_on = 'unknown'
+        self.sampling = False
+        self.logging = False
+        self.last_data_time = None
+        self.last_db_time = None
+        self._new_data = None
+    async def connect(self):
+        pass
+    async def disconnect(self):
+        pass
+    def is_connected(self):
+        return True
+    async def poll(self):
+        '''
+        Called every POLL_INTERVAL seconds for instruments which have to be asked for data.
+        '''
+        pass
+    async def soft_reset(self):
+        pass
+    async def set_power(self,on):
+        raise BrokerError(E_UNSUPPORTED_METHOD)
+    async def set_sampling(self,on):
+        self.sampling = on
+    async def set_logging(self,on):
+        self.logging = on
+    def get(self,name):
+        '''
+        Returns (value,sample_time) of the most recent reading of name.
+        '''
+        return self.values.get(name,(None,None))
+    async def put(self,name,value):
+        '''
+        Sets a RW or WO parameter. The default just records the value.
+        '''
+        self.update(name,value)
+    def update(self,name,value,sample_time=None):
+        '''
+        Records a new reading and wakes up any on_change subscriptions.
+        '''
+        now = time.time()
+        self.values[name] = (value,ts_value(sample_time or now))
+        self.version += 1
+        self.last_data_time = now
+        if self._new_data is not None:
+            self._new_data.set()
+            self._new_data = None
+    async def wait_for_data(self,timeout,version=None):
+        '''
+        Waits up to timeout seconds for the next update(). Returns at once if there
+        has already been one since version was read.
+        '''
+        if version is not None and version != self.version:
             return
+        if self._new_data is None:
+            self._new_data = asyncio.Event()
         try:
-            self.socket.send(data)
-        except Exception,e:
-            self.running = False
-            self.logger.debug('{0}.send broker failed ({1}).'.format(self.name,e))
-    def shutdown(self):
-        self.running = False
-        time.sleep(1)
-        self.logger.debug("Shutting down {0:24} {1:2} threads left..".format(self.name,threading.active_count()))
-    def start(self):
-        address = (self.host,self.PORT)
-        # This should be in a try, so if we get "socket.error: [Errno 111] Connection refused" or some other error it is handled.
-        try:
-            self.socket.connect(address)
-        except Exception,e:
-            self.logger.debug("{0}.start, connection to {1}, failed ({2}).".format(self.name,address,e))
-            self.shutdown()
-        self.sf = self.socket.makefile('r')
-        self.running = True
-        self.connected = True
-        super(SocketHandler,self).start() #threading.Thread.start(self)
-        self.logger.debug("Started up {0:24} {1:2} active threads.".format(self.name,threading.active_count()))
-    def run(self):
-        '''
-        Listens for JSON messages and puts them into rx_r with their id as the key
-        '''
-        while(self.running):
-            # See ifthere are any messages for us...
+            await asyncio.wait_for(self._new_data.wait(),timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+class SerialAdapter(BrokerAdapter):
+    '''
+    Base class for line oriented serial instruments. Needs pyserial.
+    Subclasses implement parse_line(). Command/response instruments can use command().
+    Config (broker section): SERIAL_PORT, BAUD
+    Public Methods: parse_line, write, command
+    '''
+    EOL = b'\r\n'
+    def __init__(self,config,broker_name,**kwargs):
+        super(SerialAdapter,self).__init__(config,broker_name,**kwargs)
+        broker_config = config.get(broker_name,{})
+        self.SERIAL_PORT = broker_config.get('SERIAL_PORT',None)
+        self.BAUD = int(broker_config.get('BAUD',9600))
+        self.serial = None
+        self._buffer = bytearray()
+        self._response = None # Future for command()
+    async def connect(self):
+        if serial is None:
+            raise BrokerError(E_CONNECTION,'pyserial is not installed')
+        self.serial = serial.Serial(self.SERIAL_PORT,self.BAUD,timeout=0)
+        asyncio.get_event_loop().add_reader(self.serial.fileno(),self._read_ready)
+        self.logger.info("Connected to {0} at {1} baud".format(self.SERIAL_PORT,self.BAUD))
+    async def disconnect(self):
+        if self.serial is not None:
             try:
-                [item_1, item_2, item_3] = sselect([self.sf],[],[], 1)
-                if(len(item_1) > 0):
-                    self.jrx = self.sf.readline()[:-1]
-                    self.rx = json.loads(self.jrx)
-                    self.rxid = self.rx.get("id",-1) 
-                    if(self.rxid != -1):
-                        self.rx_rpc.append([self.rx])
-                    else:
-                        pass# What do we do if there is no ID?
-                        #self.rx_r.append(self.rx)
-            except Exception,e:
-                self.running = False
+                asyncio.get_event_loop().remove_reader(self.serial.fileno())
+                self.serial.close()
+            except (IOError,OSError,ValueError):
+                pass
+        self.serial = None
+    def is_connected(self):
+        return self.serial is not None and self.serial.is_open
+    def _read_ready(self):
+        try:
+            data = self.serial.read(self.serial.in_waiting or 1)
+        except (IOError,OSError) as e:
+            self.logger.error("Lost {0}: {1}".format(self.SERIAL_PORT,e))
+            asyncio.ensure_future(self.disconnect())
+            return
+        self._buffer += data
+        while True:
+            end = self._buffer.find(self.EOL)
+            if end < 0:
                 break
-            # Now are there any messages to send 
-            if tx_reply:
-                for response in tx_reply:
-                    self.send_rpc(
-        self.connected = False
-        self.sf.close()
-        self.socket.close()
-        
-class _MethodHandler(threading.Thread):
-    '''
-    Monitors rx_rpc and performs the correct actions
-    '''
-    GENERIC_METHODS = ('status','subscribe','unsubscribe','set','list_data','broker_status')
-    def __init__(self, rx_rpc, tx_reply,subscriptions,broker_name,broker_methods={}):
+            line = bytes(self._buffer[:end]).decode('ascii','replace').strip()
+            del self._buffer[:end + len(self.EOL)]
+            if not line:
+                continue
+            if self._response is not None and not self._response.done():
+                self._response.set_result(line)
+                continue
+            try:
+                self.parse_line(line)
+            except Exception as e:
+                self.logger.debug("Could not parse {0!r}: {1}".format(line,e))
+    def parse_line(self,line):
+        '''
+        Called with every line the instrument sends which isn't a command() response.
+        Command/response instruments don't need to override this, unexpected lines are just logged.
+        '''
+        self.logger.debug("Ignoring {0!r}".format(line))
+    def write(self,data):
+        if not self.is_connected():
+            raise BrokerError(E_CONNECTION)
+        if not isinstance(data,bytes):
+            data = data.encode('ascii')
+        self.serial.write(data)
+    async def command(self,data,timeout=2):
+        '''
+        Writes data and returns the next line from the instrument.
+        '''
+        self._response = asyncio.get_event_loop().create_future()
+        self.write(data)
+        try:
+            return await asyncio.wait_for(self._response,timeout)
+        except asyncio.TimeoutError:
+            raise BrokerError(E_TIMEOUT)
+        finally:
+            self._response = None
+
+
+class NmeaSounderAdapter(SerialAdapter):
+    '''
+    NMEA 0183 depth sounder (DPT, DBT and MTW sentences). Same parameters as javp's SounderAdapter.
+    '''
+    PARAMETERS = {'water_depth':('meters','RO'),
+                  'water_temp_surface':('degrees C','RO')}
+    def parse_line(self,line):
+        if not line.startswith('$'):
+            return
+        fields = line.split('*')[0].split(',')
+        sentence = fields[0][3:]
+        if sentence == 'DPT' and fields[1]:
+            self.update('water_depth',float(fields[1]))
+        elif sentence == 'DBT' and fields[3]:
+            self.update('water_depth',float(fields[3]))
+        elif sentence == 'MTW' and fields[1]:
+            self.update('water_temp_surface',float(fields[1]))
+
+
+class _Subscription(object):
+    '''
+    One subscribe request from one client, serviced by its own task.
+    '''
+    def __init__(self,client,params,min_ms,max_ms,on_new,verbose):
+        self.client = client
+        self.params = params
+        self.min_ms = min_ms
+        self.max_ms = max_ms
+        self.on_new = on_new
+        self.verbose = verbose
+        self.task = None
+    async def run(self,broker):
+        adapter = broker.adapter
+        last = None
+        max_deadline = 0
+        while self.params and not self.client.closed:
+            now = time.time()
+            version = adapter.version
+            if not adapter.suspended:
+                values = dict((param,adapter.get(param)) for param in self.params)
+                current = dict((param,value) for param,(value,sample_time) in values.items())
+                if last is None or self.on_new or current != last or now >= max_deadline:
+                    self.client.send({'method':'subscription','params':broker.format_values(values,self.verbose)})
+                    last = current
+                    max_deadline = now + self.max_ms / 1000.0
+            await asyncio.sleep(self.min_ms / 1000.0)
+            if not self.on_new:
+                timeout = max_deadline - time.time()
+                if timeout > 0:
+                    await adapter.wait_for_data(timeout,version)
+    def remove(self,param):
+        if param in self.params:
+            self.params.remove(param)
+        if not self.params and self.task is not None:
+            self.task.cancel()
+
+
+class _ClientHandler(object):
+    '''
+    One client connection. Equivalent of javp's ControllerClientHandler.
+    '''
+    def __init__(self,reader,writer):
+        self.reader = reader
+        self.writer = writer
+        peer = writer.get_extra_info('peername') or ('?',0)
+        self.who = '{0}:{1}'.format(*peer[:2])
+        self.has_token = False
+        self.subscriptions = {} # param:_Subscription
+        self.closed = False
+    def send(self,msg):
+        if self.closed:
+            return
+        try:
+            self.writer.write(avp_codec.dumps(msg) + b'\n')
+            if self.writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+                self.closed = True
+                self.writer.close()
+        except Exception:
+            self.closed = True
+
+
+class Broker(object):
+    '''
+    asyncio JSON-RPC server for one BrokerAdapter, with the java broker's token semantics.
+
+    Arguments:
+        config      -- ConfigObj
+        broker_name -- Section of config for this broker. PORT comes from there.
+        adapter     -- BrokerAdapter instance
+    Public Methods: start, serve_forever, stop, process_request, format_values
+    Instance Variables: adapter, clients, token_owner, suspended, start_time
+    '''
+    WATCHDOG_TIME = 5 # Seconds between instrument connection checks
+    def __init__(self,config,broker_name,adapter,**kwargs):
+        self.debug_mode = kwargs.get('debug_mode',False)
         self.logger = logging.getLogger(self.__class__.__name__)
-        self.rx_rpc = rx_rpc
-        self.tx_reply = tx_reply
+        if self.debug_mode is False:
+            self.logger.setLevel(logging.INFO)
+        self.config = config
         self.broker_name = broker_name
-        self.broker_methods = broker_methods
-        self.running = False
-        self.connected = False
-        super(_MethodHandler,self).__init__()
-        self.name = "{0}.{1}".format(self.broker_name,self.__class__.__name__)
-        if not self.running:
-            self.logger.debug("Socket not connected.")
-            return
+        self.adapter = adapter
+        self.PORT = int(config.get(broker_name,{}).get('PORT',0))
+        self.LISTEN_HOST = config.get(broker_name,{}).get('LISTEN_HOST','')
+        self.clients = []
+        self.token_owner = None
+        self.token_id = ''
+        self.suspended = False
+        self.start_time = datetime.now()
+        self.server = None
+        self._tasks = []
+        self._stopped = None
+    async def start(self):
+        self._stopped = asyncio.Event()
+        self.server = await asyncio.start_server(self._handle_client,self.LISTEN_HOST or None,self.PORT)
+        self.logger.info("{0} broker listening on port {1}".format(self.broker_name,self.PORT))
+        await self._connect_adapter()
+        self._tasks.append(asyncio.ensure_future(self._watchdog()))
+        if self.adapter.POLL_INTERVAL:
+            self._tasks.append(asyncio.ensure_future(self._poll()))
+    async def serve_forever(self):
+        await self.start()
+        await self._stopped.wait()
+        await self._close()
+    def stop(self):
+        if self._stopped is not None:
+            self._stopped.set()
+    async def _close(self):
+        self.server.close()
+        for task in self._tasks:
+            task.cancel()
+        for client in list(self.clients):
+            self._drop_client(client)
+            client.writer.close()
+        await self.adapter.disconnect()
+        self.logger.info("{0} broker shut down".format(self.broker_name))
+    async def _connect_adapter(self):
         try:
-            self.socket.send(data)
-        except Exception,e:
-            self.running = False
-            self.logger.debug('{0}.send broker failed ({1}).'.format(self.name,e))
-    def shutdown(self):
-        self.running = False
-        time.sleep(1)
-        self.logger.debug("Shutting down {0:24} {1:2} threads left..".format(self.name,threading.active_count()))
-    def start(self):
-        self.running = True
-        self.connected = True
-        super(_MethodHandler,self).start() #threading.Thread.start(self)
-        self.logger.debug("Started up {0:24} {1:2} active threads.".format(self.name,threading.active_count()))
-    def run(self):
-        '''
-        Parses rx_rpc and responds as required.
-        '''
-        actionable = {}
-        while(self.running):
-            if(len(self.rx_rpc) > 0):
-                self.n = self.rx_rpc.pop()
-                reply = {'result':None,'error':{},'id':-1} # default
-                reply['id'] = self.n.get('id',-1) # Reply should have same ID as request
-                if self.n.get('method',None) not in self.GENERIC_METHODS:
-                    reply['result'],reply['error'] = self.non_generic(self.n)
-                else:#This is a generic method
-                    method = self.n.get('method')
-                    params = self.n.get('params',None)
-                    if method is 'status':
-                        data = params.get('data',[])
-                        style = params.get('style','verbose')
-                        reply['result'] = {}
-                        # Now results
-                        for data_item in data:
-                            reply['result'][data_item] = {}
-                            reply['result'][data_item]['value'] = 'Value'
-                            if style == 'verbose':
-                                reply['result'][data_item]['units'] = 'Units'
-                                reply['result'][data_item]['sample_time'] = datetime.strptime(datetime.now(), '%Y%m%d%H%M%S000').replace(tzinfo=pytz.reference.LocalTimezone())
-                    elif method is 'subscribe':
-                        data = params.get('data',[])
-                        style = params.get('style','verbose')
-                        updates = params.get('updates','on_new')
-                        max_update_ms = params.get('max_update_ms',None)
-                        min_update_ms = params.get('min_update_ms',None)
-                    elif method is 'unsubscribe':
-                        pass
-                    elif method is 'set':
-                        pass
-                    elif method is 'list_data':
-                        pass
-                    elif method is 'broker_status':
-                        pass
-                    # See if we have anything to send
-                if reply['id'] > 0:
-                    tx_reply.append(reply)
+            await self.adapter.connect()
+        except Exception as e:
+            self.logger.error("Could not connect {0}: {1}".format(self.adapter.__class__.__name__,e))
+    async def _watchdog(self):
+        while True:
+            await asyncio.sleep(self.WATCHDOG_TIME)
+            if not self.suspended and not self.adapter.is_connected():
+                await self._connect_adapter()
+    async def _poll(self):
+        while True:
+            if not self.suspended and self.adapter.is_connected():
+                try:
+                    await self.adapter.poll()
+                except Exception as e:
+                    self.logger.error("Error polling {0}: {1}".format(self.adapter.__class__.__name__,e))
+            await asyncio.sleep(self.adapter.POLL_INTERVAL)
+    #---------------------------------------------------------------------- Clients
+    async def _handle_client(self,reader,writer):
+        client = _ClientHandler(reader,writer)
+        self.clients.append(client)
+        self.logger.debug("Accepted listener: {0}".format(client.who))
+        decoder = json.JSONDecoder()
+        buffer = ''
+        try:
+            while not client.closed:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                # Clients don't terminate their requests, so decode a stream of objects.
+                buffer += data.decode('utf-8','replace')
+                while True:
+                    buffer = buffer.lstrip()
+                    if not buffer:
+                        break
+                    try:
+                        request,end = decoder.raw_decode(buffer)
+                    except ValueError:
+                        if len(buffer) > 65536:
+                            client.send({'error':BrokerError(E_PARSE).to_dict(),'id':None})
+                            buffer = ''
+                        break
+                    buffer = buffer[end:]
+                    await self.process_request(client,request)
+                await writer.drain()
+        except (ConnectionError,OSError) as e:
+            self.logger.debug("Client {0}: {1}".format(client.who,e))
+        finally:
+            self.logger.debug("Client {0} disconnected".format(client.who))
+            self._drop_client(client)
+            writer.close()
+    def _drop_client(self,client):
+        client.closed = True
+        if client in self.clients:
+            self.clients.remove(client)
+        for subscription in set(client.subscriptions.values()):
+            if subscription.task is not None:
+                subscription.task.cancel()
+        client.subscriptions.clear()
+        if self.token_owner is client:
+            self._take_token()
+    #---------------------------------------------------------------------- Requests
+    async def process_request(self,client,request):
+        '''
+        Handles one JSON-RPC request and sends the reply to client.
+        '''
+        json_id = request.get('id') if isinstance(request,dict) else None
+        if json_id is None:
+            return client.send({'error':BrokerError(E_ID_PARSE).to_dict(),'id':None})
+        method = request.get('method')
+        if not isinstance(method,str):
+            return client.send({'error':BrokerError(E_METHOD_PARSE).to_dict(),'id':json_id})
+        params = request.get('params')
+        if not isinstance(params,dict):
+            params = {} # list_data is sent ['units','type'], which the java broker ignores too
+        try:
+            if self._restricted(method) and not client.has_token:
+                raise BrokerError(E_TOKEN_REQUIRED)
+            if self.suspended and method not in SUSPENDED_METHODS:
+                raise BrokerError(E_BROKER_IS_SUSPENDED)
+            result = await self._dispatch(client,method,params)
+        except BrokerError as e:
+            return client.send({'error':e.to_dict(),'id':json_id})
+        except Exception as e:
+            self.logger.error("Error handling {0}: {1}".format(request,e))
+            return client.send({'error':BrokerError(E_EXCEPTION,str(e)).to_dict(),'id':json_id})
+        if result is not None:
+            if isinstance(result,dict):
+                message_time = {'value':ts_value()}
+                if params.get('style','verbose') == 'verbose':
+                    message_time['units'] = tz_name()
+                result.setdefault('message_time',{}).update(message_time)
+            client.send({'result':result,'id':json_id})
+    def _restricted(self,method):
+        return method in RESTRICTED_METHODS or method in self.adapter.RESTRICTED_METHODS
+    async def _dispatch(self,client,method,params):
+        if method in ('tokenAcquire','tokenForceAcquire'):
+            if self.token_owner not in (None,client) and method == 'tokenAcquire':
+                raise BrokerError(E_TOKEN_NOT_AVAILABLE,self.token_id)
+            self._take_token()
+            self.token_owner = client
+            self.token_id = params.get('name','(unnamed)')
+            client.has_token = True
+            return 'ok'
+        if method == 'tokenRelease':
+            self._take_token()
+            return 'ok'
+        if method == 'tokenOwner':
+            return self.token_id
+        if method == 'broker_status':
+            return self._broker_status()
+        if method == 'list_data':
+            result = dict((name,{'units':units,'type':data_type})
+                          for name,(units,data_type) in self.adapter.PARAMETERS.items())
+            result['message_time'] = {'units':tz_name(),'type':'RO'}
+            return result
+        if method == 'status':
+            return self._status(params)
+        if method == 'subscribe':
+            return self._subscribe(client,params)
+        if method == 'unsubscribe':
+            return self._unsubscribe(client,params)
+        if method == 'set':
+            return await self._set(params)
+        if method in ('power','sampling','logging'):
+            return await self._on_off(method,params)
+        if method == 'suspend':
+            self.suspended = self.adapter.suspended = True
+            await self.adapter.disconnect()
+            return 'ok'
+        if method == 'resume':
+            if self.suspended:
+                self.suspended = self.adapter.suspended = False
+                await self._connect_adapter()
+            if not self.adapter.is_connected():
+                raise BrokerError(E_CONNECTION)
+            return 'ok'
+        if method == 'connect':
+            await self._connect_adapter()
+            return 'ok'
+        if method == 'disconnect':
+            await self.adapter.disconnect()
+            return 'ok'
+        if method == 'softReset':
+            await self.adapter.soft_reset()
+            return 'ok'
+        if method == 'shutdown':
+            asyncio.get_event_loop().call_soon(self.stop)
+            return 'ok'
+        rpc_method = getattr(self.adapter,'rpc_{0}'.format(method),None)
+        if rpc_method is None:
+            raise BrokerError(E_UNSUPPORTED_METHOD)
+        return await rpc_method(params)
+    def _take_token(self):
+        if self.token_owner is not None:
+            self.token_owner.has_token = False
+        self.token_owner = None
+        self.token_id = ''
+    def _broker_status(self):
+        def time_str(t):
+            return datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3] if t else 'none'
+        return {'suspended':str(self.suspended).lower(),
+                'power_on':self.adapter.power_on if self.adapter.power_on == 'unknown' else str(self.adapter.power_on).lower(),
+                'instr_connected':str(self.adapter.is_connected()).lower(),
+                'db_connected':'false',
+                'start_time':self.start_time.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3],
+                'last_data_time':time_str(self.adapter.last_data_time),
+                'last_db_time':time_str(self.adapter.last_db_time)}
+    def _style(self,params):
+        style = params.get('style','verbose') or 'verbose'
+        if style not in ('verbose','terse'):
+            raise BrokerError(E_STYLE_PARSE)
+        return style == 'verbose'
+    def _data(self,params):
+        data = params.get('data')
+        if not isinstance(data,list):
+            raise BrokerError(E_PARAMS_PARSE)
+        return [param for param in data if param != 'message_time']
+    def format_values(self,values,verbose):
+        '''
+        {name:(value,sample_time)} -> status/notification result
+        '''
+        result = {}
+        for name,(value,sample_time) in values.items():
+            result[name] = {'value':value,'sample_time':sample_time}
+            if verbose:
+                result[name]['units'] = self.adapter.PARAMETERS[name][0]
+        message_time = {'value':ts_value()}
+        if verbose:
+            message_time['units'] = tz_name()
+        result['message_time'] = message_time
+        return result
+    def _status(self,params):
+        verbose = self._style(params)
+        values = {}
+        errors = {}
+        for param in self._data(params):
+            if self.adapter.PARAMETERS.get(param,(None,'WO'))[1] == 'WO':
+                errors[param] = BrokerError(E_UNSUPPORTED_STATUS_PARAM).to_dict()
             else:
-                time.sleep(self.SLEEP_TIME)
-    def non_generic(self,json_message):
-        result = None
-        error = {}
-        method = json_message.get('method',None)
-        if method in self.broker_methods:
-            params = json_message.get('params',None)
-            try:
-                result = self.broker_methods[method](params)
-            except Exception,e:
-                error['message'] = e
-                error['code'] = 1
-        else:
-            error['message'] = "No action for method {0}".format(method)
-            error['code'] = 2
-        return result,error
-if __name__ = '__main__':
-    host = 'localhost'
-    port = 3431
-    rx_rpc = []
-    tx_reply = []
-    subscriptions = {}
-    socket_handler = SocketHandler(host, PORT, rx_rpc, tx_reply,broker_name="TESTING")
-    method_handler = _MethodHandler(rx_rpc, tx_reply,subscriptions,broker_name="TESTING")
-    socket_handler.start()
-    method_handler.start()
\ No newline at end of file
+                values[param] = self.adapter.get(param)
+        result = self.format_values(values,verbose)
+        result.update(errors)
+        return result
+    def _subscribe(self,client,params):
+        data = self._data(params)
+        min_ms = params.get('min_update_ms')
+        max_ms = params.get('max_update_ms')
+        if min_ms is None and max_ms is None:
+            min_ms = self.adapter.MIN_SUB_INTERVAL
+            max_ms = min_ms * SUBSCRIPTION_RANGE
+        elif min_ms is None:
+            min_ms = max_ms // SUBSCRIPTION_RANGE
+        elif max_ms is None:
+            max_ms = min_ms * SUBSCRIPTION_RANGE
+        min_ms = max(int(min_ms),self.adapter.MIN_SUB_INTERVAL)
+        max_ms = max(int(max_ms),self.adapter.MIN_SUB_INTERVAL)
+        if min_ms > max_ms:
+            raise BrokerError(E_SUB_INTERVAL)
+        verbose = self._style(params)
+        updates = params.get('updates','on_new') or 'on_new'
+        if updates not in ('on_new','on_change'):
+            raise BrokerError(E_UPDATES_PARSE)
+        result = {}
+        accepted = []
+        for param in data:
+            if self.adapter.PARAMETERS.get(param,(None,'WO'))[1] == 'WO':
+                result[param] = dict(BrokerError(E_UNSUPPORTED_SUB_PARAM).to_dict(),status='error')
+                continue
+            if param in client.subscriptions:
+                # The java broker would start a second subscription, replace the first instead.
+                client.subscriptions.pop(param).remove(param)
+            accepted.append(param)
+            result[param] = {'status':'ok'}
+        if accepted:
+            subscription = _Subscription(client,accepted,min_ms,max_ms,updates == 'on_new',verbose)
+            for param in accepted:
+                client.subscriptions[param] = subscription
+            subscription.task = asyncio.ensure_future(subscription.run(self))
+        result['min_update_ms'] = min_ms
+        result['max_update_ms'] = max_ms
+        return result
+    def _unsubscribe(self,client,params):
+        result = {}
+        for param in self._data(params):
+            if param not in self.adapter.PARAMETERS:
+                result[param] = dict(BrokerError(E_UNSUPPORTED_SUB_PARAM).to_dict(),status='error')
+            elif param not in client.subscriptions:
+                result[param] = dict(BrokerError(E_SUB_NOT_FOUND).to_dict(),status='error')
+            else:
+                client.subscriptions.pop(param).remove(param)
+                result[param] = {'status':'ok'}
+        return result
+    async def _set(self,params):
+        result = {}
+        for param,value in params.items():
+            data_type = self.adapter.PARAMETERS.get(param,(None,None))[1]
+            if data_type is None:
+                result[param] = dict(BrokerError(E_UNSUPPORTED_SET_PARAM).to_dict(),status='error')
+            elif data_type == 'RO':
+                result[param] = dict(BrokerError(E_SET_PARAM_RO).to_dict(),status='error')
+            else:
+                try:
+                    await self.adapter.put(param,value)
+                    result[param] = {'status':'ok'}
+                except BrokerError as e:
+                    result[param] = dict(e.to_dict(),status='error')
+        return result
+    async def _on_off(self,method,params):
+        adapter = self.adapter
+        status = str(params.get('status','')).lower()
+        if status in ('on','off'):
+            await getattr(adapter,'set_{0}'.format(method))(status == 'on')
+        state = {'power':adapter.power_on,'sampling':adapter.sampling,'logging':adapter.logging}[method]
+        if state == 'unknown':
+            return state
+        return 'on' if state else 'off'
+
+
+def load_adapter(config,broker_name,**kwargs):
+    '''
+    Instantiates the class named by PY_ADAPTER = module, ClassName in the broker's section.
+    '''
+    module_name,class_name = config.get(broker_name,{}).get('PY_ADAPTER')
+    if module_name == 'py_broker':
+        adapter_class = globals()[class_name]
+    else:
+        adapter_class = getattr(importlib.import_module(module_name),class_name)
+    return adapter_class(config,broker_name,**kwargs)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print('Usage: ', sys.argv[0], ' ini-file broker-name')
+        sys.exit(1)
+    if os.path.exists(sys.argv[1]) is False:
+        print(sys.argv[1], "does not exist")
+        sys.exit(1)
+    logger = logging.getLogger('')
+    logging.basicConfig(stream=sys.stdout, level=logging.DEBUG,
+                        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s")
+    config = ConfigObj(sys.argv[1])  # Read the config file
+    dbh = avp_db.DB_LogHandler(config)
+    dbh.setLevel(logging.INFO)
+    logger.addHandler(dbh)
+    broker_name = sys.argv[2]
+    broker = Broker(config,broker_name,load_adapter(config,broker_name))
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    for signal_number in (signal.SIGTERM, signal.SIGHUP, signal.SIGQUIT, signal.SIGINT):
+        loop.add_signal_handler(signal_number,broker.stop)
+    loop.run_until_complete(broker.serve_forever())
+    logging.shutdown()
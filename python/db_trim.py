@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 #-------------------------------------------------------------------------------
 # Name:        db_trim.py
-# Purpose:     Deletes old records from <hostname>_debug_log table
+# Purpose:     Retires old records from the <hostname>_ time series tables.
+#              Tables partitioned by month (see dbscripts/avp_partitions) get their coming
+#              months' partitions made, and months older than [db] RETENTION_DAYS are dropped
+#              (or detached if RETIRE_PARTITIONS = detach). Old records are deleted from an
+#              un-partitioned <hostname>_debug_log as before.
 #
 # Author:      neve
 #
@@ -22,17 +26,64 @@ import pytz.reference
 import avp_db
 from  avp_util import get_config
 
+# Tables dbscripts/avp_partitions partitions by month, and the [db] option which names each one if not <hostname>_<table>
+PARTITIONED_TABLES = (('log','LOG_TABLE'),('debug_log','DEBUG_TABLE'),('power','POWER_TABLE'),
+                      ('sonde',None),('depth',None),('gps',None),('wind',None))
+MONTHS_AHEAD = 2 # Partitions are made this many months before they are needed
+
+def trim_partitions(db,table,days,retire='drop'):
+    '''
+    Makes table's coming partitions and drops or detaches the ones whose rows are all over days old,
+    using db (any AvpDB in the same database). If days is 0 nothing is retired.
+    Returns False if table isn't partitioned (or doesn't exist).
+    '''
+    logger = logging.getLogger('db_trim')
+    partitioned = db.execute("SELECT avp_is_partitioned(%s);",(table,))
+    if not partitioned or partitioned[0][0] is not True:
+        return False
+    made = db.execute("SELECT avp_create_partitions(%s,%s);",(table,MONTHS_AHEAD))
+    if made and made[0][0]:
+        logger.info("Made {0} new partitions of {1}".format(made[0][0],table))
+    # avp_create_partitions moves rows out of the default partition, so any left are far from now
+    stranded = db.execute("SELECT count(*) FROM {0}_default;".format(table))
+    if stranded and stranded[0][0]:
+        logger.warning("{0}_default has {1} rows which aren't in any month's partition".format(table,stranded[0][0]))
+    if days <= 0:
+        return True
+    for (partition,) in db.execute("SELECT avp_expired_partitions(%s,%s);",(table,timedelta(days=days))) or []:
+        # Detaching takes the partition out of the table without touching its rows
+        if db.execute("ALTER TABLE {0} DETACH PARTITION {1};".format(table,partition)) is None:
+            continue
+        if retire == 'detach':
+            logger.info("Detached {0} from {1}, over {2} days old".format(partition,table,days))
+        elif db.execute("DROP TABLE {0};".format(partition)) is not None:
+            logger.info("Dropped {0} from {1}, over {2} days old".format(partition,table,days))
+    return True
+
 def main(config):
     DEBUG_TABLE_DAYS = int(config.get('db',{}).get('DEBUG_TABLE_DAYS',90))
+    RETENTION_DAYS = config.get('db',{}).get('RETENTION_DAYS',{}) # table:days, 0 to keep everything
+    RETIRE_PARTITIONS = config.get('db',{}).get('RETIRE_PARTITIONS','drop')
     logger = logging.getLogger('db_trim')
     hostname = socket.gethostname()
     DEBUG_TABLE = config.get('db',{}).get('DEBUG_TABLE','{0}_debug_log'.format(hostname))
     debug_log = avp_db.AvpDB(config,table=DEBUG_TABLE)
-    trim_before = datetime.now(pytz.reference.LocalTimezone()) - timedelta(days=DEBUG_TABLE_DAYS)
-    where_condition = {'time':trim_before}
-    where_oper = '<'
-    result = debug_log.delete(where_condition=where_condition,where_oper=where_oper,debug_mode=True)
-    print(result)
+    for name,table_option in PARTITIONED_TABLES:
+        table = '{0}_{1}'.format(hostname,name)
+        if table_option is not None:
+            table = config.get('db',{}).get(table_option,table)
+        days = int(RETENTION_DAYS.get(name,DEBUG_TABLE_DAYS if name == 'debug_log' else 0))
+        if trim_partitions(debug_log,table,days,retire=RETIRE_PARTITIONS):
+            continue
+        if name == 'debug_log' and days > 0:
+            # Not partitioned yet, so delete the old rows. 0 keeps everything, as for the partitioned tables.
+            trim_before = datetime.now(pytz.reference.LocalTimezone()) - timedelta(days=days)
+            where_condition = {'time':trim_before}
+            where_oper = '<'
+            result = debug_log.delete(where_condition=where_condition,where_oper=where_oper,debug_mode=True)
+            print(result)
+        elif days > 0:
+            logger.warning("{0} is not partitioned, so RETENTION_DAYS can't be applied. See dbscripts/avp_partitions.".format(table))
 
 
 if __name__ == '__main__':
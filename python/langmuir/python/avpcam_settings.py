@@ -6,6 +6,14 @@ FREQUENCY = dt.timedelta(minutes=15)
 # Misc
 MINWIND = 2.5 #m/s
 MAXWIND = 99 #m/s
+# Pipeline. Pictures are processed (annotated) in PROCESSES worker processes and uploaded by
+# a separate thread, so a slow upload doesn't hold up the next picture.
+PROCESSES = 1
+MAX_PENDING = 8 # Pictures taken but not yet uploaded. Any more and pictures are skipped.
+UPLOAD_RETRIES = 5
+UPLOAD_RETRY_WAIT = 60 # seconds before the first retry, doubling each time
+SFTP_KEEPALIVE = 30 # seconds between SSH keepalives on the upload connection, which is kept open
+SFTP_CHUNK_SIZE = 32768 # bytes
 
 
 # Global constants
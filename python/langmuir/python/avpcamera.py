@@ -9,11 +9,15 @@
 from configobj import ConfigObj
 from datetime import datetime
 import errno
+import hashlib
 import logging
 from math import atan,degrees
 import os
+import pipes
+import socket
 import subprocess
 import sys
+import threading
 import time
 import traceback
 
@@ -55,22 +59,26 @@ class Camera(object):
             dbh.setLevel(logging.DEBUG)
             self.logger.setLevel(logging.DEBUG)
         self.logger.addHandler(dbh)
-        # Get configuration
-        result_list_config = self.list_config(db=db)
-        if result_list_config is None:
-            print "Error: Unable to get configureation listing. Shutting down."
-            self.shutdown()
+        # The wind client is only shut down with the camera if the camera made it
+        self._own_wind = wind is None
         if wind is None:
             # Set up stuff for wind broker.
             self.wind = avp_broker.Y32500Broker(config)
         else:
             self.wind = wind
+        # Get configuration
+        result_list_config = self.list_config(db=db)
+        self.ready = result_list_config is not None # False if the camera didn't answer
+        if result_list_config is None:
+            print "Error: Unable to get configureation listing. Shutting down."
+            self.shutdown()
         #self.w_speed_ms = self.wind.wind_speed.value
         #self.w_dir = self.wind.wind_direction.value
         #self.c_dir = self.wind.compass_direction.value
     def shutdown(self):
-        self.wind.unsubscribe_all()
-        self.wind.disconnect()
+        if self._own_wind is True:
+            self.wind.unsubscribe_all()
+            self.wind.disconnect()
     def __del__(self):
         self.shutdown()
     def list_config(self,db=False):
@@ -344,6 +352,17 @@ class Camera(object):
         May want to call set_iso to check if there is enough light
         Returns Photo() instance
         '''
+        capture = self.capture(imgquality=imgquality,outpath=outpath,shell=shell,log_exif=log_exif,db=db)
+        if capture is None:
+            return None
+        capture.pop('capture_time')
+        return Photo(**capture)
+    def capture(self,imgquality=None,outpath=None,shell=False,log_exif=False,db=False):
+        ''' Takes a picture and downloads it, without processing it.
+        Same arguments as take_picture.
+        Returns a dictionary of Photo() arguments plus capture_time, which can be passed to
+        process_capture in another process, or None.
+        '''
         camera_imgquality = self.get_imgquality(db=db)
         if imgquality is None:
             print "No picture quality specified, using {0}:{1}".format(camera_imgquality,
@@ -358,7 +377,8 @@ class Camera(object):
                 self.set_imgquality(mode=imgquality,db=db)
         if outpath is None:
             outpath = s.IMAGEPATH + s.PATHS[imgquality] 
-        outfile = datetime.now().strftime(s.FILE_NAME_FORMAT)
+        capture_time = datetime.now()
+        outfile = capture_time.strftime(s.FILE_NAME_FORMAT)
         outfile = '{0}.{1}'.format(outfile, s.FILE_INFO[imgquality]['extension'])
         command = [s.GPHOTO2]
         if db is True:
@@ -378,13 +398,11 @@ class Camera(object):
             return None
         if db is True:
             print "{0} result:\n{1}".format(s.GPHOTO2,gphoto2_result)
-            print "INSTANTIATING NEW PHOTO {0}".format(outfile)
-        new_photo = Photo(file=outfile,path=outpath,imgquality=imgquality,
-                          wind_speed=wind_speed, 
-                          aw_spd=self.wind.average_wind_speed.value,
-                          w_dir=self.wind.wind_direction.value, c_dir=self.wind.compass_direction.value,
-                          instance_note=gphoto2_result,log_exif=log_exif,db=db)
-        return new_photo
+        return dict(file=outfile,path=outpath,imgquality=imgquality,
+                    wind_speed=wind_speed,
+                    aw_spd=self.wind.average_wind_speed.value,
+                    w_dir=self.wind.wind_direction.value, c_dir=self.wind.compass_direction.value,
+                    instance_note=gphoto2_result,log_exif=log_exif,db=db,capture_time=capture_time)
     def do_gphoto(self,command,shell=False,cwd='/tmp',db=False):
         gphoto2_result = do_subprocess(command,shell=shell,cwd=cwd,db=db)
         error = False
@@ -616,6 +634,22 @@ class Photo(object):
         pass
    
 
+def process_capture(capture):
+    ''' Makes the Photo (reading the EXIF data, annotating and saving the image) from a
+    Camera.capture() result. This is the slow part, so it is meant to be run in a multiprocessing.Pool.
+    Returns {'file','path','imgquality','capture_time'} for uploading, or None if it failed.
+    '''
+    capture = dict(capture)
+    capture_time = capture.pop('capture_time')
+    try:
+        if capture.get('db') is True: print "INSTANTIATING NEW PHOTO {0}".format(capture['file'])
+        photo = Photo(**capture)
+    except Exception,e:
+        print "Error: processing {0}{1}: {2}".format(capture['path'],capture['file'],e)
+        traceback.print_exc()
+        return None
+    return {'file':photo.file,'path':photo.path,'imgquality':photo.imgquality,'capture_time':capture_time}
+
 def do_subprocess(command,shell=False,cwd='/tmp',db=False):
     '''
     Spawns sub process
@@ -637,48 +671,177 @@ def do_subprocess(command,shell=False,cwd='/tmp',db=False):
     if db is True: print "do_subpreocess() result: {0}".format(result)
     return result
     
-def sftp_file(local_path, local_file, host, port=22, username=None, password=None, priv_key=None,
-              key_filename=None, timeout=None, remotepath='/tmp',remove_file=False,db=False):
-    ''' Send file via sftp
+class SFTPSession(object):
+    ''' An SSH connection and SFTP channel to one host which is kept open between files.
+    SSH keepalives are sent every keepalive seconds so an idle cellular link isn't dropped, and the
+    connection is made again the next time it is needed if it has been.
+    Files are written to <name>.part and renamed once their size (and md5sum, if the host can run it)
+    match, so a file interrupted part way through carries on from the size already sent.
+    Public Methods: put, put_many, close
     '''
-    local_path_full = local_path + local_file
-    remote_path_full = remotepath + local_file
-    if db is True: print "transfering {0} to {1}:{2}".format(local_path_full,host,remote_path_full)
-    ssh = paramiko.SSHClient()
-    if db is False:
-        logger = paramiko.util.logging.getLogger()
-        logger.setLevel(logging.INFO)
-    #ssh.set_missing_host_policy(paramiko.AutoAddPolicy()) # No need unless we change hosts.
-    try:
-        pkey = paramiko.RSAKey(filename=priv_key)
-        ssh.load_system_host_keys()
-        ssh.connect(host, port=port, username=username, password=password, pkey=pkey, 
-            key_filename=key_filename,timeout=timeout)
-        sftp = ssh.open_sftp()
+    def __init__(self,host,port=22,username=None,password=None,priv_key=None,key_filename=None,
+                 timeout=None,keepalive=30,db=False):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.priv_key = priv_key
+        self.key_filename = key_filename
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.db = db
+        self.ssh = None
+        self.sftp = None
+        self._remote_dirs = set() # Directories we know exist
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(self.__class__.__name__)
+    def _connect(self):
+        transport = self.ssh.get_transport() if self.ssh is not None else None
+        if transport is not None and transport.is_active() and self.sftp is not None:
+            return
+        self.close()
+        if self.db is True: print "Connecting to {0}:{1}".format(self.host,self.port)
+        pkey = paramiko.RSAKey(filename=self.priv_key) if self.priv_key else None
+        self.ssh = paramiko.SSHClient()
+        #self.ssh.set_missing_host_policy(paramiko.AutoAddPolicy()) # No need unless we change hosts.
+        self.ssh.load_system_host_keys()
+        self.ssh.connect(self.host,port=self.port,username=self.username,password=self.password,pkey=pkey,
+                         key_filename=self.key_filename,timeout=self.timeout)
+        self.ssh.get_transport().set_keepalive(self.keepalive)
+        self.sftp = self.ssh.open_sftp()
+    def close(self):
+        for connection in (self.sftp,self.ssh):
+            try:
+                if connection is not None:
+                    connection.close()
+            except Exception:
+                pass
+        self.sftp = self.ssh = None
+    def _make_dir(self,remotepath):
+        if remotepath in self._remote_dirs:
+            return
         try:
-            sftp.stat(remotepath)
+            self.sftp.stat(remotepath)
         except IOError,e:
-            if e.errno == errno.ENOENT: # Missing directory
-                sftp.mkdir(path=remotepath)
-            else:
-                logger.error("Couldn't stat({0}), e".format(remotepath,e))
+            if e.errno != errno.ENOENT:
+                raise
+            self.sftp.mkdir(path=remotepath)
+        self._remote_dirs.add(remotepath)
+    def _remote_md5(self,remote_file):
+        # None if the host can't tell us
+        try:
+            stdin,stdout,stderr = self.ssh.exec_command('md5sum {0}'.format(pipes.quote(remote_file)),timeout=self.timeout)
+            return stdout.read().split()[0]
+        except Exception:
+            return None
+    def put(self,local_path,local_file,remotepath='/tmp',remove_file=False):
+        ''' Sends local_path + local_file to remotepath + local_file, carrying on from a previous partial upload.
+        Returns 1 if it was sent, 0 if not.
+        '''
+        local_path_full = local_path + local_file
+        remote_path_full = remotepath + local_file
+        part_path = remote_path_full + '.part'
+        with self.lock:
+            try:
+                self._connect()
+                self._make_dir(remotepath)
+                local_size = os.path.getsize(local_path_full)
+                try:
+                    offset = self.sftp.stat(part_path).st_size
+                except IOError,e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    offset = 0
+                if offset > local_size:
+                    offset = 0
+                if self.db is True: print "transfering {0} to {1}:{2} from byte {3}".format(local_path_full,self.host,remote_path_full,offset)
+                md5 = hashlib.md5()
+                with open(local_path_full,'rb') as local:
+                    remote = self.sftp.open(part_path,'ab' if offset else 'wb')
+                    try:
+                        remote.set_pipelined(True)
+                        while True:
+                            chunk = local.read(s.SFTP_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            if local.tell() > offset:
+                                remote.write(chunk[max(offset - (local.tell() - len(chunk)),0):])
+                            md5.update(chunk)
+                    finally:
+                        remote.close()
+                remote_size = self.sftp.stat(part_path).st_size
+                remote_md5 = self._remote_md5(part_path)
+                if remote_size != local_size or (remote_md5 is not None and remote_md5 != md5.hexdigest()):
+                    self.logger.error('{0} does not match {1}:{2}, sending it again'.format(local_path_full,self.host,part_path))
+                    self.sftp.remove(part_path)
+                    return 0
+                try:
+                    self.sftp.posix_rename(part_path,remote_path_full)
+                except (IOError,AttributeError): # Server or paramiko doesn't have posix-rename
+                    try:
+                        self.sftp.remove(remote_path_full)
+                    except IOError:
+                        pass
+                    self.sftp.rename(part_path,remote_path_full)
+            except paramiko.BadHostKeyException,e:
+                print "Error BadHostKeyException:{0}".format(e)
+                self.close()
+                return 0
+            except paramiko.AuthenticationException,e:
+                print "Error AuthenticationException:{0}".format(e)
+                self.close()
+                return 0
+            except (paramiko.SSHException,IOError,OSError,EOFError,socket.error),e:
+                print "Error sending {0}:{1}".format(local_path_full,e)
+                self.close()
                 return 0
-        put_result = sftp.put(localpath=local_path_full, remotepath=remote_path_full)
-        if db is True: print "Put result: {0}".format(put_result)
         if remove_file is True:
             # Delete local file
-            if db is True: print "Removing {0}".format(local_path_full)
-            os.remove(local_path_full)
-    except paramiko.BadHostKeyException,e:
-        print "Error BadHostKeyException:{0}".format(e)
-    except paramiko.AuthenticationException,e:
-        print "Error AuthenticationException:{0}".format(e)
-    except paramiko.SSHException,e:
-        print "Error SSHException:{0}".format(e)
-    finally:
-        ssh.close()
-        del(ssh)
+            if self.db is True: print "Removing {0}".format(local_path_full)
+            try:
+                os.remove(local_path_full)
+            except OSError,e:
+                print "Error removing {0}:{1}".format(local_path_full,e)
         return 1
+    def put_many(self,files,remove_file=False):
+        ''' Sends a list of (local_path,local_file,remotepath) over this connection, stopping at the first failure.
+        Returns how many were sent.
+        '''
+        sent = 0
+        for local_path,local_file,remotepath in files:
+            if self.put(local_path,local_file,remotepath,remove_file=remove_file) != 1:
+                break
+            sent += 1
+        return sent
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_sftp_session(host,port=22,username=None,password=None,priv_key=None,key_filename=None,timeout=None,db=False):
+    ''' Returns this process's SFTPSession for host, port and username, making it the first time.
+    '''
+    key = (host,port,username)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = _sessions[key] = SFTPSession(host,port=port,username=username,password=password,priv_key=priv_key,
+                                                   key_filename=key_filename,timeout=timeout,
+                                                   keepalive=s.SFTP_KEEPALIVE,db=db)
+        return session
+
+def sftp_file(local_path, local_file, host, port=22, username=None, password=None, priv_key=None,
+              key_filename=None, timeout=None, remotepath='/tmp',remove_file=False,db=False):
+    ''' Send file via sftp, over the SFTPSession kept for host.
+    Returns 1 if the file was sent, 0 if not.
+    '''
+    if db is False:
+        logger = paramiko.util.logging.getLogger()
+        logger.setLevel(logging.INFO)
+    session = get_sftp_session(host,port=port,username=username,password=password,priv_key=priv_key,
+                               key_filename=key_filename,timeout=timeout,db=db)
+    return session.put(local_path,local_file,remotepath=remotepath,remove_file=remove_file)
         
 def reset_port(db=False):
     ''' Reset the usb port
@@ -6,7 +6,11 @@ Takes care of scheduling and recording Langmuir pictures
 from configobj import ConfigObj
 import datetime as dt
 import logging
+import multiprocessing
+import os
+import Queue
 import sys
+import threading
 import time
 #3rd party
 #import psycopg2
@@ -31,10 +35,126 @@ if db is True:
     dbh.setLevel(logging.DEBUG)
     logger.setLevel(logging.DEBUG)
 logger.addHandler(dbh)
-        
-        
+
+
+# Pictures go capture (this loop) -> process (pool) -> upload (upload thread).
+# pending is taken for each picture captured and given back once it is uploaded or given up on.
+pending = threading.BoundedSemaphore(s.MAX_PENDING)
+uploads = Queue.Queue()
+pool = multiprocessing.Pool(s.PROCESSES) # Made before any broker connections, which the workers don't need
+
+
+def processed(picture):
+    '''
+    Called in the pool's result thread with the result of avpcamera.process_capture.
+    '''
+    if picture is None:
+        pending.release()
+    else:
+        uploads.put(picture)
+
+def upload_pictures():
+    '''
+    Sends the pictures in uploads, oldest first, over one kept open SFTP connection. Everything
+    which has queued up while waiting (e.g. for the link to come back) goes in one batch.
+    '''
+    session = avpcamera.get_sftp_session(avpcamera.s.IMAGE_HOST,
+                                         username=avpcamera.s.IMAGE_HOST_USER,
+                                         priv_key=avpcamera.s.PRIV_KEY)
+    backlog = []
+    attempts = 0
+    retry_wait = s.UPLOAD_RETRY_WAIT
+    while True:
+        if not backlog:
+            backlog.append(uploads.get())
+        while True:
+            try:
+                backlog.append(uploads.get_nowait())
+            except Queue.Empty:
+                break
+        files = []
+        for picture in backlog:
+            remotepath = avpcamera.s.REMOTE_PATH
+            remotepath += avpcamera.s.PATHS.get(picture['imgquality'],'') # usually adds 'JPEG/'
+            remotepath += "{year}{month:02}/".format(year=picture['capture_time'].year,month=picture['capture_time'].month)
+            files.append((picture['path'],picture['file'],remotepath))
+        sent = session.put_many(files,remove_file=True)
+        for picture in backlog[:sent]:
+            pending.release()
+        del backlog[:sent]
+        if sent:
+            attempts = 0
+            retry_wait = s.UPLOAD_RETRY_WAIT
+        if backlog:
+            attempts += 1
+            if attempts > s.UPLOAD_RETRIES:
+                picture = backlog.pop(0)
+                logger.error('Giving up uploading {0}, it has been left in {1}'.format(picture['file'],picture['path']))
+                pending.release()
+                attempts = 0
+                retry_wait = s.UPLOAD_RETRY_WAIT
+            else:
+                logger.warning('Upload of {0} failed, {1} waiting, trying again in {2} seconds'.format(
+                               backlog[0]['file'],len(backlog),retry_wait))
+                time.sleep(retry_wait)
+                retry_wait *= 2
+
+uploader = threading.Thread(target=upload_pictures,name='upload_pictures')
+uploader.daemon = True
+uploader.start()
+
+
+# The wind client and camera are kept for the life of the program, and only made again if they fail.
+WIND_SUBSCRIPTIONS = ['wind_speed','average_wind_speed','wind_direction','compass_direction']
+SETTINGS_FILE = os.path.splitext(s.__file__)[0] + '.py'
+wind = None
+D40 = None
+
+
+def modified(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+def get_wind():
+    '''
+    Returns the subscribed wind client, connecting a new one if there isn't one or it has disconnected.
+    '''
+    global wind
+    if wind is not None and wind.socket_handler.connected is True:
+        return wind
+    if wind is not None:
+        logger.warning('Wind broker disconnected, reconnecting')
+        try:
+            wind.disconnect()
+        except Exception,e:
+            logger.debug('Error disconnecting wind broker: {0}'.format(e))
+    wind = WindBroker(config)
+    wind.add_subscriptions(WIND_SUBSCRIPTIONS,on_change=True)
+    if D40 is not None:
+        D40.wind = wind
+    return wind
+
+def get_camera():
+    '''
+    Returns the Camera, resetting the usb port and listing the camera's configuration the first time
+    and after the camera has failed. Returns None if the camera doesn't answer.
+    '''
+    global D40
+    if D40 is None:
+        avpcamera.reset_port(db=False)
+        D40 = avpcamera.Camera(config=config,wind=get_wind(),db=False)
+        if D40.ready is False:
+            D40 = None
+    return D40
+
+settings_modified = modified(SETTINGS_FILE)
+config_modified = modified(s.CONFIG_FILE)
+
 # Schedule loop
 while True:
+    cycle_start = time.time()
     skip_pic = False
     new_picture = None
     # Check time
@@ -43,21 +163,30 @@ while True:
         logger.debug('Time out of Range')
         # We should sleep until s.START_TIME
         time.sleep(s.FREQUENCY.seconds)
-        continue # Since we have yet to instantiate D40
-    # We need a camera for the next few checks, so instantiate it
-    reload(s) # In case settings have changed.
-    # Set up stuff for wind broker.
-    wind = WindBroker(config)
-    avpcamera.reset_port(db=False)
-    D40 = avpcamera.Camera(config=config,wind=wind,db=False)
+        continue
+    # Re-read the settings and config files only if they have changed.
+    if modified(SETTINGS_FILE) != settings_modified:
+        settings_modified = modified(SETTINGS_FILE)
+        logger.info('Reloading {0}'.format(SETTINGS_FILE))
+        reload(s)
+    if modified(s.CONFIG_FILE) != config_modified:
+        config_modified = modified(s.CONFIG_FILE)
+        logger.info('Reloading {0}'.format(s.CONFIG_FILE))
+        config.reload()
+        if wind is not None:
+            wind.disconnect()
+            wind = None
     # Check wind
-    aw_spd = wind.average_wind_speed.value
+    aw_spd = get_wind().average_wind_speed.value
     if aw_spd is None:
         skip_pic = True
         print "No wind data, skipping picture"
-    if aw_spd < avpcamera.s.MINWIND or aw_spd > avpcamera.s.MAXWIND:
+    elif aw_spd < avpcamera.s.MINWIND or aw_spd > avpcamera.s.MAXWIND:
         print "Wind speed of {0} m/s is out of range {1} - {2}".format(aw_spd,avpcamera.s.MINWIND,avpcamera.s.MAXWIND)
         skip_pic = True
+    if skip_pic is False and get_camera() is None:
+        print "Camera not responding, skipping picture"
+        skip_pic = True
     # Set ISO and see if we have enough light.
     if skip_pic is False:
         iso_result = D40.set_iso(db=False)
@@ -70,28 +199,23 @@ while True:
                     ape=iso_result.get('A','Unknown'),
                     iso=iso_result.get('I','Unknown'),
                     spd=iso_result.get('S','Unknown'))
-    if skip_pic is True:
-        D40.shutdown()
-    else:
-        now = dt.datetime.now()
-        new_picture = D40.take_picture(imgquality=2,log_exif=True,db=False)
-        if new_picture is not None:
-            # Now transfer the picture
-            remotepath = avpcamera.s.REMOTE_PATH
-            remotepath += avpcamera.s.PATHS.get(new_picture.imgquality,'') # usually adds 'JPEG/'
-            remotepath += "{year}{month:02}/".format(year=now.year,month=now.month)
-            avpcamera.sftp_file(new_picture.path,
-                new_picture.file,
-                avpcamera.s.IMAGE_HOST,
-                username=avpcamera.s.IMAGE_HOST_USER,
-                priv_key=avpcamera.s.PRIV_KEY,
-                remotepath=remotepath,remove_file=True)
-        D40.shutdown()
+    if skip_pic is False and pending.acquire(False) is False:
+        logger.warning('{0} pictures still waiting to be processed or uploaded, skipping picture'.format(s.MAX_PENDING))
+        skip_pic = True
+    if skip_pic is False:
+        new_picture = D40.capture(imgquality=2,log_exif=True,db=False)
+        if new_picture is None:
+            pending.release()
+            D40 = None # Reset the port and start again with the camera next time
+        else:
+            # Annotating and uploading happen in the background
+            pool.apply_async(avpcamera.process_capture,(new_picture,),callback=processed)
         
-    # Now sleep
+    # Now sleep until the next picture is due, however long this one took
     if new_picture is not None:
         sleep_time = s.FREQUENCY.seconds
     else:
         sleep_time = 60
-    print "Cycle Done, sleeping {0} seconds".format(sleep_time)
-    time.sleep(sleep_time)
\ No newline at end of file
+    sleep_time = max(sleep_time - (time.time() - cycle_start),0)
+    print "Cycle Done, sleeping {0:.0f} seconds".format(sleep_time)
+    time.sleep(sleep_time)
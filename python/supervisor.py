@@ -11,6 +11,7 @@
 from collections import deque
 from datetime import datetime, timedelta
 import logging
+import math
 import os
 import signal
 import socket
@@ -81,9 +82,7 @@ class Supervisor(object):
         power_table = self._config['db'].get('POWER_TABLE', '{0}_power'.format(socket.gethostname()))
         self.power_db = avp_db.AvpDB(self._config, power_table)
         # time of most recent warning issued by gps or compass (set to ten minutes ago)
-        self.latq = deque([])  # list from which the averages are taken
-        self.lonq = deque([])  # list from which the averages are taken
-        self.latlontimeq = deque([])  # list of associated times
+        self.positions = None  # PositionWindow of recent GPS fixes, made on the first _gps_checks
         self.gpsWarnTime = datetime.now(pytz.reference.LocalTimezone()) - timedelta(seconds=600)
         self.compassWarnTime = datetime.now(pytz.reference.LocalTimezone()) - timedelta(seconds=600)
         self.loops = 0 # Reset to 0 on any broker start so that we don't start scheduler too soon.
@@ -126,6 +125,22 @@ class Supervisor(object):
                                                 'pid': None,
                                                 'old_pid': None,
                                                 'root': False}
+        if self._config.get('broker', {}).get('SHM_BUS'):
+            # Shared memory value table, see avp_collector.py
+            self.py_processes['collector'] = {'search_str': 'avp_collector.py',
+                                              'spawn_str': '/home/avp/python/avp_collector.py',
+                                              'args': '/home/avp/python/{hostname}_avp.ini'.format(hostname=hostname),
+                                              'pid': None,
+                                              'old_pid': None,
+                                              'root': False}
+        if avp_util.t_or_f(self._config.get('broker', {}).get('USE_PROXY', False)):
+            # One connection per broker shared by all clients, see avp_proxy.py
+            self.py_processes['proxy'] = {'search_str': 'avp_proxy.py',
+                                          'spawn_str': '/home/avp/python/avp_proxy.py',
+                                          'args': '/home/avp/python/{hostname}_avp.ini'.format(hostname=hostname),
+                                          'pid': None,
+                                          'old_pid': None,
+                                          'root': False}
         while self._running:
             if datetime.now(pytz.reference.LocalTimezone()).second == 0 or check_cs is True:
                 if datetime.now(pytz.reference.LocalTimezone()).minute % self.CHECK_FREQ == 0 or check_cs is True:
@@ -180,17 +195,19 @@ class Supervisor(object):
             try:
                 mode = self.gps.mode.value
                 if mode == 3:   # only check gps for 3d fixes
-                    self.latq.append(self.gps.lat.value)
-                    self.lonq.append(self.gps.lon.value)
-                    self.latlontimeq.append(self.gps.lat.sample_time)
-                    # keep 900 seconds, and protect against bad data
-                    if self.latlontimeq[-1] - self.latlontimeq[0] > timedelta(seconds=900) or \
-                       self.latlontimeq[-1] - self.latlontimeq[0] < timedelta(seconds=0):
-                        self.latq.popleft()
-                        self.lonq.popleft()
-                        self.latlontimeq.popleft()
-                    lat = sum(self.latq) / len(self.latq)
-                    lon = sum(self.lonq) / len(self.lonq)
+                    if self.positions is None:
+                        self.positions = PositionWindow(window=getattr(self.gps, 'ANCHOR_WATCH_WINDOW', 900),
+                                                        average=getattr(self.gps, 'ANCHOR_WATCH_AVERAGE', 'mean'))
+                    self.positions.add(self.gps.lat.sample_time, self.gps.lat.value, self.gps.lon.value)
+                    lat, lon = self.positions.position()
+                    drift_rate, drift_bearing = self.positions.drift()
+                    drift_limit = getattr(self.gps, 'ANCHOR_WATCH_DRIFT_RATE', 0)
+                    if drift_rate is not None:
+                        self._logger.debug("GPS position moving {0:.2f}m/min toward {1:.0f} deg.".format(drift_rate,
+                                                                                                  drift_bearing))
+                        if drift_limit and drift_rate > drift_limit:
+                            out_of_position_message += "Moving {0:.1f}m/min toward {1:.0f} deg. ".format(drift_rate,
+                                                                                                   drift_bearing)
             except Exception as e:
                 print("Exception checking gps position: ", e)
             if mode == 3:   # only check gps for 3d fixes
@@ -235,27 +252,13 @@ class Supervisor(object):
             self._logger.debug('Wind client not initialized, skipping _wind_checks')
             return
         elif self.wind.connected() is True:
-            heading = self.wind.compass_direction.value
+            heading, off_target, deviation = self.wind.heading()
             warning = False
-            self._logger.debug('Profiler heading is {0}, target is {1}'.format(heading, self.wind.COMPASS_TARGET))
-            cwlimit = self.wind.COMPASS_TARGET + self.wind.COMPASS_MARGIN 
-            ccwlimit = self.wind.COMPASS_TARGET - self.wind.COMPASS_MARGIN
-            # Make sure everything is between 0 and 360
-            if cwlimit >= 360:
-                cwlimit -= 360
-            if cwlimit < 0:
-                cwlimit += 360
-            if ccwlimit >= 360:
-                ccwlimit -= 360
-            if ccwlimit < 0:
-                ccwlimit += 360
+            self._logger.debug('Profiler heading is {0}, target is {1}, deviation {2}'.format(heading,
+                               self.wind.COMPASS_TARGET, deviation))
             if datetime.now(pytz.reference.LocalTimezone()) > (self.compassWarnTime + timedelta(seconds=600)):
-                if cwlimit < ccwlimit:
-                    if ccwlimit > heading > cwlimit:
-                        warning = True
-                else:
-                    if heading > cwlimit or heading < ccwlimit:
-                        warning = True
+                if abs(off_target) > self.wind.COMPASS_MARGIN:
+                    warning = True
             if warning is True:
                 self._logger.warning('Platform heading of {0} indicates possible mooring problem'.format(heading))
                 self.compassWarnTime = datetime.now(pytz.reference.LocalTimezone())
@@ -694,6 +697,8 @@ class Supervisor(object):
                 self.wind = self.context.wind
             if self.wind.initialized is False:  # Need to try re-initializing the broker.
                 self.wind.re_structure_data(connect_tries=1)
+            if self.wind.initialized is True and 'compass_direction' not in self.wind.callbacks:
+                self.wind.track_wind()   # Averages the heading for _wind_checks
         if 'sounder' in self.broker_list: 
             if hasattr(self, 'sounder') is False:
                 self.sounder = self.context.sounder
@@ -751,6 +756,94 @@ class Supervisor(object):
         self.mm3.motor_cb(sample_dt, callback_obj)
 
 
+class PositionWindow(object):
+    """Averages the GPS fixes from the last window seconds and fits how fast they are moving.
+
+    Running sums are kept so adding a fix, dropping the expired ones and getting the mean or drift rate don't
+    depend on how many fixes are in the window. Positions are kept as metres north and east of a reference
+    fix, which is moved up to the oldest fix once it has expired so the sums don't lose precision.
+
+    Keyword arguments:
+    window -- Seconds of fixes to keep.
+    average -- 'mean', or 'median' which isn't pulled off by the odd bad fix.
+    """
+    M_PER_DEGREE = gislib.earthradius * 1000 * math.pi / 180
+
+    def __init__(self, window=900, average='mean'):
+        self.window = float(window)
+        self.average = average
+        self.fixes = deque()    # (seconds since reference time, north m, east m, lat, lon)
+        self._reset()
+
+    def _reset(self, reference=None):
+        self._ref_time, self._ref_lat, self._ref_lon, self._m_per_lon_degree = None, None, None, None
+        self._sums = [0.0] * 6  # t, t*t, north, t*north, east, t*east
+        if reference is not None:
+            self._ref_time, self._ref_lat, self._ref_lon = reference
+            self._m_per_lon_degree = self.M_PER_DEGREE * math.cos(math.radians(self._ref_lat))
+
+    def _sum(self, fix, sign):
+        t, north, east = fix[:3]
+        for i, value in enumerate((t, t * t, north, t * north, east, t * east)):
+            self._sums[i] += sign * value
+
+    def _rebase(self):
+        """Makes the oldest fix the reference and re-adds the fixes relative to it."""
+        fixes = [(self._ref_time + timedelta(seconds=t), lat, lon) for t, north, east, lat, lon in self.fixes]
+        self.fixes.clear()
+        self._reset(fixes[0])
+        for sample_time, lat, lon in fixes:
+            self._append(sample_time, lat, lon)
+
+    def _append(self, sample_time, lat, lon):
+        fix = ((sample_time - self._ref_time).total_seconds(),
+               (lat - self._ref_lat) * self.M_PER_DEGREE,
+               (lon - self._ref_lon) * self._m_per_lon_degree,
+               lat, lon)
+        self.fixes.append(fix)
+        self._sum(fix, 1)
+
+    def add(self, sample_time, lat, lon):
+        """Adds a fix and drops all those more than window seconds older than it.
+        A fix older than the previous one means the clock or the data is wrong, so the window starts again."""
+        if self._ref_time is None or (self.fixes and (sample_time - self._ref_time).total_seconds() < self.fixes[-1][0]):
+            self.fixes.clear()
+            self._reset((sample_time, lat, lon))
+        self._append(sample_time, lat, lon)
+        newest = self.fixes[-1][0]
+        while newest - self.fixes[0][0] > self.window:
+            self._sum(self.fixes.popleft(), -1)
+        if self.fixes[0][0] > self.window:
+            self._rebase()
+
+    def position(self):
+        """Returns the (lat, lon) of the fixes in the window, or (None, None) if there aren't any."""
+        n = len(self.fixes)
+        if n == 0:
+            return None, None
+        if self.average == 'median':
+            lats = sorted(fix[3] for fix in self.fixes)
+            lons = sorted(fix[4] for fix in self.fixes)
+            return (lats[(n - 1) // 2] + lats[n // 2]) / 2, (lons[(n - 1) // 2] + lons[n // 2]) / 2
+        return (self._ref_lat + self._sums[2] / n / self.M_PER_DEGREE,
+                self._ref_lon + self._sums[4] / n / self._m_per_lon_degree)
+
+    def drift(self):
+        """Returns (metres per minute, bearing in degrees) of the least squares line through the fixes in the
+        window, or (None, None) if there are fewer than three or they span less than a minute."""
+        n = len(self.fixes)
+        if n < 3 or self.fixes[-1][0] - self.fixes[0][0] < 60:
+            return None, None
+        sum_t, sum_tt, sum_north, sum_t_north, sum_east, sum_t_east = self._sums
+        denominator = n * sum_tt - sum_t * sum_t
+        if denominator <= 0:
+            return None, None
+        north = (n * sum_t_north - sum_t * sum_north) / denominator  # m/s
+        east = (n * sum_t_east - sum_t * sum_east) / denominator
+        bearing = math.degrees(math.atan2(east, north)) % 360
+        return math.hypot(north, east) * 60, bearing if bearing < 360 else 0.0  # A tiny negative angle % 360 is 360.0
+
+
 class BrokerInfo(object):
     """Holds information about each broker that we manage."""
     def __init__(self, name='', pid=0):